@@ -0,0 +1,213 @@
+#!/usr/bin/python3
+
+'''
+Discovery, advertising and droid connections spread over several adapters
+
+Scanning adapters each run their own device manager, all feeding one
+DroidDiscovery so a droid heard on several of them is one registry entry,
+with the RSSI last seen on each adapter kept in DroidEntry.adapters.
+Beacons are placed on the advertising adapter with the most free
+advertising instances. Droid connections go through the least loaded
+adapter that has seen the droid, as BlueZ can only connect to devices known
+to the adapter.
+
+With a single adapter it does all three, as before.
+'''
+
+import dbus
+import gatt
+
+import dbeacon
+import fleet
+import multiplex
+
+ADAPTER_IFACE = 'org.bluez.Adapter1'
+ADVERTISING_IFACE = 'org.bluez.LEAdvertisingManager1'
+
+def find_adapters(bus):
+    '''
+    :return: Adapter name -> names of the interfaces it implements, for
+    every adapter, ordered by name
+    :rtype: dict
+    '''
+    remote_om = dbus.Interface(bus.get_object('org.bluez', '/'),
+                               'org.freedesktop.DBus.ObjectManager')
+    objects = remote_om.GetManagedObjects()
+    adapters = {}
+    for path, interfaces in objects.items():
+        if ADAPTER_IFACE in interfaces:
+            adapters[str(path).rsplit('/', 1)[-1]] = set(interfaces)
+    return dict(sorted(adapters.items()))
+
+def plan(adapters, scanners=1):
+    '''
+    Split adapters into scanning and advertising ones
+
+    Adapters that cannot advertise scan first. At least one advertising
+    adapter is kept; with only one it also scans.
+
+    :param dict adapters: Output of find_adapters
+    :param int scanners: Number of adapters to scan on
+    :return: Lists of scanning and advertising adapter names
+    '''
+    advertisers = [name for name, interfaces in adapters.items() if ADVERTISING_IFACE in interfaces]
+    if not advertisers:
+        raise Exception('No adapter supports advertising')
+    scan = [name for name in adapters if name not in advertisers][:scanners]
+    while len(scan) < scanners and len(advertisers) > 1:
+        scan.append(advertisers.pop())
+    if not scan:
+        scan = advertisers[:1]
+    return scan, advertisers
+
+class Adapter(object):
+    '''
+    One adapter and what is running on it
+
+    :param gatt.DeviceManager manager: Manager for the adapter, an
+    AnyDeviceManager if it scans
+    '''
+    def __init__(self, name, manager, scan, advertise):
+        self.name = name
+        self.manager = manager
+        self.scan = scan
+        self.advertise = advertise
+        self.instances = multiplex.available_instances(manager) if advertise else 0
+        self.beacons = []
+        self.backend = None
+        self.connections = 0
+        self.connects = 0
+
+    def free_instances(self):
+        return self.instances - len(self.beacons)
+
+    def stats(self, discovery):
+        return {
+            'scan': self.scan,
+            'advertise': self.advertise,
+            'advertisements': discovery.adapters[self.name],
+            'beacons': len(self.beacons),
+            'instances': self.instances,
+            'connections': self.connections,
+            'connects': self.connects,
+        }
+
+class AdapterSet(object):
+    '''
+    :param list scanners: Names of the adapters to scan on
+    :param list advertisers: Names of the adapters to advertise on
+    :param scanner_factory: Called with an adapter name and returns the
+    scanning manager for it, such as an AnyDeviceManager sharing one
+    DroidDiscovery
+    :param DroidDiscovery discovery: Discovery the scanners feed
+    '''
+    def __init__(self, scanners, advertisers, scanner_factory, discovery):
+        self.discovery = discovery
+        self.adapters = {}
+        for name in scanners:
+            self.adapters[name] = Adapter(name, scanner_factory(name), True, name in advertisers)
+        for name in advertisers:
+            if name not in self.adapters:
+                self.adapters[name] = Adapter(name, gatt.DeviceManager(name), False, True)
+        # Advertisement object paths are per process, so indexes are
+        # unique across adapters
+        self.next_index = 0
+
+    @property
+    def scanners(self):
+        return [adapter for adapter in self.adapters.values() if adapter.scan]
+
+    def start_discovery(self):
+        for adapter in self.scanners:
+            adapter.manager.start_discovery()
+
+    def beacon(self, debounce=0):
+        '''
+        Create a dBeacon on the advertising adapter with the most free
+        instances
+
+        :rtype: dbeacon.dBeacon
+        '''
+        candidates = [adapter for adapter in self.adapters.values() if adapter.free_instances() > 0]
+        if not candidates:
+            raise Exception('No advertising instances available')
+        adapter = max(candidates, key=Adapter.free_instances)
+        ret = dbeacon.dBeacon(adapter.manager, self.next_index, debounce)
+        self.next_index += 1
+        adapter.beacons.append(ret)
+        return ret
+
+    def backend(self, writer_options=None):
+        '''
+        :return: A droid connection backend for fleet.DroidController
+        balancing connections over the scanning adapters
+        :rtype: ShardedBackend
+        '''
+        for adapter in self.scanners:
+            if adapter.backend is None:
+                adapter.backend = fleet.GattBackend(adapter.manager, writer_options)
+        return ShardedBackend(self.scanners, self.discovery.registry)
+
+    def stats(self):
+        return {name: adapter.stats(self.discovery) for name, adapter in self.adapters.items()}
+
+class ShardedBackend(object):
+    '''
+    fleet backend spreading droid connections over several adapters
+
+    Each connection goes to the adapter with the fewest live connections
+    among those the registry has seen the droid on, or among all of them
+    for droids not in the registry. The droid stays on that adapter until
+    the connection is lost or closed.
+
+    :param list adapters: Adapter objects with a backend
+    :param DroidRegistry droids: Registry fed by discovery on the adapters
+    '''
+    def __init__(self, adapters, droids):
+        self.adapters = {adapter.name: adapter for adapter in adapters}
+        self.droids = droids
+        self.assigned = {}
+
+    def pick(self, mac):
+        entry = self.droids.get(mac)
+        candidates = []
+        if entry is not None:
+            candidates = [self.adapters[name] for name in entry.adapters if name in self.adapters]
+        if not candidates:
+            candidates = list(self.adapters.values())
+        return min(candidates, key=lambda adapter: adapter.connections)
+
+    def connect(self, mac, ready, lost):
+        adapter = self.assigned.get(mac)
+        if adapter is None:
+            adapter = self.assigned[mac] = self.pick(mac)
+            adapter.connections += 1
+        adapter.connects += 1
+
+        def resolved(mac, handle):
+            ready(mac, (adapter, handle))
+
+        def disconnected(mac, error):
+            self.release(mac)
+            lost(mac, error)
+
+        adapter.backend.connect(mac, resolved, disconnected)
+
+    def release(self, mac):
+        adapter = self.assigned.pop(mac, None)
+        if adapter is not None:
+            adapter.connections -= 1
+        return adapter
+
+    def disconnect(self, mac):
+        adapter = self.release(mac)
+        if adapter is not None:
+            adapter.backend.disconnect(mac)
+
+    def forget(self, mac):
+        for adapter in self.adapters.values():
+            adapter.backend.forget(mac)
+
+    def writer(self, handle, drained):
+        adapter, handle = handle
+        return adapter.backend.writer(handle, drained)
@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+
+import collections
+import time
+
+import dbeacon
+import mainloop
+import registry
+
+class BayAutomation(object):
+    '''
+    Pair and activate droids placed in a bay without an operator
+
+    Fed every droid advertisement by DroidDiscovery. While idle, the
+    strongest unpaired droid reporting this bay is picked and the
+    DROID_DEPOT_ACTIVATE_PAIR beacon put up for it. The first
+    advertisement showing it paired withdraws the beacon and puts up
+    DROID_DEPOT_ACTIVATE_GO. The droid's advertisement does not
+    acknowledge GO, so the GO beacon is withdrawn as soon as the droid
+    advertises a change other than RSSI, or after activate_time ms. The
+    bay is then idle again.
+
+    Served droids are not picked again until cooldown seconds after they
+    were served; droids that time out wait the same time.
+
+    activated counts droids that confirmed GO by a change in their
+    advertisement, go_timeouts those whose GO beacon was withdrawn after
+    activate_time without one.
+
+    :param dBeacon adv: Advertisement of this bay
+    :param int bay: Bay number, as sent in the depot bay beacon
+    :param DroidRegistry droids: Registry updated by discovery
+    :param int min_rssi: Weakest RSSI at which a droid is considered
+    placed in the bay
+    :param int timeout: ms to wait for a droid to confirm pairing
+    :param int delay: Default delay / 100 sent with the GO beacon
+    '''
+    def __init__(self, adv, bay, droids, min_rssi=-75, timeout=10000, activate_time=3000, delay=2, cooldown=120,
+                 clock=time.monotonic):
+        self.adv = adv
+        self.bay = bay
+        self.droids = droids
+        self.min_rssi = min_rssi
+        self.timeout = timeout
+        self.activate_time = activate_time
+        self.delay = delay
+        self.cooldown = cooldown
+        self.clock = clock
+        self.state = registry.IDLE
+        self.target = None
+        self.fields = None
+        self.timer = None
+        self.recent = collections.OrderedDict()
+        self.paired = 0
+        self.activated = 0
+        self.go_timeouts = 0
+        self.timeouts = 0
+        self.cancelled = 0
+
+    @staticmethod
+    def summary(entry):
+        record = entry.record
+        return tuple(record[field] for field in record.fields if field != 'rssi')
+
+    def advertisement(self, entry):
+        if self.state == registry.IDLE:
+            if entry.bay == self.bay:
+                self.pick()
+        elif entry is self.target:
+            if self.state == registry.PAIRING:
+                if entry.paired:
+                    self.paired += 1
+                    self.activate()
+            elif self.summary(entry) != self.fields:
+                self.activated += 1
+                self.finish()
+
+    def pick(self):
+        now = self.clock()
+        while self.recent and now - next(iter(self.recent.values())) >= self.cooldown:
+            self.recent.popitem(last=False)
+        candidates = [entry for entry in self.droids.in_bay(self.bay)
+                      if not entry.paired and entry.state == registry.IDLE and entry.mac not in self.recent
+                      and entry.rssi and entry.rssi[-1] >= self.min_rssi]
+        if candidates:
+            self.pair(max(candidates, key=lambda entry: entry.rssi[-1]))
+
+    def pair(self, entry):
+        self.target = entry
+        self.enter(registry.PAIRING, self.timeout, self.expired)
+        self.adv.add_droid_depot_activate(entry.addr, dbeacon.DROID_DEPOT_ACTIVATE_PAIR, 0)
+
+    def activate(self):
+        self.fields = self.summary(self.target)
+        self.enter(registry.ACTIVATING, self.activate_time, self.activate_done)
+        self.adv.add_droid_depot_activate(self.target.addr, dbeacon.DROID_DEPOT_ACTIVATE_GO, self.delay)
+
+    def enter(self, state, interval, callback):
+        self.cancel_timer()
+        self.state = state
+        self.target.state = state
+        self.timer = mainloop.timeout_add(interval, callback)
+
+    def cancel_timer(self):
+        if self.timer is not None:
+            mainloop.source_remove(self.timer)
+            self.timer = None
+
+    def activate_done(self):
+        self.timer = None
+        self.go_timeouts += 1
+        self.finish()
+        return False
+
+    def expired(self):
+        self.timer = None
+        self.timeouts += 1
+        self.finish()
+        return False
+
+    def cancel(self, entry=None):
+        '''
+        Withdraw the beacon of the droid being served, if it is entry when
+        given
+
+        :return: The droid's address, None if there was nothing to cancel
+        '''
+        if self.state == registry.IDLE or (entry is not None and entry is not self.target):
+            return None
+        mac = self.target.mac
+        self.cancelled += 1
+        self.finish()
+        return mac
+
+    def finish(self):
+        '''
+        Withdraw the activate beacon and go back to idle
+        '''
+        self.cancel_timer()
+        self.target.state = registry.IDLE
+        self.recent[self.target.mac] = self.clock()
+        self.recent.move_to_end(self.target.mac)
+        self.target = None
+        self.fields = None
+        self.state = registry.IDLE
+        with self.adv.batch():
+            self.adv.remove_droid_depot_activate()
+            self.pick()
+
+    def stats(self):
+        return {
+            'bay': self.bay,
+            'state': self.state,
+            'target': None if self.target is None else self.target.mac,
+            'paired': self.paired,
+            'activated': self.activated,
+            'go_timeouts': self.go_timeouts,
+            'timeouts': self.timeouts,
+            'cancelled': self.cancelled,
+        }
@@ -1,35 +1,46 @@
 #!/usr/bin/python3
 
 import gatt
-import struct
 import signal
-import binascii
 import sys
 import os
 import fcntl
-import datetime
-import gi.repository
+import argparse
+import collections
+import multiprocessing
+import adapters
+import autopilot
+import capture
 import dbeacon
+import fleet
+import gatt_writer
+import discovery
+import droidtable
+import control
+import mainloop
+import metrics
+import obslog
+import registry
 import dbus
-from PyQt5 import QtCore
-import dbus.mainloop.pyqt5
 
 class IODriver(object):
     def __init__(self, line_callback):
-        self.buffer = ''
+        self.lines = control.LineBuffer()
         self.line_callback = line_callback
         flags = fcntl.fcntl(sys.stdin.fileno(), fcntl.F_GETFL)
         flags |= os.O_NONBLOCK
         fcntl.fcntl(sys.stdin.fileno(), fcntl.F_SETFL, flags)
-        gi.repository.GLib.io_add_watch(sys.stdin, gi.repository.GLib.IO_IN, self.io_callback)
+        mainloop.io_add_watch(sys.stdin.fileno(), mainloop.IO_IN, self.io_callback)
 
     def io_callback(self, fd, condition):
-        chunk = fd.read()
-        for char in chunk:
-            self.buffer += char
-            if char == '\n':
-                self.line_callback(self.buffer)
-                self.buffer = ''
+        try:
+            chunk = os.read(fd, 65536)
+        except BlockingIOError:
+            return True
+        if not chunk:
+            return False
+        for line in self.lines.feed(chunk):
+            self.line_callback(line.decode(errors='replace') + '\n')
 
         return True
 
@@ -49,43 +60,198 @@ def find_adapter(bus):
     return None
 
 class AnyDeviceManager(gatt.DeviceManager):
-    def __init__(self, adapter_name):
+    DEVICE_IFACE = 'org.bluez.Device1'
+
+    def __init__(self, adapter_name, rssi_floor=-90, recorder=None, droid_discovery=None, sharded=False,
+                 listen=True):
+        '''
+        :param DroidDiscovery droid_discovery: Discovery to feed, shared by
+        the managers of all scanning adapters
+        :param bool sharded: Tag advertisements with the adapter name
+        :param bool listen: Handle advertisements in this process, False
+        when discovery runs in worker processes
+        '''
         super().__init__(adapter_name)
-        self.connect_signals()
-        self.addr = None
+        self.rssi_floor = rssi_floor
+        self.sharded = sharded
+        self.device_properties = {}
+        if listen:
+            self.connect_signals()
+        if droid_discovery is None:
+            droid_discovery = discovery.DroidDiscovery(recorder=recorder)
+        self.discovery = droid_discovery
+        self.adapters = None
+        self.fleet = None
+        self.workers = None
+        self.log = None
+        self.automation = None
+        self.registry = self.discovery.registry
+        self.parse_cache = self.discovery.parse_cache
 
-    def device_discovered(self, device):
-        super().device_discovered(device)
-        if device.alias() != 'DROID':
-            return
+    def start_discovery(self, service_uuids=[]):
+        '''
+        Start LE discovery, letting the controller drop weak advertisements
+        and report every advertisement rather than only changed ones
+        '''
+        discovery_filter = {'Transport': 'le', 'DuplicateData': True}
+        if self.rssi_floor is not None:
+            discovery_filter['RSSI'] = dbus.Int16(self.rssi_floor)
+        if service_uuids:
+            discovery_filter['UUIDs'] = service_uuids
+        self._adapter.SetDiscoveryFilter(discovery_filter)
+        self._adapter.StartDiscovery()
 
-        mfd = device._properties.Get('org.bluez.Device1', 'ManufacturerData')
-        if dbeacon.MFG_ID_DISNEY not in mfd:
+    def _interfaces_added(self, path, interfaces):
+        props = interfaces.get(self.DEVICE_IFACE)
+        if props is None or not self._device_path_regex.match(path):
             return
+        self.device_properties[path] = dict(props)
+        self.device_seen(path, props)
 
-        dbeacons = dbeacon.parse(bytes(mfd[dbeacon.MFG_ID_DISNEY]))
-        if 0x03 not in dbeacons or dbeacons[0x03]['droid_id'] != 0x44:
-            return
+    def _interfaces_removed(self, path, interfaces):
+        if self.DEVICE_IFACE in interfaces:
+            self.device_properties.pop(path, None)
 
-        affiliation = dbeacon.affiliation[dbeacons[0x03]['affiliation']]
-        personality = dbeacon.personality[dbeacons[0x03]['personalityChip']]
-        desc = f'{device.alias()} [{device.mac_address}] {affiliation}/{personality}'
-        now = datetime.datetime.now()
-        print(f'[{now:%H:%M:%S}] Discovered [{device.mac_address}] {device.alias()}', dbeacons[3])
-        self.addr = bytearray.fromhex(''.join(device.mac_address.split(':')))
+    def _properties_changed(self, interface, changed, invalidated, path):
+        props = self.device_properties.get(path)
+        if props is None:
+            # Signals from devices of other adapters arrive too
+            if not self._device_path_regex.match(path):
+                return
+            # Device known to BlueZ before we started, fetch once
+            try:
+                props = dict(dbus.Interface(self._bus.get_object('org.bluez', path),
+                                            dbus.PROPERTIES_IFACE).GetAll(self.DEVICE_IFACE))
+            except dbus.exceptions.DBusException:
+                return
+            self.device_properties[path] = props
+        else:
+            props.update(changed)
+        for name in invalidated:
+            props.pop(name, None)
+        if 'ManufacturerData' in changed:
+            self.device_seen(path, props)
 
-    def line_entered(self, line):
-        if line[0] == '1':
-            if self.addr is not None:
-                print(f'pair {self.addr}')
-                self.adv.add_droid_depot_activate(self.addr, dbeacon.DROID_DEPOT_ACTIVATE_PAIR, 0)
-        elif line[0] == '2':
-            if self.addr is not None:
-                print(f'activate {self.addr}')
-                self.adv.add_droid_depot_activate(self.addr, dbeacon.DROID_DEPOT_ACTIVATE_GO, 2)
+    def device_seen(self, path, props):
+        '''
+        Handle an advertisement using the properties carried by the D-Bus
+        signals, without querying the device
+        '''
+        rssi = props.get('RSSI')
+        self.discovery.advertisement(str(props.get('Address') or self._mac_address(path)),
+                                     props.get('Alias'), None if rssi is None else int(rssi),
+                                     props.get('ManufacturerData'),
+                                     adapter=self.adapter_name if self.sharded else None)
+
+    def manual(self):
+        if self.automation is not None:
+            raise Exception(f'Bay {self.automation.bay} is automated, only remove is accepted')
+
+    def control_pair(self, mac=None, bay=None):
+        self.manual()
+        droid = self.registry.find(mac, bay)
+        self.adv.add_droid_depot_activate(droid.addr, dbeacon.DROID_DEPOT_ACTIVATE_PAIR, 0)
+        droid.state = registry.PAIRING
+        return {'mac': droid.mac}
+
+    def control_activate(self, mac=None, bay=None, delay=2):
+        self.manual()
+        droid = self.registry.find(mac, bay)
+        self.adv.add_droid_depot_activate(droid.addr, dbeacon.DROID_DEPOT_ACTIVATE_GO, delay)
+        droid.state = registry.ACTIVATING
+        return {'mac': droid.mac}
+
+    def control_remove(self, mac=None, bay=None):
+        '''
+        Withdraw the activator beacon. Given a droid, only if the beacon is
+        up for that droid. With automation, cancels what it is doing.
+        '''
+        if self.automation is not None:
+            droid = None if mac is None and bay is None else self.registry.find(mac, bay)
+            target = self.automation.cancel(droid)
+            return {'removed': target, 'macs': [] if target is None else [target]}
+        target = self.adv.depot_activate_target()
+        if mac is None and bay is None:
+            droids = [droid for droid in self.registry if droid.state != registry.IDLE]
         else:
-            print('removed')
+            droids = [self.registry.find(mac, bay)]
+            if target != droids[0].mac:
+                target = None
+        if target is not None:
             self.adv.remove_droid_depot_activate()
+        for droid in droids:
+            droid.state = registry.IDLE
+        return {'removed': target, 'macs': [droid.mac for droid in droids]}
+
+    def control_send(self, data, mac=None, bay=None):
+        '''
+        Send a command buffer, as hex, to a droid over GATT, connecting
+        through the least loaded adapter that has seen it
+        '''
+        droid = self.registry.find(mac, bay)
+        buf = bytes.fromhex(data)
+        # Reject malformed buffers here rather than when the droid connects
+        commands = sum(count for packet, count in gatt_writer.packetize(buf, 512))
+        self.fleet.send(droid.mac, buf)
+        return {'mac': droid.mac, 'commands': commands}
+
+    def control_list(self):
+        return {'droids': self.registry.as_list()}
+
+    def control_stats(self):
+        return {'automation': None if self.automation is None else self.automation.stats(),
+                'discovery': self.discovery.stats(),
+                'registry': self.registry.stats(),
+                'parse_cache': self.parse_cache.stats(),
+                'adapters': None if self.adapters is None else self.adapters.stats(),
+                'fleet': None if self.fleet is None else self.fleet.stats(),
+                'workers': None if self.workers is None else self.workers.stats(),
+                'log': None if self.log is None else self.log.stats(),
+                'refreshes_avoided': self.adv.refreshes_avoided,
+                'control': self.control.stats()}
+
+    def control_metrics(self, format='json'):
+        if format == 'prometheus':
+            return {'text': metrics.export()}
+        return {'histograms': metrics.snapshot()}
+
+    def control_handlers(self):
+        return {
+            'metrics': self.control_metrics,
+            'pair': self.control_pair,
+            'activate': self.control_activate,
+            'remove': self.control_remove,
+            'send': self.control_send,
+            'list': self.control_list,
+            'stats': self.control_stats,
+        }
+
+    def line_entered(self, line):
+        '''
+        Operator commands: 1 (pair), 2 (activate), s (stats), anything else
+        removes the activation. 1 and 2 take an optional MAC or bay number,
+        defaulting to the most recently seen droid; given one, remove only
+        withdraws an activation for that droid.
+        '''
+        words = line.split()
+        if not words:
+            return
+        target = {}
+        if len(words) > 1:
+            target = {'bay': int(words[1])} if words[1].isdigit() else {'mac': words[1]}
+        try:
+            if line[0] == '1':
+                print('pair', self.control_pair(**target)['mac'])
+            elif line[0] == '2':
+                print('activate', self.control_activate(**target)['mac'])
+            elif line[0] == 's':
+                print('registry', self.registry.stats())
+                print('parse cache', self.parse_cache.stats())
+                print('advertisement refreshes avoided', self.adv.refreshes_avoided)
+            else:
+                print('removed', self.control_remove(**target)['removed'])
+        except Exception as e:
+            print(e)
 
     def connect_signals(self):
         self._interface_added_signal = self._bus.add_signal_receiver(
@@ -98,25 +264,179 @@ class AnyDeviceManager(gatt.DeviceManager):
             signal_name='PropertiesChanged',
             arg0='org.bluez.Device1',
             path_keyword='path')
+        self._interfaces_removed_signal = self._bus.add_signal_receiver(
+            self._interfaces_removed,
+            dbus_interface='org.freedesktop.DBus.ObjectManager',
+            signal_name='InterfacesRemoved')
+
+def worker_main(adapter_name, table_name, rssi_floor, loop, sharded):
+    '''
+    Discovery worker process for --workers: scan on one adapter and
+    publish each droid advertisement to the coordinator's table
+    '''
+    # The coordinator handles Ctrl-C and terminates the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    mainloop.install(loop)
+    table = droidtable.DroidTable.attach(table_name)
+    manager = AnyDeviceManager(adapter_name=adapter_name, rssi_floor=rssi_floor, sharded=sharded)
+    parent = os.getppid()
+    counts = collections.Counter()
+
+    def publish(entry):
+        counts[entry.mac] += 1
+        table.write(entry.mac, entry.record, entry.rssi[-1], counts[entry.mac])
+
+    def tick():
+        for mac in counts.keys() - manager.registry.entries.keys():
+            del counts[mac]
+        table.counters(manager.discovery.advertisements, manager.discovery.droids)
+        if os.getppid() != parent:
+            mainloop.quit()
+        return True
+
+    manager.discovery.listeners.append(publish)
+    manager.start_discovery()
+    mainloop.timeout_add(1000, tick)
+    mainloop.run()
+
+class DiscoveryWorkers(object):
+    '''
+    One discovery process per scanning adapter, each writing decoded droids
+    to a droidtable.DroidTable that is polled into the coordinator's
+    DroidDiscovery
+
+    Advertisement handling time is not measured in the coordinator and
+    droids are marked discovered when polled, see metrics.
+    '''
+    def __init__(self, droid_discovery, scanners, rssi_floor, loop, sharded, interval=100):
+        self.discovery = droid_discovery
+        self.sharded = sharded
+        self.tables = {}
+        self.processes = {}
+        context = multiprocessing.get_context('spawn')
+        for name in scanners:
+            table = self.tables[name] = droidtable.DroidTable.create()
+            self.processes[name] = context.Process(target=worker_main, name=f'discovery-{name}', daemon=True,
+                                                   args=(name, table.name, rssi_floor, loop, sharded))
+            self.processes[name].start()
+        mainloop.timeout_add(interval, self.poll)
+
+    def poll(self):
+        for name, table in self.tables.items():
+            adapter = name if self.sharded else None
+            for mac, record, rssi, last_seen, count in table.changed():
+                self.discovery.droid(mac, record, rssi, adapter)
+        return True
+
+    def stats(self):
+        return {name: dict(table.stats(), alive=self.processes[name].is_alive())
+                for name, table in self.tables.items()}
+
+    def close(self):
+        for name, process in self.processes.items():
+            process.terminate()
+            process.join()
+            self.tables[name].close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Droid depot bay controller')
+    parser.add_argument('--loop', choices=sorted(mainloop.backends), default=None,
+                        help='Main loop backend (default: $DROID_MAINLOOP or glib)')
+    parser.add_argument('--rssi-floor', type=int, default=-90,
+                        help='Ignore advertisements weaker than this, in dBm')
+    parser.add_argument('--capture', metavar='FILE',
+                        help='Record every advertisement seen to FILE for capture.py replay')
+    parser.add_argument('--log', metavar='FILE',
+                        help='Append every droid advertisement to the observation log FILE, see obslog.py')
+    parser.add_argument('--auto', action='store_true',
+                        help='Pair and activate droids placed in the bay automatically')
+    parser.add_argument('--adapters', metavar='HCI,...',
+                        help='Comma separated adapters to use (default: all)')
+    parser.add_argument('--scanners', type=int, default=1,
+                        help='Number of adapters to scan on, the others advertise')
+    parser.add_argument('--connections', type=int, default=8,
+                        help='Most droids connected at once for the send command')
+    parser.add_argument('--workers', action='store_true',
+                        help='Run discovery for each scanning adapter in its own process')
+    parser.add_argument('--bay', type=int, default=5, help='Bay number to advertise')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='Write latency histograms to FILE in the Prometheus text format every 10s')
+    parser.add_argument('control', nargs='?', default='/tmp/droid_bay.sock',
+                        help='Control socket path')
+    args = parser.parse_args()
+    if args.workers and args.capture:
+        parser.error('--capture is not supported with --workers')
+
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    mainloop.install(args.loop)
+
+    found = adapters.find_adapters(dbus.SystemBus())
+    if args.adapters:
+        missing = [name for name in args.adapters.split(',') if name not in found]
+        if missing:
+            parser.error('unknown adapter ' + ', '.join(missing))
+        found = {name: found[name] for name in args.adapters.split(',')}
+    scanners, advertisers = adapters.plan(found, args.scanners)
+    # Called in reverse order when the main loop exits
+    cleanup = []
+    recorder = None
+    if args.capture:
+        recorder = capture.CaptureWriter(open(args.capture, 'wb', buffering=65536))
+        cleanup.append(recorder.close)
+    droid_discovery = discovery.DroidDiscovery(recorder=recorder)
+    sharded = len(found) > 1
+
+    def scanner(adapter_name):
+        return AnyDeviceManager(adapter_name=adapter_name, rssi_floor=args.rssi_floor,
+                                droid_discovery=droid_discovery, sharded=sharded, listen=not args.workers)
+    shards = adapters.AdapterSet(scanners, advertisers, scanner, droid_discovery)
+    manager = shards.scanners[0].manager
+    manager.adapters = shards
+    manager.fleet = fleet.DroidController(shards.backend(), max_connections=args.connections)
+    print('scanning on', ', '.join(scanners), 'advertising on', ', '.join(advertisers))
 
-signal.signal(signal.SIGINT, signal.SIG_DFL)
+    adv = shards.beacon()
+    #adv.add_droid_location(2, 2, -90, 1)
+    #adv.add_droid_depot_activate(bytearray.fromhex('d5a8b5ba307a'), 2, 0)
+    adv.add_droid_depot_bay(args.bay, -90)
+    adv.register(register_ad_cb, register_ad_error_cb)
+    manager.adv = adv
 
-dbus.mainloop.pyqt5.DBusQtMainLoop(set_as_default=True)
-app = QtCore.QCoreApplication(sys.argv)
+    if args.log:
+        manager.log = obslog.ObservationWriter(args.log)
+        cleanup.append(manager.log.close)
+        manager.discovery.listeners.append(manager.log.observer)
 
-adapter_name = os.path.basename(find_adapter(dbus.SystemBus()))
-manager = AnyDeviceManager(adapter_name=adapter_name)
+    if args.auto:
+        manager.automation = autopilot.BayAutomation(adv, args.bay, manager.registry)
+        manager.discovery.listeners.append(manager.automation.advertisement)
 
-adv = dbeacon.dBeacon(manager, 0)
-#adv.add_droid_location(2, 2, -90, 1)
-#adv.add_droid_depot_activate(bytearray.fromhex('d5a8b5ba307a'), 2, 0)
-adv.add_droid_depot_bay(5, -90)
-adv.register(register_ad_cb, register_ad_error_cb)
-manager.adv = adv
+    if args.workers:
+        manager.workers = DiscoveryWorkers(droid_discovery, scanners, args.rssi_floor, args.loop, sharded)
+        cleanup.append(manager.workers.close)
+    else:
+        shards.start_discovery()
 
-manager.start_discovery()
+    d = IODriver(manager.line_entered)
+    manager.control = control.ControlServer(args.control, manager.control_handlers())
 
-d = IODriver(manager.line_entered)
+    if args.metrics:
+        def write_metrics():
+            metrics.write(args.metrics)
+            return True
+        mainloop.timeout_add(10000, write_metrics)
 
-app.exec_()
+    def shutdown():
+        mainloop.quit()
+        return False
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        mainloop.signal_add(signum, shutdown)
+    try:
+        mainloop.run()
+    finally:
+        for close in reversed(cleanup):
+            close()
 
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,8 @@ import dbus.service
 
 import array
 
+import metrics
+
 DBUS_PROP_IFACE = 'org.freedesktop.DBus.Properties'
 
 LE_ADVERTISEMENT_IFACE = 'org.bluez.LEAdvertisement1'
@@ -56,19 +58,34 @@ class Advertisement(dbus.service.Object):
         self.rh = None
         self.eh = None
         self.running = False
+        self.register_started = None
         dbus.service.Object.__init__(self, manager._bus, self.path)
 
     def refresh(self):
     	if self.running:
              self.ad_manager.UnregisterAdvertisement(self.get_path())
-             self.ad_manager.RegisterAdvertisement(self.get_path(), {}, reply_handler=self.rh, error_handler=self.eh)
+             self.register_sent()
+             self.ad_manager.RegisterAdvertisement(self.get_path(), {}, reply_handler=self.registered, error_handler=self.eh)
 
     def register(self, reply_handler=empty_reply_handler, error_handler=empty_error_handler):
         self.manager._adapter_properties.Set("org.bluez.Adapter1", "Powered", dbus.Boolean(1))
         self.rh = reply_handler
         self.eh = error_handler
         self.running = True
-        self.ad_manager.RegisterAdvertisement(self.get_path(), {}, reply_handler=self.rh, error_handler=self.eh)
+        self.register_sent()
+        self.ad_manager.RegisterAdvertisement(self.get_path(), {}, reply_handler=self.registered, error_handler=self.eh)
+
+    def register_sent(self):
+        self.register_started = metrics.clock()
+
+    def registered(self):
+        metrics.advertisement_register.observe(metrics.clock() - self.register_started)
+        self.rh()
+
+    def unregister(self):
+        if self.running:
+            self.running = False
+            self.ad_manager.UnregisterAdvertisement(self.get_path())
 
     def get_properties(self):
         properties = dict()
@@ -0,0 +1,436 @@
+#!/usr/bin/python3
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import struct
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import commands
+import droid_cmd
+import parse_entry1
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+class legacy_cmd_buffer:
+    '''
+    The original immutable bytes command buffer, kept as a reference
+    '''
+    def __init__(self):
+        self.buf = b''
+
+    def pop(self):
+        ret = self.buf
+        self.buf = b''
+        return ret
+
+    def cmd(self, id, data=b'', sub_cmd=0x00):
+        if len(data) > 0x1f:
+            raise Exception('Command data too large')
+        self.buf += struct.pack('>BBBB', (len(data)+3) | 0x20, sub_cmd, id, len(data) | 0x40) + data
+
+    def led_rgb_ramp(self, idx, rgb_end_value, ramp_time):
+        self.cmd(0x04, struct.pack('>BBHBBB', 0x04, idx, ramp_time, rgb_end_value[0], rgb_end_value[1], rgb_end_value[2]))
+
+    def delay(self, delay):
+        self.cmd(0x0d, struct.pack('>H', delay))
+
+    def cmd_script(self, id, data=b''):
+        self.cmd(id, data, sub_cmd=0x42)
+
+def timeit(fn, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def bench_cmd_buffer():
+    step = bytes.fromhex('0400b400c8012c')
+    for count in (100, 1000, 10000):
+        def build(cls):
+            def fn():
+                buf = cls()
+                for i in range(count):
+                    buf.led_rgb_ramp(i & 0x7f, (i & 0xff, 0x80, 0x40), 200)
+                    buf.delay(100)
+                    buf.cmd_script(0x04, step)
+                buf.pop()
+            return fn
+        legacy = timeit(build(legacy_cmd_buffer))
+        current = timeit(build(droid_cmd.droid_cmd_buffer))
+        ops = count * 3
+        print(f'cmd_buffer {ops:6d} cmds: legacy {ops / legacy:10.0f}/s, current {ops / current:10.0f}/s, {legacy / current:5.1f}x')
+
+_field_ranges = {'B': 0x100, 'H': 0x10000}
+
+def random_fields(spec, rnd):
+    return {field: rnd.randrange(_field_ranges[fmt]) for field, fmt in zip(spec.fields, spec.fmt)}
+
+def bench_codec():
+    rnd = random.Random(0)
+    calls = [(spec.encode, tuple(random_fields(spec, rnd).values())) for spec in commands.commands] * 100
+    def encode():
+        buf = bytearray()
+        for encode, args in calls:
+            encode(buf, 0x42, *args)
+    elapsed = timeit(encode)
+    print(f'encode: {len(calls) / elapsed:10.0f} cmds/s')
+
+    entries = [bytes.fromhex(entry) for entry in parse_entry1.entries.values()]
+    count = sum(len(parse_entry1.parse(entry)) for entry in entries) * 100
+    def decode():
+        for _ in range(100):
+            for entry in entries:
+                for cmd in parse_entry1.iter_cmds(entry, 4):
+                    pass
+    elapsed = timeit(decode)
+    print(f'decode: {count / elapsed:10.0f} cmds/s')
+
+_startup_probe = '''
+import resource, sys, time, json
+start = time.perf_counter()
+import mainloop, dbeacon, control, registry, parse_cache
+mainloop.install(sys.argv[1])
+elapsed = time.perf_counter() - start
+print(json.dumps({'seconds': elapsed, 'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))
+'''
+
+def bench_startup():
+    '''
+    Import and main loop setup cost of each backend, each in a fresh
+    interpreter
+    '''
+    for name in ('glib', 'asyncio', 'qt'):
+        results = []
+        for _ in range(3):
+            proc = subprocess.run([sys.executable, '-c', _startup_probe, name], capture_output=True, text=True,
+                                  cwd=DIRECTORY)
+            if proc.returncode != 0:
+                break
+            results.append(json.loads(proc.stdout))
+        if not results:
+            print(f'startup {name:8s}: unavailable ({proc.stderr.strip().splitlines()[-1]})')
+            continue
+        seconds = min(result['seconds'] for result in results)
+        rss = min(result['maxrss_kb'] for result in results)
+        print(f'startup {name:8s}: {seconds * 1000:7.1f}ms, max RSS {rss / 1024:6.1f}MB')
+
+def bench_refresh(cycles=200):
+    '''
+    Advertisement update round trips against fakebluez.py: change the
+    activate beacon, then wait for the RegisterAdvertisement reply
+    '''
+    try:
+        import gatt
+    except ImportError as e:
+        print(f'refresh: unavailable ({e})')
+        return
+    import dbeacon
+    import mainloop
+
+    fake = subprocess.Popen([sys.executable, os.path.join(DIRECTORY, 'fakebluez.py'), '--droids', '0'],
+                            stdout=subprocess.PIPE, text=True)
+    try:
+        os.environ['DBUS_SYSTEM_BUS_ADDRESS'] = fake.stdout.readline().strip().split('=', 1)[1]
+        mainloop.install('glib')
+        manager = gatt.DeviceManager(adapter_name='hci0')
+        adv = dbeacon.dBeacon(manager, 0)
+        adv.add_droid_depot_bay(5, -90)
+        times = []
+        state = {'count': 0, 'start': None}
+
+        def step():
+            state['start'] = time.perf_counter()
+            addr = bytearray(state['count'].to_bytes(6, 'big'))
+            adv.add_droid_depot_activate(addr, dbeacon.DROID_DEPOT_ACTIVATE_PAIR, 0)
+            return False
+
+        def registered():
+            if state['start'] is not None:
+                times.append(time.perf_counter() - state['start'])
+            state['count'] += 1
+            if state['count'] > cycles:
+                mainloop.quit()
+            else:
+                mainloop.timeout_add(0, step)
+
+        adv.register(registered, lambda error: print('register failed', error) or mainloop.quit())
+        mainloop.run()
+        stats = json.loads(manager._bus.get_object('org.bluez', '/').Stats(dbus_interface='org.droiddepot.FakeBluez1'))
+    finally:
+        fake.terminate()
+        fake.wait()
+    times.sort()
+    print(f'refresh: {len(times)} updates, median {times[len(times) // 2] * 1000:.2f}ms, '
+          f'p99 {times[int(len(times) * 0.99)] * 1000:.2f}ms')
+    for name, call in stats['calls'].items():
+        print(f'  {name}: {call["count"]} calls, mean {call["mean_ms"]:.3f}ms, max {call["max_ms"]:.3f}ms')
+
+# Baselines are machine specific and not kept in the repository: record
+# one with suite --save on each machine before changing a codec, then rerun
+# suite to compare
+BASELINE_PATH = os.path.join(DIRECTORY, 'benchmark_baseline.json')
+# Allowed slowdown in ops/s and growth in bytes allocated per op before a
+# result is reported as a regression
+SPEED_THRESHOLD = 0.15
+ALLOC_THRESHOLD = 0.25
+
+class offline_bus:
+    '''
+    Just enough of a dbus connection to construct a dBeacon that is never
+    registered
+    '''
+    def get_object(self, *args, **kwargs):
+        return None
+
+    def _register_object_path(self, *args, **kwargs):
+        pass
+
+class offline_manager:
+    adapter_name = 'hci0'
+    _bus = offline_bus()
+
+def offline_beacon(index=0):
+    import dbeacon
+    return dbeacon.dBeacon(offline_manager(), index)
+
+def micro(op, count, repeat=9):
+    '''
+    Measure one operation
+
+    :param callable op: Performs one operation per call
+    :return: ops per second (best of repeat runs of count calls), peak
+    bytes allocated during a single call (least of several, so buffer
+    growth is not counted) and bytes still allocated per call after count
+    calls
+    :rtype: dict
+    '''
+    op()
+    def loop():
+        for _ in range(count):
+            op()
+    elapsed = timeit(loop, repeat)
+
+    tracemalloc.start()
+    try:
+        peaks = []
+        for _ in range(16):
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            op()
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+        peak = min(peaks)
+        before = tracemalloc.get_traced_memory()[0]
+        loop()
+        retained = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    return {
+        'ops_per_second': count / elapsed,
+        'alloc_bytes_per_op': peak,
+        'retained_bytes_per_op': retained / count,
+    }
+
+def alternate(fn, *args_list):
+    '''
+    Op calling fn with each argument tuple in turn, so encoders that skip
+    unchanged data always do work
+    '''
+    args_list = args_list * 2 if len(args_list) == 1 else args_list
+    state = [0]
+    def op():
+        i = state[0]
+        state[0] = (i + 1) % len(args_list)
+        fn(*args_list[i])
+    return op
+
+_cmd_args = {
+    'id': [()],
+    'led_mono': [(1, 0x80)],
+    'led_rgb': [(0, (0x10, 0x20, 0x30))],
+    'led_mono_ramp': [(1, 0xff, 500)],
+    'led_mono_flash': [(1, 0xff, 0x00, 3, 200, 100)],
+    'led_mono_pulse': [(1, 0xff, 0x00, 3, 200)],
+    'led_rgb_ramp': [(0, (0xff, 0x80, 0x40), 200)],
+    'led_rgb_flash': [(0, (0xff, 0, 0), (0, 0, 0xff), 3, 200, 100)],
+    'led_rgb_pulse': [(0, (0xff, 0, 0), (0, 0, 0xff), 3, 200)],
+    'motor': [(2, -120, 300)],
+    'nop': [(0,)],
+    'script_open': [(20,)],
+    'script_finish': [()],
+    'script_run': [(20,)],
+    'delay': [(1000,)],
+    'custom': [(0x44, 0x01, b'\x80\x00')],
+    'serial_reg_write': [(droid_cmd.SERIAL_SOUND, 3)],
+    'r2_center_head': [(0x80, 1)],
+    'r2_rotate_head1': [(-200, 100, 500)],
+    'r2_rotate_head2': [(True, 50)],
+    'bb8_rotate': [(180, 100, 500)],
+    'bb8_fwd_rev': [(-180, 100, 500)],
+    'bb8_fwd_rev_default': [(True, 100, 500)],
+}
+
+def cmd_micros():
+    buf = droid_cmd.droid_cmd_buffer()
+    ret = {}
+    for name, args in _cmd_args.items():
+        method = getattr(buf, name)
+        def op(method=method, args=args[0]):
+            method(*args)
+            if len(buf.buf) > 4096:
+                buf.pop()
+        ret[f'cmd.{name}'] = op
+    return ret
+
+def parse_entry_micros():
+    entries = [bytes.fromhex(entry) for entry in parse_entry1.entries.values()]
+    def op():
+        for entry in entries:
+            parse_entry1.parse(entry)
+    return {f'parse_entry1.parse[{len(entries)} entries]': op}
+
+_beacon_args = {
+    'add_droid': [(1, 2, True), (2, 3, False)],
+    'add_droid_extended': [(1, 2, False, False, False, 5, 0xc4), (1, 2, False, False, False, 6, 0xc3)],
+    'add_droid_location': [(2, 2, -90, 1), (3, 2, -90, 1)],
+    'add_droid_depot_bay': [(5, -90), (6, -90)],
+    'add_droid_depot_activate': [(bytes.fromhex('d5a8b5ba307a'), 1, 0), (bytes.fromhex('d5a8b5ba307b'), 2, 2)],
+    'add_showcontrol': [(1, 0, 3, b'guest001'), (0, 1, 4, b'guest002')],
+    'add_gameadvanced': [(1, -70), (2, -70)],
+    'add_arbitrary_tw': [(1, 3, 2, 0.5, 0.25, 0.75, 0.1, 0), (0, 4, 2, 0.5, 0.25, 0.75, 0.1, 1)],
+    'add_arbitrary_audio': [(1, 10), (2, 20)],
+}
+
+def dbeacon_micros():
+    import dbeacon
+    ret = {}
+    for name, args in _beacon_args.items():
+        ret[f'dBeacon.{name}'] = alternate(getattr(offline_beacon(), name), *args)
+
+    adv = offline_beacon()
+    adv.add_droid_depot_bay(5, -90)
+    adv.add_droid_depot_activate(bytes.fromhex('d5a8b5ba307a'), 1, 0)
+    def refresh():
+        adv.mfd[dbeacon.ADVDATA_LEN] ^= 1
+        adv.refresh_advdata()
+    ret['dBeacon.refresh_advdata'] = refresh
+
+    payloads = {
+        'droid': bytes.fromhex('03064481820105c4'),
+        'location': bytes.fromhex('0a04020290' + '01'),
+        'depot': bytes.fromhex('bd0205a6' + 'bc08d5a8b5ba307a0100'),
+        'full': bytes(offline_beacon_payload()),
+    }
+    for name, payload in payloads.items():
+        ret[f'dbeacon.parse.{name}'] = lambda payload=payload: dbeacon.parse(payload)
+    return ret
+
+def offline_beacon_payload():
+    adv = offline_beacon()
+    adv.add_droid_depot_bay(5, -90)
+    adv.add_droid_depot_activate(bytes.fromhex('d5a8b5ba307a'), 1, 0)
+    adv.add_droid_location(2, 2, -90, 1)
+    return adv.advdataraw
+
+def compare(name, result, baseline):
+    if baseline is None:
+        return 'new'
+    notes = []
+    speed = result['ops_per_second'] / baseline['ops_per_second'] - 1
+    if speed < -SPEED_THRESHOLD:
+        notes.append(f'REGRESSION ops/s {speed:+.0%}')
+    alloc = baseline['alloc_bytes_per_op']
+    if result['alloc_bytes_per_op'] > max(alloc * (1 + ALLOC_THRESHOLD), alloc + 64):
+        notes.append(f'REGRESSION alloc {alloc} -> {result["alloc_bytes_per_op"]}')
+    return ', '.join(notes) or f'{speed:+.0%}'
+
+def missing_baseline(path):
+    return f'No benchmark baseline at {path}, record one on this machine with: benchmark.py suite --save'
+
+def suite(save=False, baseline_path=BASELINE_PATH, pattern=None, count=20000):
+    '''
+    Run the microbenchmarks and compare them against the stored baseline
+
+    :param bool save: Store the results as the new baseline, merged into
+    any existing one
+    :return: Number of regressions
+    :rtype: int
+    '''
+    with open(os.devnull, 'w') as devnull:
+        return run_suite(devnull, save, baseline_path, pattern, count)
+
+def run_suite(devnull, save, baseline_path, pattern, count):
+    micros = {}
+    micros.update(cmd_micros())
+    micros.update(parse_entry_micros())
+    try:
+        with contextlib.redirect_stdout(devnull):
+            micros.update(dbeacon_micros())
+    except ImportError as e:
+        print(f'dbeacon benchmarks unavailable ({e})')
+
+    baselines = {}
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baselines = json.load(f)
+    elif not save:
+        raise Exception(missing_baseline(baseline_path))
+
+    results = {}
+    regressions = 0
+    for name, op in micros.items():
+        if pattern is not None and pattern not in name:
+            continue
+        # add_subtype prints each change
+        with contextlib.redirect_stdout(devnull):
+            result = micro(op, count if not name.startswith('parse_entry1') else count // 20)
+        results[name] = result
+        verdict = compare(name, result, baselines.get(name))
+        regressions += 'REGRESSION' in verdict
+        print(f'{name:40s} {result["ops_per_second"]:12.0f} ops/s {result["alloc_bytes_per_op"]:6d} B/op '
+              f'{result["retained_bytes_per_op"]:8.1f} B retained/op  {verdict}')
+
+    if save:
+        baselines.update(results)
+        with open(baseline_path, 'w') as f:
+            json.dump(baselines, f, indent=1, sort_keys=True)
+        print(f'baseline saved to {baseline_path}')
+    return regressions
+
+benchmarks = {
+    'cmd_buffer': bench_cmd_buffer,
+    'codec': bench_codec,
+    'startup': bench_startup,
+    'refresh': bench_refresh,
+    'suite': suite,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Droid depot benchmarks')
+    parser.add_argument('names', nargs='*', metavar='name', help=f'Benchmarks to run, default all: {", ".join(benchmarks)}')
+    parser.add_argument('--save', action='store_true', help='Store suite results as the baseline')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='Suite baseline file')
+    parser.add_argument('--filter', help='Only run suite benchmarks whose name contains this')
+    args = parser.parse_args()
+    unknown = [name for name in args.names if name not in benchmarks]
+    if unknown:
+        parser.error(f'unknown benchmark {", ".join(unknown)}, choose from {", ".join(benchmarks)}')
+    names = args.names or list(benchmarks)
+    if 'suite' in names and not args.save and not os.path.exists(args.baseline):
+        parser.error(missing_baseline(args.baseline))
+    regressions = 0
+    for name in names:
+        if name == 'suite':
+            regressions += suite(args.save, args.baseline, args.filter)
+        else:
+            benchmarks[name]()
+    sys.exit(1 if regressions else 0)
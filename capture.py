@@ -0,0 +1,201 @@
+#!/usr/bin/python3
+
+'''
+Advertisement capture files
+
+A capture is a magic string followed by one record per advertisement:
+
+    <d6sbHBB  timestamp, MAC, RSSI, company id, alias length, data length
+    alias     UTF-8, alias length bytes
+    data      manufacturer data, data length bytes
+
+RSSI is NO_RSSI when unknown, company id is NO_COMPANY for advertisements
+without manufacturer data. Only the Disney entry of the manufacturer data
+is kept if there is one, otherwise the first.
+'''
+
+import argparse
+import random
+import struct
+import time
+
+import dbeacon
+import discovery
+import droidstate
+
+MAGIC = b'DROIDCAP1\n'
+NO_RSSI = droidstate.NO_RSSI
+NO_COMPANY = 0xffff
+
+_record = struct.Struct('<d6sbHBB')
+
+class CaptureWriter(object):
+    def __init__(self, f, clock=time.time):
+        self.f = f
+        self.clock = clock
+        self.records = 0
+        f.write(MAGIC)
+
+    def write(self, mac, alias, rssi, mfd, timestamp=None):
+        company, data = NO_COMPANY, b''
+        if mfd:
+            company = dbeacon.MFG_ID_DISNEY if dbeacon.MFG_ID_DISNEY in mfd else next(iter(mfd))
+            data = bytes(mfd[company])[:255]
+        # Cut on a character boundary so the alias still decodes
+        alias = (alias or '').encode()[:255].decode('utf-8', 'ignore').encode()
+        self.f.write(_record.pack(self.clock() if timestamp is None else timestamp, droidstate.mac_bytes(mac),
+                                  droidstate.rssi_byte(rssi),
+                                  company, len(alias), len(data)) + alias + data)
+        self.records += 1
+
+    def close(self):
+        self.f.close()
+
+def read_capture(buf):
+    '''
+    Decode a capture
+
+    A record torn by the recording process dying ends the capture.
+
+    :param bytes buf: Capture file contents
+    :return: Generator of (timestamp, mac, alias, rssi, mfd), matching the
+    arguments of DroidDiscovery.advertisement
+    '''
+    with memoryview(buf) as mv:
+        if bytes(mv[:len(MAGIC)]) != MAGIC:
+            raise Exception('Not a droid capture')
+        offset = len(MAGIC)
+        end = len(mv)
+        while offset < end:
+            if offset + _record.size > end:
+                return
+            timestamp, mac, rssi, company, alias_len, data_len = _record.unpack_from(mv, offset)
+            offset += _record.size
+            if offset + alias_len + data_len > end:
+                return
+            alias = str(mv[offset:offset + alias_len], 'utf-8')
+            offset += alias_len
+            mfd = None if company == NO_COMPANY else {company: bytes(mv[offset:offset + data_len])}
+            offset += data_len
+            yield timestamp, droidstate.mac_str(mac), alias, droidstate.rssi_value(rssi), mfd
+
+def load(path):
+    with open(path, 'rb') as f:
+        return list(read_capture(f.read()))
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+def replay(records, sink, speed=None):
+    '''
+    Feed captured advertisements to sink(mac, alias, rssi, mfd, timestamp)
+
+    :param list records: Output of read_capture
+    :param float speed: None to replay as fast as possible, otherwise a
+    time scale, 1.0 being real time
+    :return: Events per second and handling latency statistics in ms.
+    Latency is measured from when an event was due, so in real time mode
+    it includes any delay in getting to it.
+    :rtype: dict
+    '''
+    latencies = []
+    if not records:
+        return {'events': 0}
+    first = records[0][0]
+    start = time.perf_counter()
+    for timestamp, mac, alias, rssi, mfd in records:
+        if speed is None:
+            due = time.perf_counter()
+        else:
+            due = start + (timestamp - first) / speed
+            wait = due - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+        sink(mac, alias, rssi, mfd, timestamp)
+        latencies.append(time.perf_counter() - due)
+    elapsed = time.perf_counter() - start
+    return {
+        'events': len(records),
+        'seconds': elapsed,
+        'events_per_second': len(records) / elapsed,
+        'latency_p50_ms': percentile(latencies, 0.5) * 1000,
+        'latency_p99_ms': percentile(latencies, 0.99) * 1000,
+        'latency_max_ms': max(latencies) * 1000,
+    }
+
+def droid_payload(affiliation, personalityChip, paired, bay, rssi):
+    '''
+    Disney manufacturer data of an extended 0x03 droid advertisement, as
+    built by dBeacon.add_droid_extended
+    '''
+    byte3 = 0x81 if paired else 0x01
+    byte4 = (4 << 5) | (affiliation << 2) | ((personalityChip >> 8) & 1)
+    return struct.pack('>BBBBBBBB', 0x03, 6, 0x44, byte3, byte4, personalityChip & 0xff, bay & 0xf, rssi & 0xff)
+
+def synthesize(f, droids=50, others=200, seconds=10.0, interval=0.1, seed=0):
+    '''
+    Write a synthetic crowd trace: droids advertising their 0x03 record
+    every interval seconds with the odd change of bay or paired state,
+    among other devices with unrelated manufacturer data
+    '''
+    rnd = random.Random(seed)
+    writer = CaptureWriter(f)
+    devices = []
+    for i in range(droids):
+        state = [rnd.randrange(3), rnd.randrange(1, 9), rnd.randrange(2) == 0, rnd.randrange(1, 8)]
+        devices.append((f'D0:00:00:00:{i >> 8:02X}:{i & 0xff:02X}', 'DROID', state))
+    for i in range(others):
+        devices.append((f'0E:00:00:00:{i >> 8:02X}:{i & 0xff:02X}', rnd.choice(['', 'Phone', 'Watch']), None))
+
+    events = []
+    for mac, alias, state in devices:
+        t = rnd.uniform(0, interval)
+        while t < seconds:
+            events.append((t, mac, alias, state))
+            t += interval * rnd.uniform(0.8, 1.2)
+    events.sort(key=lambda event: event[0])
+
+    for t, mac, alias, state in events:
+        rssi = rnd.randrange(-95, -40)
+        if state is None:
+            mfd = {0x004c: bytes(rnd.randrange(256) for _ in range(rnd.randrange(4, 24)))}
+        else:
+            if rnd.random() < 0.01:
+                state[2] = not state[2]
+            if rnd.random() < 0.01:
+                state[3] = rnd.randrange(1, 8)
+            affiliation, personality, paired, bay = state
+            mfd = {dbeacon.MFG_ID_DISNEY: droid_payload(affiliation, personality, paired, bay, rssi)}
+        writer.write(mac, alias, rssi, mfd, 1700000000.0 + t)
+    return writer.records
+
+def main():
+    parser = argparse.ArgumentParser(description='Synthesize and replay advertisement captures')
+    sub = parser.add_subparsers(dest='command', required=True)
+    synth = sub.add_parser('synth', help='Write a synthetic crowd trace')
+    synth.add_argument('path')
+    synth.add_argument('--droids', type=int, default=50)
+    synth.add_argument('--others', type=int, default=200)
+    synth.add_argument('--seconds', type=float, default=10.0)
+    play = sub.add_parser('replay', help='Replay a capture through the discovery path')
+    play.add_argument('path')
+    play.add_argument('--speed', type=float, default=None, help='Time scale, default as fast as possible')
+    args = parser.parse_args()
+
+    if args.command == 'synth':
+        with open(args.path, 'wb') as f:
+            records = synthesize(f, args.droids, args.others, args.seconds)
+        print(f'{records} advertisements written to {args.path}')
+    else:
+        records = load(args.path)
+        droids = discovery.DroidDiscovery(verbose=False)
+        result = replay(records, droids.advertisement, args.speed)
+        result.update(droids.stats())
+        result['registry'] = droids.registry.stats()
+        result['parse_cache'] = droids.parse_cache.stats()
+        for key, value in result.items():
+            print(f'{key}: {value:.3f}' if isinstance(value, float) else f'{key}: {value}')
+
+if __name__ == '__main__':
+    main()
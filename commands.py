@@ -0,0 +1,180 @@
+#!/usr/bin/python3
+
+import struct
+
+DROID_CUSTOM_ID = 0x44
+
+CYCLE_LED = 0x04
+CUSTOM = 0x0f
+
+class command(object):
+    '''
+    Layout of one robot command
+
+    :param str key: Identifier of the generated encoder and decoder
+    :param int id: Command id
+    :param tuple prefix: Constant leading data bytes, the Cycle LED
+    sub-command or the custom command robot identifier and sub-command
+    :param str name: Command name reported by the decoder as 'cmd'
+    :param str fields: Space separated names of the data fields
+    :param str fmt: Big endian struct format of the data fields
+    :param callable fixup: Adjusts the decoded fields dict in place
+    '''
+    __slots__ = ('key', 'id', 'prefix', 'name', 'fields', 'fmt', 'fixup', 'encode', 'decode')
+
+    def __init__(self, key, id, prefix, name, fields, fmt, fixup=None):
+        self.key = key
+        self.id = id
+        self.prefix = prefix
+        self.name = name
+        self.fields = tuple(fields.split())
+        self.fmt = fmt
+        self.fixup = fixup
+
+def motor_fixup(args):
+    args['reverse'] = (args['id'] & 0x80) != 0
+    args['id'] &= ~0x80
+
+def fixup_rotate_head1(args):
+    args['reverse'] = (args['flags'] & 0x80) != 0
+    del args['flags']
+
+def fixup_rotate_head2(args):
+    args['value'] = 255
+    args['ramp_time'] = 0
+    fixup_rotate_head1(args)
+
+def fixup_fwdrev(args):
+    args['reverse'] = (args['flags'] & 0x80) != 0
+    if args['flags'] & 0x01:
+        args['value'] = 'default'
+    del args['flags']
+
+commands = [
+    command('id', 0x01, (), 'ID', '', ''),
+    command('led_mono', 0x02, (), 'Mono LED', 'id brightness', 'BB'),
+    command('led_rgb', 0x03, (), 'RGB LED', 'id r g b', 'BBBB'),
+    command('led_mono_ramp', CYCLE_LED, (0x01,), 'LED Mono Ramp', 'id ramp_time end_value', 'BHB'),
+    command('led_mono_flash', CYCLE_LED, (0x02,), 'LED Mono Flash', 'id high_period low_period flashes high_value low_value', 'BHHBBB'),
+    command('led_mono_pulse', CYCLE_LED, (0x03,), 'LED Mono Pulse', 'id ramp_time cycles high_value low_value', 'BHBBB'),
+    command('led_rgb_ramp', CYCLE_LED, (0x04,), 'LED RGB Ramp', 'id ramp_time r g b', 'BHBBB'),
+    command('led_rgb_flash', CYCLE_LED, (0x05,), 'LED RGB Flash', 'id high_period low_period flashes sr sg sb er eg eb', 'BHHBBBBBBB'),
+    command('led_rgb_pulse', CYCLE_LED, (0x06,), 'LED RGB Pulse', 'id ramp_time cycles vr vg vb dr dg db', 'BHBBBBBBB'),
+    command('motor', 0x05, (), 'Motor', 'id value ramp_time', 'BBH', motor_fixup),
+    command('nop', 0x06, (), 'No action', '', ''),
+    command('script', 0x0c, (), 'Script', 'entry action', 'BB'),
+    command('delay', 0x0d, (), 'Delay', 'delay', 'H'),
+    command('serial_reg_write', CUSTOM, (DROID_CUSTOM_ID, 0x00), 'Serial Write', 'reg value', 'BB'),
+    command('r2_center_head', CUSTOM, (DROID_CUSTOM_ID, 0x01), 'Center R2 Head', 'value start_timer', 'BB'),
+    command('r2_rotate_head1', CUSTOM, (DROID_CUSTOM_ID, 0x02), 'Rotate R2 Head1', 'flags value ramp_time delay', 'BBHH', fixup_rotate_head1),
+    command('r2_rotate_head2', CUSTOM, (DROID_CUSTOM_ID, 0x03), 'Rotate R2 Head2', 'flags delay', 'BB', fixup_rotate_head2),
+    command('bb8_rotate', CUSTOM, (DROID_CUSTOM_ID, 0x04), 'BB8 Rotate', 'flags value ramp_time delay', 'BBHH', fixup_rotate_head1),
+    command('bb8_fwd_rev', CUSTOM, (DROID_CUSTOM_ID, 0x05), 'Drive Fwd/Rev', 'flags value ramp_time delay', 'BBHH', fixup_fwdrev),
+]
+
+_encoder_template = '''
+def encode(buf, sub_cmd, {args}):
+    buf += pack({header}, sub_cmd, {id}, {length}{prefix}, {args})
+'''
+
+_encoder_template_noargs = '''
+def encode(buf, sub_cmd):
+    buf += pack({header}, sub_cmd, {id}, {length}{prefix})
+'''
+
+_decoder_template = '''
+def decode(buf, offset, end):
+    if offset + {size} > end:
+        raise Exception('Truncated {name} command')
+    {values}, = unpack_from(buf, offset)
+    args = {{'cmd': {name!r}, {items}}}
+'''
+
+_decoder_template_noargs = '''
+def decode(buf, offset, end):
+    args = {{'cmd': {name!r}}}
+'''
+
+def generate(spec):
+    '''
+    Build the encoder and decoder functions of a command
+
+    The encoder appends the command with its 4 byte header to a bytearray:
+    encode(buf, sub_cmd, *fields). The decoder returns the fields dict of
+    a script entry command whose data, after any prefix, is
+    buf[offset:end]: decode(buf, offset, end).
+    '''
+    data_len = len(spec.prefix) + struct.calcsize('>' + spec.fmt)
+    if data_len > 0x1f:
+        raise Exception('Command data too large')
+    args = ', '.join(spec.fields)
+    prefix = ''.join(f', {value}' for value in spec.prefix)
+    namespace = {'pack': struct.Struct('>BBBB' + 'B' * len(spec.prefix) + spec.fmt).pack}
+    template = _encoder_template if spec.fields else _encoder_template_noargs
+    exec(template.format(args=args, header=(data_len + 3) | 0x20, id=spec.id, length=data_len | 0x40, prefix=prefix), namespace)
+    spec.encode = namespace['encode']
+    spec.encode.__name__ = spec.key
+
+    decoder = struct.Struct('>' + spec.fmt)
+    namespace = {'unpack_from': decoder.unpack_from, 'fixup': spec.fixup}
+    if spec.fields:
+        source = _decoder_template.format(size=decoder.size, name=spec.name, values=args,
+                                          items=', '.join(f'{field!r}: {field}' for field in spec.fields))
+    else:
+        source = _decoder_template_noargs.format(name=spec.name)
+    if spec.fixup is not None:
+        source += '    fixup(args)\n'
+    source += '    return args\n'
+    exec(source, namespace)
+    spec.decode = namespace['decode']
+    spec.decode.__name__ = 'decode_' + spec.key
+
+by_key = {}
+decoders = {}
+sub_decoders = {}
+for spec in commands:
+    generate(spec)
+    by_key[spec.key] = spec
+    if spec.prefix:
+        sub_decoders.setdefault(spec.id, {})[spec.prefix] = spec.decode
+    else:
+        decoders[spec.id] = spec.decode
+
+encoders = {spec.key: spec.encode for spec in commands}
+
+def decode(cmd, buf, offset, end):
+    '''
+    Decode one script entry command
+
+    :param int cmd: Command id
+    :param memoryview buf: Buffer holding the command data
+    :param int offset: Start of the command data
+    :param int end: End of the command data
+    :rtype: dict
+    '''
+    decoder = decoders.get(cmd)
+    if decoder is not None:
+        return decoder(buf, offset, end)
+    table = sub_decoders.get(cmd)
+    if table is None:
+        print(cmd, 'not in', list(decoders))
+        return {'cmd': cmd, 'data': bytearray(buf[offset:end])}
+    if cmd == CUSTOM:
+        if offset + 2 > end:
+            raise Exception('Truncated Custom command')
+        custom_id, sub = buf[offset], buf[offset + 1]
+        decoder = table.get((custom_id, sub))
+        if decoder is None:
+            if all(prefix[0] != custom_id for prefix in table):
+                return {'custom_id': custom_id, 'data': bytearray(buf[offset + 2:end])}
+            print(sub, 'not in', [prefix[1] for prefix in table if prefix[0] == custom_id])
+            return {'cmd': sub, 'data': bytearray(buf[offset + 2:end])}
+        return decoder(buf, offset + 2, end)
+    if offset + 1 > end:
+        raise Exception('Truncated Cycle LED command')
+    sub = buf[offset]
+    decoder = table.get((sub,))
+    if decoder is None:
+        print(sub, 'not in', [prefix[0] for prefix in table])
+        return {'cmd': sub, 'data': bytearray(buf[offset + 1:end])}
+    return decoder(buf, offset + 1, end)
@@ -0,0 +1,201 @@
+#!/usr/bin/python3
+
+import errno
+import json
+import os
+import socket
+
+import mainloop
+
+class LineBuffer(object):
+    '''
+    Split a byte or text stream into lines
+
+    Received data is appended to one buffer and complete lines are cut
+    off the front, so a chunk costs one copy regardless of its length.
+    '''
+    def __init__(self, empty=b'', maxlen=65536):
+        self.buffer = empty
+        self.newline = '\n' if isinstance(empty, str) else b'\n'
+        self.maxlen = maxlen
+
+    def feed(self, data):
+        '''
+        :return: Complete lines, without the line endings
+        :rtype: list
+        '''
+        self.buffer += data
+        *lines, self.buffer = self.buffer.split(self.newline)
+        if len(self.buffer) > self.maxlen:
+            raise Exception('Line too long')
+        return [line.rstrip() for line in lines]
+
+def parse_request(line):
+    '''
+    Parse one control line
+
+    A line is either a JSON request object, a JSON list of request objects
+    run as a batch, or a plain command word followed by its arguments:
+
+        pair 12:34:56:78:9a:bc
+        {"cmd": "activate", "bay": 5}
+        [{"cmd": "pair", "mac": "12:34:56:78:9a:bc"}, {"cmd": "stats"}]
+
+    :return: (list of requests, True if the line was a batch)
+    '''
+    if line[:1] in (b'{', b'['):
+        request = json.loads(line)
+        if isinstance(request, list):
+            return request, True
+        return [request], False
+    words = line.decode().split()
+    request = {'cmd': words[0]}
+    if len(words) > 1:
+        target = words[1]
+        if target.isdigit():
+            request['bay'] = int(target)
+        else:
+            request['mac'] = target
+    return [request], False
+
+class ControlClient(object):
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        self.lines = LineBuffer()
+        self.outgoing = bytearray()
+        self.write_watch = None
+        self.read_watch = mainloop.io_add_watch(sock.fileno(),
+            mainloop.IO_IN | mainloop.IO_HUP | mainloop.IO_ERR, self.readable)
+
+    def readable(self, fd, condition):
+        try:
+            data = self.sock.recv(65536)
+        except BlockingIOError:
+            return True
+        except OSError:
+            data = b''
+        if not data:
+            self.close()
+            return False
+        try:
+            lines = self.lines.feed(data)
+        except Exception as e:
+            self.send({'ok': False, 'error': str(e)})
+            self.close()
+            return False
+        for line in lines:
+            if line:
+                self.send(self.server.execute(line))
+        return True
+
+    def send(self, reply):
+        if self.sock is None:
+            return
+        self.outgoing += json.dumps(reply).encode() + b'\n'
+        if self.write_watch is None:
+            self.flush()
+
+    def flush(self, fd=None, condition=None):
+        try:
+            sent = self.sock.send(self.outgoing)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self.close()
+            return False
+        del self.outgoing[:sent]
+        if not self.outgoing:
+            self.write_watch = None
+            return False
+        if self.write_watch is None:
+            self.write_watch = mainloop.io_add_watch(self.sock.fileno(), mainloop.IO_OUT, self.flush)
+        return True
+
+    def close(self):
+        if self.sock is None:
+            return
+        for watch in (self.read_watch, self.write_watch):
+            if watch is not None:
+                mainloop.source_remove(watch)
+        self.read_watch = self.write_watch = None
+        self.sock.close()
+        self.sock = None
+        self.server.clients.discard(self)
+
+class ControlServer(object):
+    '''
+    Unix domain socket control interface on the main loop
+
+    Each client sends newline terminated requests (see parse_request) and
+    gets one JSON reply line per request line, in order. Batches reply with
+    a list. Handlers are called as handler(**request) without the 'cmd'
+    key and return a dict that is merged into the reply; exceptions become
+    {'ok': false, 'error': ...} replies.
+
+    :param str path: Socket path, replaced if it already exists
+    :param dict handlers: Command name -> callable
+    '''
+    def __init__(self, path, handlers):
+        self.path = path
+        self.handlers = handlers
+        self.clients = set()
+        self.requests = 0
+        self.errors = 0
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.setblocking(False)
+        self.sock.bind(path)
+        self.sock.listen(16)
+        self.watch = mainloop.io_add_watch(self.sock.fileno(), mainloop.IO_IN, self.accept)
+
+    def accept(self, fd, condition):
+        while True:
+            try:
+                sock, _ = self.sock.accept()
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    print('Control socket accept failed: ' + str(e))
+                return True
+            sock.setblocking(False)
+            self.clients.add(ControlClient(self, sock))
+
+    def call(self, request):
+        self.requests += 1
+        try:
+            request = dict(request)
+            name = request.pop('cmd')
+            handler = self.handlers.get(name)
+            if handler is None:
+                raise Exception(f'Unknown command {name}')
+            reply = {'ok': True}
+            reply.update(handler(**request) or {})
+            return reply
+        except Exception as e:
+            self.errors += 1
+            return {'ok': False, 'error': str(e)}
+
+    def execute(self, line):
+        try:
+            requests, batch = parse_request(line)
+        except Exception as e:
+            self.errors += 1
+            return {'ok': False, 'error': f'Bad request: {e}'}
+        replies = [self.call(request) for request in requests]
+        return replies if batch else replies[0]
+
+    def stats(self):
+        return {'clients': len(self.clients), 'requests': self.requests, 'errors': self.errors}
+
+    def close(self):
+        for client in list(self.clients):
+            client.close()
+        mainloop.source_remove(self.watch)
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
@@ -4,6 +4,10 @@ import beacon
 import struct
 import uuid
 import collections
+import collections.abc
+import contextlib
+import mainloop
+import metrics
 
 INTERACTION_ID_DLR = 0x0002
 INTERACTION_ID_WDW = 0x0003
@@ -57,92 +61,418 @@ personality = [
 DROID_DEPOT_ACTIVATE_PAIR = 1
 DROID_DEPOT_ACTIVATE_GO = 2
 
+ADVDATA_LEN = 22
+
+_sub_hdr = struct.Struct('>BB')
+_droid = struct.Struct('>BBBB')
+_droid_extended_norssi = struct.Struct('>BBBBB')
+_droid_extended = struct.Struct('>BBBBBB')
+_location = struct.Struct('<BBbB')
+_depot_bay = struct.Struct('<Bb')
+_depot_activate = struct.Struct('<6sBB')
+_showcontrol = struct.Struct('>HB8s')
+_gameadvanced = struct.Struct('>HBb')
+_interaction = struct.Struct('>H')
+
+class SubRecord(collections.abc.Mapping):
+    '''
+    Decoded manufacturer data sub-record
+
+    Decoded fields are stored in slots. The record is also a read-only
+    mapping with the same keys as the dicts previously returned by parse,
+    so record['bay'] and record.bay are equivalent. sub_data is only
+    sliced out of the source buffer when it is asked for.
+    '''
+    __slots__ = ('sub_id', 'sub_len', '_mfd', '_offset')
+    fields = ()
+    _keys = ('sub_id', 'sub_len', 'sub_data')
+
+    def __init__(self, sub_id, sub_len, mfd, mv, offset):
+        self.sub_id = sub_id
+        self.sub_len = sub_len
+        self._mfd = mfd
+        self._offset = offset
+        self.decode(mv, offset, sub_len)
+
+    def decode(self, mv, offset, length):
+        pass
+
+    @property
+    def sub_data(self):
+        return bytes(self._mfd[self._offset:self._offset + self.sub_len])
+
+    def __getitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._keys = ('sub_id', 'sub_len', 'sub_data') + cls.fields
+
+    def as_dict(self):
+        return {key: getattr(self, key) for key in self._keys}
+
+    def __repr__(self):
+        return repr(self.as_dict())
+
+class DroidRecord(SubRecord):
+    '''
+    0x03 droid advertisement, see dBeacon.add_droid and add_droid_extended
+    '''
+    fields = ('droid_id', 'rssi', 'bay', 'action78', 'battery_low', 'personalityChip', 'affiliation', 'paired')
+    __slots__ = fields
+    sub_data = None
+
+    def decode(self, mv, offset, length):
+        if length >= 6:
+            self.droid_id, byte3, byte4, byte5, byte6, rssi = _droid_extended.unpack_from(mv, offset)
+            self.rssi = rssi - 256
+        elif length >= 4:
+            self.rssi = None
+            if length == 5:
+                self.droid_id, byte3, byte4, byte5, byte6 = _droid_extended_norssi.unpack_from(mv, offset)
+            else:
+                self.droid_id, byte3, byte4, byte5 = _droid.unpack_from(mv, offset)
+                byte6 = None
+        else:
+            self.droid_id = self.personalityChip = self.affiliation = self.paired = None
+            self.bay = self.action78 = self.battery_low = self.rssi = None
+            return
+        self.personalityChip = byte5 | ((byte4 & 1) << 8)
+        self.affiliation = (byte4 >> 2) & 0x7
+        self.paired = (byte3 & 0x80) != 0
+        if byte6 is None:
+            self.bay = self.action78 = self.battery_low = None
+        else:
+            self.bay = byte6 & 0xf
+            self.action78 = (byte6 & 0x10) != 0
+            self.battery_low = (byte6 & 0x80) != 0
+
+class LocationRecord(SubRecord):
+    '''
+    0x0a droid location beacon, see dBeacon.add_droid_location
+    '''
+    fields = ('location', 'minInterval', 'expectedRssi', 'accept')
+    __slots__ = fields
+
+    def decode(self, mv, offset, length):
+        if length >= _location.size:
+            self.location, self.minInterval, self.expectedRssi, self.accept = _location.unpack_from(mv, offset)
+        else:
+            self.location = self.minInterval = self.expectedRssi = self.accept = None
+
+class DepotActivateRecord(SubRecord):
+    '''
+    0xbc droid depot activator beacon, see dBeacon.add_droid_depot_activate
+    '''
+    fields = ('gapAddr', 'action', 'delay')
+    __slots__ = fields
+
+    def decode(self, mv, offset, length):
+        if length >= _depot_activate.size:
+            self.gapAddr, self.action, self.delay = _depot_activate.unpack_from(mv, offset)
+        else:
+            self.gapAddr = self.action = self.delay = None
+
+class DepotBayRecord(SubRecord):
+    '''
+    0xbd droid depot bay beacon, see dBeacon.add_droid_depot_bay
+    '''
+    fields = ('bay', 'expectedRssi')
+    __slots__ = fields
+
+    def decode(self, mv, offset, length):
+        if length >= _depot_bay.size:
+            self.bay, self.expectedRssi = _depot_bay.unpack_from(mv, offset)
+        else:
+            self.bay = self.expectedRssi = None
+
+class ShowControlRecord(SubRecord):
+    '''
+    0x05 show control beacon, see dBeacon.add_showcontrol
+    '''
+    fields = ('interactionId', 'down', 'inUse', 'status', 'guestId')
+    __slots__ = fields
+
+    def decode(self, mv, offset, length):
+        if length >= _showcontrol.size:
+            self.interactionId, byte0, self.guestId = _showcontrol.unpack_from(mv, offset)
+            self.down = (byte0 & 0x80) != 0
+            self.inUse = (byte0 & 0x40) != 0
+            self.status = (byte0 >> 2) & 0xf
+        else:
+            self.interactionId = self.down = self.inUse = self.status = self.guestId = None
+
+class ArbitraryRecord(SubRecord):
+    '''
+    0x06 arbitrary data beacon, see dBeacon.add_arbitrary
+    '''
+    fields = ('interactionId', 'arbdata')
+    __slots__ = ('interactionId',)
+
+    def decode(self, mv, offset, length):
+        if length >= _interaction.size:
+            self.interactionId, = _interaction.unpack_from(mv, offset)
+        else:
+            self.interactionId = None
+
+    @property
+    def arbdata(self):
+        if self.interactionId is None:
+            return None
+        start = self._offset + _interaction.size
+        return bytes(self._mfd[start:self._offset + self.sub_len])
+
+class GameAdvancedRecord(SubRecord):
+    '''
+    0x10 advanced game beacon, see dBeacon.add_gameadvanced
+    '''
+    fields = ('interactionId', 'waypointId', 'expectedRssi')
+    __slots__ = fields
+
+    def decode(self, mv, offset, length):
+        if length >= _gameadvanced.size:
+            self.interactionId, self.waypointId, self.expectedRssi = _gameadvanced.unpack_from(mv, offset)
+        else:
+            self.interactionId = self.waypointId = self.expectedRssi = None
+
+subrecords = {
+    0x03: DroidRecord,
+    0x05: ShowControlRecord,
+    0x06: ArbitraryRecord,
+    0x0a: LocationRecord,
+    0x10: GameAdvancedRecord,
+    0xbc: DepotActivateRecord,
+    0xbd: DepotBayRecord,
+}
+
 def parse(mfd):
+    '''
+    Decode Disney manufacturer data
+
+    Sub-records are decoded in place from a memoryview of mfd. Records
+    keep a reference to mfd for lazily producing sub_data, so pass an
+    immutable bytes object.
+
+    :param bytes mfd: Manufacturer data for MFG_ID_DISNEY
+    :return: Decoded sub-records keyed by sub-record id
+    :rtype: dict
+    '''
     ret = {}
-    while len(mfd) > 1:
-        hdr, mfd = mfd[:2], mfd[2:]
-        id, length = struct.unpack('>BB', hdr)
-        if length > len(mfd):
-            break
-        subdata, mfd = mfd[:length], mfd[length:]
-        args = {'sub_id': id, 'sub_len': length, 'sub_data': None}
-        if id == 0x03:
-            for key in ['droid_id', 'rssi', 'bay', 'action78', 'battery_low', 'personalityChip', 'affiliation', 'paired']:
-                args[key] = None
-            if length >= 4:
-                args['droid_id'], byte3, byte4, byte5 = struct.unpack('>BBBB', subdata[:4])
-                args['personalityChip'] = byte5 | ((byte4 & 1) << 8)
-                args['affiliation'] = (byte4 >> 2) & 0x7
-                args['paired'] = (byte3 & 0x80) != 0
-            if length >= 5:
-                byte6, = struct.unpack('>B', subdata[4:5])
-                args['bay'] = byte6 & 0xf
-                args['action78'] = (byte6 & 0x10) != 0
-                args['battery_low'] = (byte6 & 0x80) != 0
-            if length >= 6:
-                args['rssi'], = struct.unpack('>B', subdata[5:6])
-                args['rssi'] = args['rssi'] - 256
-        else:
-            args['sub_data'] = subdata
-        ret[id] = args
+    with memoryview(mfd) as mv:
+        end = len(mv)
+        offset = 0
+        while end - offset > 1:
+            id, length = _sub_hdr.unpack_from(mv, offset)
+            offset += 2
+            if length > end - offset:
+                break
+            ret[id] = subrecords.get(id, SubRecord)(id, length, mfd, mv, offset)
+            offset += length
     return ret
 
 class dBeacon(beacon.Advertisement):
-    def __init__(self, manager, index):
+    def __init__(self, manager, index, debounce=0):
         beacon.Advertisement.__init__(self, manager, index, 'peripheral')
         self.interactionId = INTERACTION_ID_DLR
         self.has_interactionId = set()
         self.add_discoverable(True)
         self.add_discoverable_to(1000)
         self.include_tx_power = True
-        self.advdata = collections.OrderedDict()
-        self.advdataraw = b''
+        # Subtype entries are laid out back to back in mfd[:22] followed by
+        # the power byte. layout maps subtype -> (offset, length) of each
+        # entry including its 2 byte header.
+        self.mfd = bytearray(ADVDATA_LEN + 1)
+        self.layout = collections.OrderedDict()
+        self.used = 0
+        self.published = None
         self.power = -59
+        self.mfd[ADVDATA_LEN] = (256 + self.power) & 0xff
+        self.debounce = debounce
+        self.debounce_source = None
+        self.batch_depth = 0
+        self.refresh_pending = False
+        self.refreshes_avoided = 0
+        # Address of a droid whose activation has not been published yet,
+        # and of the one in the registration awaiting its reply
+        self.activation_pending = None
+        self.activation_published = None
+
+    @property
+    def advdata(self):
+        return collections.OrderedDict((subtype, bytes(self.mfd[offset:offset + length]))
+                                       for subtype, (offset, length) in self.layout.items())
+
+    @property
+    def advdataraw(self):
+        return bytes(self.mfd[:self.used])
 
     def set_power(self, power):
         if power != self.power:
             self.power = power
-            self.refresh_advadata()
+            self.mfd[ADVDATA_LEN] = (256 + power) & 0xff
+            self.refresh_advdata()
 
     def set_interactionId(self, interactionId):
         if interactionId != self.interactionId:
             self.interactionId = interactionId
             dirty = False
-            for key, value in self.advdata.items():
-                if key in self.has_interactionId:
-                    value = value[0] + struct.pack('>H', interactionId) + value[3:]
-                    self.advdata[key] = value
+            for subtype in self.has_interactionId:
+                if subtype in self.layout:
+                    offset, length = self.layout[subtype]
+                    _interaction.pack_into(self.mfd, offset + 2, interactionId)
                     dirty = True
             if dirty:
                 self.refresh_advdata()
 
+    @contextlib.contextmanager
+    def batch(self):
+        '''
+        Merge advertisement updates
+
+        Subtype, power and interaction ID changes made inside the with block
+        are applied with a single advertisement re-registration on exit.
+        Batches may be nested.
+        '''
+        self.batch_depth += 1
+        try:
+            yield self
+        finally:
+            self.batch_depth -= 1
+            if self.batch_depth == 0 and self.refresh_pending:
+                self.flush_advdata()
+
     def refresh_advdata(self):
-        self.advdataraw = b''
-        for data in self.advdata.values():
-            self.advdataraw += data
-        power = (256 + self.power) & 0xff
-        self.add_manufacturer_data(MFG_ID_DISNEY, struct.pack('<22sB', self.advdataraw, power))
+        '''
+        Request that the advertisement be updated with the current advdata
+
+        The update is deferred while a batch is open or, if a debounce
+        window in ms was given, until the window after the first change has
+        passed. Requests merged into an already pending update are counted
+        in refreshes_avoided.
+        '''
+        if self.refresh_pending:
+            self.refreshes_avoided += 1
+            return
+        if self.batch_depth:
+            self.refresh_pending = True
+        elif self.debounce:
+            self.refresh_pending = True
+            self.start_debounce()
+        else:
+            self.flush_advdata()
+
+    def start_debounce(self):
+        self.debounce_source = mainloop.timeout_add(self.debounce, self.debounce_expired)
+
+    def cancel_debounce(self):
+        mainloop.source_remove(self.debounce_source)
+        self.debounce_source = None
+
+    def debounce_expired(self):
+        self.debounce_source = None
+        if self.batch_depth == 0:
+            self.flush_advdata()
+        return False
+
+    def flush_advdata(self):
+        '''
+        Apply pending changes to the advertisement immediately
+        '''
+        if self.debounce_source is not None:
+            self.cancel_debounce()
+        self.refresh_pending = False
+        if self.mfd == self.published:
+            self.refreshes_avoided += 1
+            return
+        self.published = bytes(self.mfd)
+        self.add_manufacturer_data(MFG_ID_DISNEY, self.published)
         self.refresh()
 
+    def register_sent(self):
+        super().register_sent()
+        # A refresh without a new activation keeps waiting for the reply
+        # to the one already published
+        if self.activation_pending is not None:
+            self.activation_published = self.activation_pending
+            self.activation_pending = None
+            metrics.mark(self.activation_published, 'published', self.register_started)
+
+    def registered(self):
+        if self.activation_published is not None:
+            metrics.mark(self.activation_published, 'registered')
+            self.activation_published = None
+        super().registered()
+
+    def register(self, *args, **kwargs):
+        if self.refresh_pending:
+            self.flush_advdata()
+        beacon.Advertisement.register(self, *args, **kwargs)
+
+    def load(self, other):
+        '''
+        Replace this advertisement's payload with another dBeacon's
+
+        :param dBeacon other: Source of subtypes, interaction ID and power
+        '''
+        self.mfd[:] = other.mfd
+        self.layout = collections.OrderedDict(other.layout)
+        self.used = other.used
+        self.has_interactionId = set(other.has_interactionId)
+        self.interactionId = other.interactionId
+        self.power = other.power
+        self.refresh_advdata()
+
+    def resize_entry(self, offset, old_length, new_length):
+        '''
+        Grow or shrink the entry at offset, moving the entries after it
+        '''
+        delta = new_length - old_length
+        end = self.used
+        self.mfd[offset + new_length:end + delta] = self.mfd[offset + old_length:end]
+        if delta < 0:
+            self.mfd[end + delta:end] = bytes(-delta)
+        for subtype, (entry_offset, length) in self.layout.items():
+            if entry_offset > offset:
+                self.layout[subtype] = (entry_offset + delta, length)
+        self.used += delta
+
     def add_subtype(self, subtype, subdata):
         print(f'{subtype}={subdata}')
-        data = struct.pack('<BB', subtype, len(subdata)) + subdata
-        length = len(data) + len(self.advdataraw)
-        if subtype in self.advdata:
-            length -= len(self.advdata[subtype])
-        if length > 22:
+        length = len(subdata) + 2
+        if subtype in self.layout:
+            offset, old_length = self.layout[subtype]
+            if old_length == length and self.mfd[offset + 2:offset + length] == subdata:
+                return
+        else:
+            offset, old_length = self.used, 0
+        if self.used - old_length + length > ADVDATA_LEN:
             raise Exception('Data too large')
-        self.advdata[subtype] = data
+        if old_length != length:
+            self.resize_entry(offset, old_length, length)
+            self.layout[subtype] = (offset, length)
+        _sub_hdr.pack_into(self.mfd, offset, subtype, len(subdata))
+        self.mfd[offset + 2:offset + length] = subdata
         self.refresh_advdata()
 
     def remove_subtype(self, subtype):
-        if subtype in self.advdata:
-            del self.advdata[subtype]
+        if subtype in self.layout:
+            offset, length = self.layout.pop(subtype)
+            self.resize_entry(offset, length, 0)
             self.refresh_advdata()
 
     def remove_all(self):
-        if self.advdata:
-            self.advdata = collections.OrderedDict()
+        if self.layout:
+            self.layout.clear()
+            self.mfd[:self.used] = bytes(self.used)
+            self.used = 0
             self.refresh_advdata()
 
     def add_droid(self, affiliation, personalityChip, paired=True):
@@ -237,11 +567,24 @@ class dBeacon(beacon.Advertisement):
         :param int action: Activation action type, 1 or 2.
         :param int delay: default delay / 100 for interaction script delay command.
         '''
+        self.activation_pending = metrics.mac_key(gapAddr)
+        metrics.mark(self.activation_pending, 'activate')
         return self.add_subtype(0xbc, struct.pack('<6sBB', gapAddr, action, delay))
 
     def remove_droid_depot_activate(self):
+        self.activation_pending = None
         self.remove_subtype(0xbc)
 
+    def depot_activate_target(self):
+        '''
+        :return: Address of the droid the activator beacon is up for, upper
+        case with colons, or None
+        '''
+        if 0xbc not in self.layout:
+            return None
+        offset, length = self.layout[0xbc]
+        return metrics.mac_key(self.mfd[offset + 2:offset + 8])
+
     def add_showcontrol(self, down, inUse, status, guestId):
         byte0 = (down << 7) | (inUse << 6) | ((status & 0xf) << 2)
         self.has_interactionId.add(0x05)
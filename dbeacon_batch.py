@@ -0,0 +1,157 @@
+#!/usr/bin/python3
+
+import numpy as np
+import struct
+import random
+import time
+
+import dbeacon
+
+droid_fields = ('droid_id', 'paired', 'affiliation', 'personalityChip', 'bay', 'battery_low', 'action78', 'rssi')
+
+def pack(payloads, width=None):
+    '''
+    Pack manufacturer data payloads into a fixed width matrix
+
+    :param list payloads: bytes objects, one per advertisement
+    :param int width: Matrix width, defaults to the longest payload
+    :return: (uint8 matrix, payload lengths)
+    :rtype: tuple
+    '''
+    if width is None:
+        width = max((len(p) for p in payloads), default=0)
+    lengths = np.fromiter((min(len(p), width) for p in payloads), dtype=np.intp, count=len(payloads))
+    flat = b''.join(p[:width].ljust(width, b'\0') for p in payloads)
+    matrix = np.frombuffer(flat, dtype=np.uint8).reshape(len(payloads), width)
+    return matrix, lengths
+
+def parse_droid(matrix, lengths=None):
+    '''
+    Decode the 0x03 droid sub-record of many payloads at once
+
+    Equivalent to calling dbeacon.parse on each row and looking at the 0x03
+    record, but the sub-record walk and bit decoding are done column-wise.
+    Fields that dbeacon.parse would report as None, or rows without a 0x03
+    record, are masked.
+
+    :param ndarray matrix: uint8 matrix, one payload per row
+    :param ndarray lengths: Valid length of each row, defaults to the full width
+    :return: 'present' bool column plus a masked array per droid field
+    :rtype: dict
+    '''
+    matrix = np.asarray(matrix, dtype=np.uint8)
+    n, width = matrix.shape
+    if lengths is None:
+        lengths = np.full(n, width, dtype=np.intp)
+    else:
+        lengths = np.minimum(np.asarray(lengths, dtype=np.intp), width)
+
+    # Padding lets the gathers below read a full record past any offset
+    # without bounds checks; padded bytes are never part of a valid record.
+    padded = np.zeros((n, width + 8), dtype=np.uint8)
+    padded[:, :width] = matrix
+
+    rows = np.arange(n)
+    pos = np.zeros(n, dtype=np.intp)
+    rec_off = np.zeros(n, dtype=np.intp)
+    rec_len = np.full(n, -1, dtype=np.intp)
+    active = lengths > 1
+    while active.any():
+        r = rows[active]
+        p = pos[r]
+        sub_id = padded[r, p]
+        length = padded[r, p + 1].astype(np.intp)
+        remaining = lengths[r] - p - 2
+        fits = length <= remaining
+        hit = fits & (sub_id == 0x03)
+        rec_off[r[hit]] = p[hit] + 2
+        rec_len[r[hit]] = length[hit]
+        p = p + 2 + length
+        pos[r] = p
+        active[r] = fits & (lengths[r] - p > 1)
+
+    b = [padded[rows, rec_off + i] for i in range(6)]
+    has_droid = rec_len >= 4
+    has_ext = rec_len >= 5
+    has_rssi = rec_len >= 6
+
+    def column(data, valid):
+        return np.ma.array(data, mask=~valid)
+
+    return {
+        'present': rec_len >= 0,
+        'droid_id': column(b[0], has_droid),
+        'paired': column((b[1] & 0x80) != 0, has_droid),
+        'affiliation': column((b[2] >> 2) & 0x7, has_droid),
+        'personalityChip': column(b[3].astype(np.uint16) | ((b[2].astype(np.uint16) & 1) << 8), has_droid),
+        'bay': column(b[4] & 0xf, has_ext),
+        'battery_low': column((b[4] & 0x80) != 0, has_ext),
+        'action78': column((b[4] & 0x10) != 0, has_ext),
+        'rssi': column(b[5].astype(np.int16) - 256, has_rssi),
+    }
+
+def to_records(columns):
+    '''
+    Convert parse_droid columns back into per-row dicts
+
+    Rows without a 0x03 record are None, masked fields are None.
+    '''
+    ret = []
+    for i, present in enumerate(columns['present']):
+        if not present:
+            ret.append(None)
+            continue
+        row = {}
+        for key in droid_fields:
+            value = columns[key][i]
+            row[key] = None if value is np.ma.masked else value.item()
+        ret.append(row)
+    return ret
+
+def random_payloads(count, seed=0):
+    '''
+    Generate plausible MFG_ID_DISNEY payloads for testing and benchmarks
+    '''
+    rnd = random.Random(seed)
+    payloads = []
+    for _ in range(count):
+        data = b''
+        if rnd.random() < 0.3:
+            data += struct.pack('<BBBb', 0xbd, 2, rnd.randrange(16), -90)
+        length = rnd.choice((4, 4, 6, 6, 6, 5, 2))
+        body = bytes(rnd.randrange(256) for _ in range(length))
+        data += struct.pack('<BB', 0x03, length) + body
+        if rnd.random() < 0.2:
+            data += struct.pack('<BB', 0x0a, 4) + bytes(4)
+        if rnd.random() < 0.05:
+            data = data[:rnd.randrange(len(data) + 1)]
+        payloads.append(data)
+    return payloads
+
+def benchmark(count=200000):
+    payloads = random_payloads(count)
+
+    start = time.perf_counter()
+    scalar = []
+    for payload in payloads:
+        record = dbeacon.parse(payload).get(0x03)
+        scalar.append(None if record is None else {key: record[key] for key in droid_fields})
+    scalar_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    matrix, lengths = pack(payloads, 22)
+    pack_time = time.perf_counter() - start
+    start = time.perf_counter()
+    columns = parse_droid(matrix, lengths)
+    batch_time = time.perf_counter() - start
+
+    if to_records(columns) != scalar:
+        raise Exception('Batch decode does not match dbeacon.parse')
+
+    print(f'{count} payloads')
+    print(f'dbeacon.parse:        {scalar_time:8.3f}s {count / scalar_time:12.0f}/s')
+    print(f'parse_droid:          {batch_time:8.3f}s {count / batch_time:12.0f}/s')
+    print(f'parse_droid + pack:   {batch_time + pack_time:8.3f}s {count / (batch_time + pack_time):12.0f}/s')
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+
+import collections
+import datetime
+
+import dbeacon
+import metrics
+import parse_cache
+import registry
+
+class DroidDiscovery(object):
+    '''
+    Advertisement handling of the bay, independent of BlueZ
+
+    Fed one advertisement at a time by AnyDeviceManager, or by
+    capture.replay. Droid advertisements update the registry.
+
+    :param recorder: Optional capture.CaptureWriter that every
+    advertisement is written to
+    :param bool verbose: Print droids whose advertisement changed
+
+    Callables in listeners are called with the registry entry after each
+    droid advertisement.
+    '''
+    def __init__(self, droid_registry=None, cache=None, recorder=None, verbose=True):
+        self.registry = droid_registry if droid_registry is not None else registry.DroidRegistry()
+        self.registry.evicted.append(self.evicted)
+        self.parse_cache = cache if cache is not None else parse_cache.ParseCache()
+        self.recorder = recorder
+        self.verbose = verbose
+        self.listeners = []
+        self.advertisements = 0
+        self.droids = 0
+        self.adapters = collections.Counter()
+
+    def advertisement(self, mac_address, alias, rssi, mfd, timestamp=None, adapter=None):
+        '''
+        :param str mac_address: Device address
+        :param str alias: Device alias, None if unknown
+        :param int rssi: Received signal strength, None if unknown
+        :param dict mfd: Company id -> manufacturer data
+        :param str adapter: Name of the adapter that received it, when
+        discovery runs on several
+        :return: The updated registry entry for droid advertisements
+        :rtype: registry.DroidEntry
+        '''
+        self.advertisements += 1
+        if adapter is not None:
+            self.adapters[adapter] += 1
+        start = metrics.clock()
+        entry = self.handle(mac_address, alias, rssi, mfd, timestamp, adapter)
+        metrics.advertisement_handling.observe(metrics.clock() - start)
+        return entry
+
+    def handle(self, mac_address, alias, rssi, mfd, timestamp, adapter=None):
+        if self.recorder is not None:
+            self.recorder.write(mac_address, alias, rssi, mfd, timestamp)
+
+        if alias != 'DROID' or mfd is None or dbeacon.MFG_ID_DISNEY not in mfd:
+            return None
+
+        dbeacons, changed = self.parse_cache.lookup(mac_address, bytes(mfd[dbeacon.MFG_ID_DISNEY]))
+        if 0x03 not in dbeacons or dbeacons[0x03]['droid_id'] != 0x44:
+            return None
+
+        self.droids += 1
+        if changed and self.verbose:
+            now = datetime.datetime.now()
+            print(f'[{now:%H:%M:%S}] Discovered [{mac_address}] {alias}', dbeacons[3])
+        return self.droid(mac_address, dbeacons[0x03], rssi, adapter)
+
+    def droid(self, mac_address, record, rssi, adapter=None):
+        '''
+        Update the registry with a decoded droid record and notify the
+        listeners. Also used for records decoded by a worker process.
+
+        :param DroidRecord record: 0x03 droid record
+        :rtype: registry.DroidEntry
+        '''
+        entry = self.registry.update(mac_address, record, rssi, adapter=adapter)
+        if entry.first_seen == entry.last_seen:
+            metrics.mark(entry.mac, 'discovered')
+        for listener in self.listeners:
+            listener(entry)
+        return entry
+
+    def evicted(self, entry):
+        metrics.forget(entry.mac)
+
+    def stats(self):
+        ret = {'advertisements': self.advertisements, 'droids': self.droids}
+        if self.adapters:
+            ret['adapters'] = dict(self.adapters)
+        return ret
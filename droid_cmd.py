@@ -1,7 +1,7 @@
+import commands
 import robot_cmd
-import struct
 
-custom_id = 0x44
+custom_id = commands.DROID_CUSTOM_ID
 
 SERIAL_VOLUME = 0x0e
 SERIAL_SOUND = 0x10
@@ -9,6 +9,13 @@ SERIAL_SOUND_FLASH = 0x11
 SERIAL_LED_ON = 0x48
 SERIAL_LED_OFF = 0x49
 
+_serial_reg_write = commands.encoders['serial_reg_write']
+_r2_center_head = commands.encoders['r2_center_head']
+_r2_rotate_head1 = commands.encoders['r2_rotate_head1']
+_r2_rotate_head2 = commands.encoders['r2_rotate_head2']
+_bb8_rotate = commands.encoders['bb8_rotate']
+_bb8_fwd_rev = commands.encoders['bb8_fwd_rev']
+
 class droid_cmd_buffer(robot_cmd.robot_cmd_buffer):
     def serial_reg_write(self, reg, value):
         '''
@@ -20,7 +27,7 @@ class droid_cmd_buffer(robot_cmd.robot_cmd_buffer):
         :param int reg: Write register 0-255
         :param int value: Write value 0-255
         '''
-        self.custom(custom_id, 0x00, struct.pack('>BB', reg, value))
+        _serial_reg_write(self.buf, self.sub_cmd, reg, value)
 
     def r2_center_head(self, value, start_timer):
         '''
@@ -30,7 +37,7 @@ class droid_cmd_buffer(robot_cmd.robot_cmd_buffer):
         :param bool start_timer: Insert a 3s delay before executing the
         next script command. Has no effect outside of command scripts.
         '''
-        self.custom(custom_id, 0x01, struct.pack('>BB', value, start_timer))
+        _r2_center_head(self.buf, self.sub_cmd, value, start_timer)
 
     def r2_rotate_head1(self, value, ramp_time, delay):
         '''
@@ -45,7 +52,7 @@ class droid_cmd_buffer(robot_cmd.robot_cmd_buffer):
             value = -value
         else:
             flags = 0x00
-        self.custom(custom_id, 0x02, struct.pack('>BBHH', flags, value, ramp_time, delay))
+        _r2_rotate_head1(self.buf, self.sub_cmd, flags, value, ramp_time, delay)
 
     def r2_rotate_head2(self, forward, delay):
         '''
@@ -57,7 +64,7 @@ class droid_cmd_buffer(robot_cmd.robot_cmd_buffer):
         :param int delay: Delay before executing next command script instruction. 0-65535
         '''
         flags = 0x00 if forward else 0x80
-        self.custom(custom_id, 0x03, struct.pack('>BB', flags, delay))
+        _r2_rotate_head2(self.buf, self.sub_cmd, flags, delay)
 
     def bb8_rotate(self, value, ramp_time, delay):
         '''
@@ -72,7 +79,7 @@ class droid_cmd_buffer(robot_cmd.robot_cmd_buffer):
             value = -value
         else:
             flags = 0x00
-        self.custom(custom_id, 0x04, struct.pack('>BBHH', flags, value, ramp_time, delay))
+        _bb8_rotate(self.buf, self.sub_cmd, flags, value, ramp_time, delay)
 
     def bb8_fwd_rev(self, value, ramp_time, delay):
         '''
@@ -83,11 +90,11 @@ class droid_cmd_buffer(robot_cmd.robot_cmd_buffer):
         :param int delay: Delay before executing next command script instruction. 0-65535
         '''
         if value < 0:
-            flags |= 0x80
+            flags = 0x80
             value = -value
         else:
             flags = 0x00
-        self.custom(custom_id, 0x05, struct.pack('>BBHH', flags, value, ramp_time, delay))
+        _bb8_fwd_rev(self.buf, self.sub_cmd, flags, value, ramp_time, delay)
 
     def bb8_fwd_rev_default(self, forward, ramp_time, delay):
         '''
@@ -100,5 +107,5 @@ class droid_cmd_buffer(robot_cmd.robot_cmd_buffer):
         :param int delay: Delay before executing next command script instruction. 0-65535
         '''
         flags = 0x01 if forward else 0x81
-        self.custom(custom_id, 0x05, struct.pack('>BBHH', flags, 0x00, ramp_time, delay))
+        _bb8_fwd_rev(self.buf, self.sub_cmd, flags, 0x00, ramp_time, delay)
 
@@ -0,0 +1,98 @@
+#!/usr/bin/python3
+
+'''
+Compact encoding of droid addresses and decoded 0x03 droid records, shared
+by the fixed layout tables and logs (droidtable, obslog, capture)
+
+A record packs into the struct fields <BBBBBH:
+
+    droid_id, record RSSI byte, bay, flags, affiliation, personalityChip
+
+The record RSSI is stored as the raw advertised byte; dbeacon.DroidRecord
+decodes it as byte - 256. Advertisement RSSIs reported by BlueZ are
+packed as b, NO_RSSI meaning unknown.
+'''
+
+NO_RSSI = -128
+NO_BAY = 0xff
+
+PAIRED = 0x01
+ACTION78 = 0x02
+BATTERY_LOW = 0x04
+EXTENDED = 0x08
+HAS_RSSI = 0x10
+
+RECORD_FORMAT = 'BBBBBH'
+
+def mac_bytes(mac):
+    return bytes.fromhex(mac.replace(':', ''))
+
+def mac_str(raw):
+    return ':'.join(f'{b:02X}' for b in raw)
+
+def rssi_byte(rssi):
+    '''
+    Advertisement RSSI for a b field, clamped to its range
+    '''
+    return NO_RSSI if rssi is None else max(NO_RSSI + 1, min(127, int(rssi)))
+
+def rssi_value(byte):
+    return None if byte == NO_RSSI else byte
+
+class DecodedRecord(object):
+    '''
+    0x03 droid record read back from a table or log, with the same fields
+    and item access as dbeacon.DroidRecord
+    '''
+    fields = ('droid_id', 'rssi', 'bay', 'action78', 'battery_low', 'personalityChip', 'affiliation', 'paired')
+    __slots__ = fields
+
+    def __getitem__(self, key):
+        if key not in self.fields:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+def pack_record(record):
+    '''
+    :param record: dbeacon.DroidRecord or DecodedRecord
+    :return: Values for RECORD_FORMAT
+    :rtype: tuple
+    '''
+    flags = PAIRED if record['paired'] else 0
+    rssi = record['rssi']
+    if rssi is not None:
+        flags |= HAS_RSSI
+    bay = record['bay']
+    if bay is not None:
+        flags |= EXTENDED
+        if record['action78']:
+            flags |= ACTION78
+        if record['battery_low']:
+            flags |= BATTERY_LOW
+    return (record['droid_id'] or 0, 0 if rssi is None else rssi & 0xff, NO_BAY if bay is None else bay, flags,
+            record['affiliation'] or 0, record['personalityChip'] or 0)
+
+def unpack_record(droid_id, rssi, bay, flags, affiliation, personality):
+    '''
+    :return: The record packed by pack_record
+    :rtype: DecodedRecord
+    '''
+    record = DecodedRecord()
+    record.droid_id = droid_id
+    record.rssi = rssi - 256 if flags & HAS_RSSI else None
+    record.paired = bool(flags & PAIRED)
+    record.affiliation = affiliation
+    record.personalityChip = personality
+    if flags & EXTENDED:
+        record.bay = bay
+        record.action78 = bool(flags & ACTION78)
+        record.battery_low = bool(flags & BATTERY_LOW)
+    else:
+        record.bay = record.action78 = record.battery_low = None
+    return record
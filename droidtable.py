@@ -0,0 +1,208 @@
+#!/usr/bin/python3
+
+'''
+Shared memory table of decoded droid state
+
+Written by one discovery worker process, read by the coordinator without
+copying the table or any message per advertisement. The segment is a
+header followed by capacity fixed size rows:
+
+    header  <8sIIQQ   magic, capacity, rows in use, advertisements seen by
+                      the worker, row writes
+    row     <I6sbBBBBBHdI
+            seq, MAC, advertisement RSSI, the droid record as packed by
+            droidstate, last seen (time.time()), advertisements from this
+            droid
+
+Each row is guarded by a seqlock: the writer makes seq odd, writes the row
+and makes seq even again, and a reader retries while seq is odd or changed
+under it. A row left odd by a worker that died mid-write is skipped after
+READ_RETRIES attempts. Rows are allocated in order and the header's row
+count only grows, so the reader indexes new rows by MAC as they appear.
+When the table is full the row seen least recently is reused for the new
+droid.
+'''
+
+import struct
+import time
+from multiprocessing import shared_memory
+
+import droidstate
+
+MAGIC = b'DROIDTB2'
+READ_RETRIES = 1000
+
+_header = struct.Struct('<8sIIQQ')
+_row = struct.Struct('<I6sb' + droidstate.RECORD_FORMAT + 'dI')
+_seq = struct.Struct('<I')
+_count = struct.Struct('<I')
+_counters = struct.Struct('<QQ')
+
+COUNT_OFFSET = 12
+COUNTERS_OFFSET = 16
+LAST_SEEN = 9
+
+class DroidTable(object):
+    '''
+    Use create() in the coordinator, which owns the segment, and attach()
+    in the worker.
+    '''
+    def __init__(self, shm, owner):
+        self.shm = shm
+        self.owner = owner
+        self.buf = shm.buf
+        magic, self.capacity, count, advertisements, writes = _header.unpack_from(self.buf, 0)
+        if magic != MAGIC:
+            raise Exception(f'{shm.name} is not a droid table')
+        # MAC -> row, maintained separately by the writer and the reader
+        self.index = {}
+        self.macs = []
+        self.seqs = []
+
+    @classmethod
+    def create(cls, capacity=1024, name=None):
+        shm = shared_memory.SharedMemory(name, create=True, size=_header.size + capacity * _row.size)
+        _header.pack_into(shm.buf, 0, MAGIC, capacity, 0, 0, 0)
+        return cls(shm, True)
+
+    @classmethod
+    def attach(cls, name):
+        return cls(shared_memory.SharedMemory(name), False)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    def offset(self, row):
+        return _header.size + row * _row.size
+
+    def count(self):
+        return _count.unpack_from(self.buf, COUNT_OFFSET)[0]
+
+    # Writer side
+
+    def allocate(self, mac):
+        count = len(self.macs)
+        if count < self.capacity:
+            row = count
+            self.macs.append(mac)
+        else:
+            row = min(range(count), key=lambda row: _row.unpack_from(self.buf, self.offset(row))[LAST_SEEN])
+            del self.index[self.macs[row]]
+            self.macs[row] = mac
+        self.index[mac] = row
+        return row
+
+    def write(self, mac, record, rssi, advertisements=1, now=None):
+        '''
+        Publish the latest state of a droid
+
+        :param str mac: Droid address, upper case
+        :param record: Decoded 0x03 droid record
+        :param int rssi: RSSI of the advertisement
+        :param int advertisements: Advertisements seen from the droid
+        '''
+        row = self.index.get(mac)
+        if row is None:
+            row = self.allocate(mac)
+        offset = self.offset(row)
+        seq = _seq.unpack_from(self.buf, offset)[0]
+        _seq.pack_into(self.buf, offset, (seq + 1) & 0xffffffff)
+        _row.pack_into(self.buf, offset, (seq + 1) & 0xffffffff, droidstate.mac_bytes(mac),
+                       droidstate.rssi_byte(rssi), *droidstate.pack_record(record),
+                       time.time() if now is None else now, advertisements & 0xffffffff)
+        _seq.pack_into(self.buf, offset, (seq + 2) & 0xffffffff)
+        if row == self.count():
+            _count.pack_into(self.buf, COUNT_OFFSET, row + 1)
+
+    def counters(self, advertisements, writes):
+        _counters.pack_into(self.buf, COUNTERS_OFFSET, advertisements, writes)
+
+    # Reader side
+
+    def read(self, row):
+        '''
+        :return: The row's fields, consistent with one write, or None if
+        the row stayed mid-write
+        :rtype: tuple
+        '''
+        offset = self.offset(row)
+        for _ in range(READ_RETRIES):
+            fields = _row.unpack_from(self.buf, offset)
+            if not fields[0] & 1 and _seq.unpack_from(self.buf, offset)[0] == fields[0]:
+                return fields
+        return None
+
+    @staticmethod
+    def decode(fields):
+        '''
+        :return: mac, droidstate.DecodedRecord, advertisement RSSI, last seen, advertisements
+        '''
+        seq, mac, rssi = fields[:3]
+        last_seen, advertisements = fields[LAST_SEEN:]
+        return (droidstate.mac_str(mac), droidstate.unpack_record(*fields[3:LAST_SEEN]),
+                droidstate.rssi_value(rssi), last_seen, advertisements)
+
+    def changed(self):
+        '''
+        Rows written since the last call
+
+        :return: Generator of decode() results
+        '''
+        count = self.count()
+        while len(self.seqs) < count:
+            self.seqs.append(None)
+        for row in range(count):
+            offset = self.offset(row)
+            if _seq.unpack_from(self.buf, offset)[0] == self.seqs[row]:
+                continue
+            fields = self.read(row)
+            if fields is None:
+                continue
+            self.seqs[row] = fields[0]
+            ret = self.decode(fields)
+            self.index[ret[0]] = row
+            yield ret
+
+    def get(self, mac):
+        '''
+        :return: decode() result for a droid, None if not in the table
+        '''
+        row = self.index.get(mac.upper())
+        if row is None:
+            return None
+        fields = self.read(row)
+        if fields is None:
+            return None
+        ret = self.decode(fields)
+        return ret if ret[0] == mac.upper() else None
+
+    def stats(self):
+        magic, capacity, count, advertisements, writes = _header.unpack_from(self.buf, 0)
+        return {'capacity': capacity, 'rows': count, 'advertisements': advertisements, 'writes': writes}
+
+if __name__ == '__main__':
+    import sys
+    import timeit
+
+    # Write and poll throughput of a table with one hundred droids
+    record = droidstate.DecodedRecord()
+    for field, value in zip(record.fields, (0x44, -60, 3, False, False, 5, 1, True)):
+        setattr(record, field, value)
+    table = DroidTable.create(1024)
+    try:
+        macs = [f'D0:00:00:00:00:{i:02X}' for i in range(100)]
+        count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+        i = iter(range(1 << 62))
+        seconds = timeit.timeit(lambda: table.write(macs[next(i) % 100], record, -50), number=count)
+        print(f'write: {count / seconds:.0f}/s')
+        seconds = timeit.timeit(lambda: (table.write(macs[0], record, -50), list(table.changed())), number=count // 100)
+        print(f'poll of 100 rows, 1 changed: {seconds / (count // 100) * 1e6:.1f} us')
+    finally:
+        table.close()
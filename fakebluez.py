@@ -0,0 +1,513 @@
+#!/usr/bin/python3
+
+'''
+Stand-in for bluetoothd on a private bus
+
+Implements enough of org.bluez for beacon, dbeacon, multiplex, bay and
+fleet to run without hardware: the ObjectManager root, Adapter1,
+LEAdvertisingManager1, Device1 discovery signals and a droid GATT
+service with the command and notify characteristics. Every method call
+is timed; the numbers are printed on exit and can be fetched as JSON
+with the Stats method of STATS_IFACE on /.
+
+    ./fakebluez.py --droids 20
+    export DBUS_SYSTEM_BUS_ADDRESS=...   # as printed
+    ./bay.py
+
+Without --address a private dbus-daemon is started, and stopped on exit.
+Advertisements come from a capture (see capture.py) or a synthetic crowd
+trace, and are only sent while discovery is running.
+'''
+
+import argparse
+import collections
+import contextlib
+import io
+import json
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import dbus
+import dbus.bus
+import dbus.service
+
+import capture
+import fleet
+import mainloop
+
+OM_IFACE = 'org.freedesktop.DBus.ObjectManager'
+PROPS_IFACE = 'org.freedesktop.DBus.Properties'
+ADAPTER_IFACE = 'org.bluez.Adapter1'
+AD_MANAGER_IFACE = 'org.bluez.LEAdvertisingManager1'
+GATT_MANAGER_IFACE = 'org.bluez.GattManager1'
+AD_IFACE = 'org.bluez.LEAdvertisement1'
+DEVICE_IFACE = 'org.bluez.Device1'
+SERVICE_IFACE = 'org.bluez.GattService1'
+CHRC_IFACE = 'org.bluez.GattCharacteristic1'
+STATS_IFACE = 'org.droiddepot.FakeBluez1'
+
+class BluezError(dbus.exceptions.DBusException):
+    def __init__(self, name, message):
+        super().__init__(message, name='org.bluez.Error.' + name)
+
+class CallLog(object):
+    def __init__(self):
+        self.calls = collections.defaultdict(list)
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        self.calls[name].append(seconds)
+
+    def stats(self):
+        ret = {}
+        for name, times in sorted(self.calls.items()):
+            ret[name] = {
+                'count': len(times),
+                'mean_ms': sum(times) / len(times) * 1000,
+                'p99_ms': capture.percentile(times, 0.99) * 1000,
+                'max_ms': max(times) * 1000,
+            }
+        return ret
+
+class PropertiesObject(dbus.service.Object):
+    '''
+    Object exporting a set of interfaces with properties
+    '''
+    def __init__(self, bluez, path, props):
+        self.bluez = bluez
+        self.path = path
+        self.props = props
+        dbus.service.Object.__init__(self, bluez.bus, path)
+
+    def update(self, interface, changed):
+        self.props[interface].update(changed)
+        self.PropertiesChanged(interface, changed, [])
+
+    @dbus.service.method(PROPS_IFACE, in_signature='ss', out_signature='v')
+    def Get(self, interface, name):
+        with self.bluez.log.timed('Properties.Get'):
+            try:
+                return self.props[interface][name]
+            except KeyError:
+                raise dbus.exceptions.DBusException(f'No property {interface}.{name}',
+                                                    name='org.freedesktop.DBus.Error.InvalidArgs')
+
+    @dbus.service.method(PROPS_IFACE, in_signature='s', out_signature='a{sv}')
+    def GetAll(self, interface):
+        with self.bluez.log.timed('Properties.GetAll'):
+            return self.props.get(interface, {})
+
+    @dbus.service.method(PROPS_IFACE, in_signature='ssv', out_signature='')
+    def Set(self, interface, name, value):
+        with self.bluez.log.timed('Properties.Set'):
+            if name not in self.props.get(interface, {}):
+                raise dbus.exceptions.DBusException(f'No property {interface}.{name}',
+                                                    name='org.freedesktop.DBus.Error.InvalidArgs')
+            self.update(interface, {name: value})
+
+    @dbus.service.signal(PROPS_IFACE, signature='sa{sv}as')
+    def PropertiesChanged(self, interface, changed, invalidated):
+        pass
+
+class Root(dbus.service.Object):
+    def __init__(self, bluez):
+        self.bluez = bluez
+        dbus.service.Object.__init__(self, bluez.bus, '/')
+
+    @dbus.service.method(OM_IFACE, in_signature='', out_signature='a{oa{sa{sv}}}')
+    def GetManagedObjects(self):
+        with self.bluez.log.timed('ObjectManager.GetManagedObjects'):
+            return {obj.path: obj.props for obj in self.bluez.objects.values()}
+
+    @dbus.service.signal(OM_IFACE, signature='oa{sa{sv}}')
+    def InterfacesAdded(self, path, interfaces):
+        pass
+
+    @dbus.service.signal(OM_IFACE, signature='oas')
+    def InterfacesRemoved(self, path, interfaces):
+        pass
+
+    @dbus.service.method(STATS_IFACE, in_signature='', out_signature='s')
+    def Stats(self):
+        return json.dumps(self.bluez.stats())
+
+class Adapter(PropertiesObject):
+    def __init__(self, bluez, name, instances):
+        super().__init__(bluez, '/org/bluez/' + name, {
+            ADAPTER_IFACE: {
+                'Address': '00:00:00:00:00:01',
+                'Alias': 'fakebluez',
+                'Powered': dbus.Boolean(True),
+                'Discovering': dbus.Boolean(False),
+            },
+            AD_MANAGER_IFACE: {
+                'ActiveInstances': dbus.Byte(0),
+                'SupportedInstances': dbus.Byte(instances),
+            },
+            GATT_MANAGER_IFACE: {},
+        })
+        self.advertisements = {}
+        self.discovery_filter = {}
+        self.registrations = 0
+
+    @dbus.service.method(ADAPTER_IFACE, in_signature='', out_signature='')
+    def StartDiscovery(self):
+        with self.bluez.log.timed('Adapter1.StartDiscovery'):
+            self.update(ADAPTER_IFACE, {'Discovering': dbus.Boolean(True)})
+            self.bluez.feed.start()
+
+    @dbus.service.method(ADAPTER_IFACE, in_signature='', out_signature='')
+    def StopDiscovery(self):
+        with self.bluez.log.timed('Adapter1.StopDiscovery'):
+            self.update(ADAPTER_IFACE, {'Discovering': dbus.Boolean(False)})
+            self.bluez.feed.stop()
+
+    @dbus.service.method(ADAPTER_IFACE, in_signature='a{sv}', out_signature='')
+    def SetDiscoveryFilter(self, discovery_filter):
+        with self.bluez.log.timed('Adapter1.SetDiscoveryFilter'):
+            self.discovery_filter = dict(discovery_filter)
+
+    @dbus.service.method(ADAPTER_IFACE, in_signature='o', out_signature='')
+    def RemoveDevice(self, path):
+        with self.bluez.log.timed('Adapter1.RemoveDevice'):
+            self.bluez.remove_device(str(path))
+
+    @dbus.service.method(AD_MANAGER_IFACE, in_signature='oa{sv}', out_signature='',
+                         sender_keyword='sender', async_callbacks=('reply', 'error'))
+    def RegisterAdvertisement(self, path, options, sender=None, reply=None, error=None):
+        # Like bluetoothd, read the advertisement properties back from the
+        # caller before replying
+        start = time.perf_counter()
+        path = str(path)
+        if path in self.advertisements:
+            error(BluezError('AlreadyExists', 'Already Exists'))
+            return
+        if len(self.advertisements) >= self.props[AD_MANAGER_IFACE]['SupportedInstances']:
+            error(BluezError('NotPermitted', 'Maximum advertisements reached'))
+            return
+        self.advertisements[path] = None
+        def registered(props):
+            if path not in self.advertisements:
+                error(BluezError('Failed', 'Unregistered while registering'))
+                return
+            self.advertisements[path] = (sender, dict(props))
+            self.registrations += 1
+            self.update(AD_MANAGER_IFACE, {'ActiveInstances': dbus.Byte(len(self.advertisements))})
+            self.bluez.log.record('LEAdvertisingManager1.RegisterAdvertisement', time.perf_counter() - start)
+            reply()
+        def failed(e):
+            self.advertisements.pop(path, None)
+            error(BluezError('Failed', f'Failed to parse advertisement: {e}'))
+        self.bluez.bus.get_object(sender, path, introspect=False).GetAll(
+            AD_IFACE, dbus_interface=PROPS_IFACE, reply_handler=registered, error_handler=failed)
+
+    @dbus.service.method(AD_MANAGER_IFACE, in_signature='o', out_signature='')
+    def UnregisterAdvertisement(self, path):
+        with self.bluez.log.timed('LEAdvertisingManager1.UnregisterAdvertisement'):
+            if self.advertisements.pop(str(path), 0) == 0:
+                raise BluezError('DoesNotExist', 'Does Not Exist')
+            self.update(AD_MANAGER_IFACE, {'ActiveInstances': dbus.Byte(len(self.advertisements))})
+
+class Characteristic(PropertiesObject):
+    def __init__(self, bluez, device, path, uuid, mtu):
+        super().__init__(bluez, path, {
+            CHRC_IFACE: {
+                'UUID': uuid,
+                'Service': dbus.ObjectPath(path.rsplit('/', 1)[0]),
+                'Flags': dbus.Array(['write-without-response', 'write', 'notify'], signature='s'),
+                'MTU': dbus.UInt16(mtu),
+                'Notifying': dbus.Boolean(False),
+            },
+        })
+        self.device = device
+        self.written = 0
+        self.writes = 0
+        self.pipe = None
+
+    @dbus.service.method(CHRC_IFACE, in_signature='aya{sv}', out_signature='')
+    def WriteValue(self, value, options):
+        with self.bluez.log.timed('GattCharacteristic1.WriteValue'):
+            if not self.device.props[DEVICE_IFACE]['Connected']:
+                raise BluezError('Failed', 'Not connected')
+            if len(value) > self.props[CHRC_IFACE]['MTU'] - 3:
+                raise BluezError('InvalidValueLength', 'Invalid Length')
+            self.written += len(value)
+            self.writes += 1
+
+    @dbus.service.method(CHRC_IFACE, in_signature='a{sv}', out_signature='hq')
+    def AcquireWrite(self, options):
+        with self.bluez.log.timed('GattCharacteristic1.AcquireWrite'):
+            if self.pipe is not None:
+                raise BluezError('NotPermitted', 'Write acquired')
+            self.pipe, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            self.pipe.setblocking(False)
+            mainloop.io_add_watch(self.pipe.fileno(), mainloop.IO_IN | mainloop.IO_HUP, self.readable)
+            fd = dbus.types.UnixFd(theirs)
+            theirs.close()
+            return fd, self.props[CHRC_IFACE]['MTU']
+
+    def readable(self, fd, condition):
+        try:
+            data = self.pipe.recv(65536)
+        except BlockingIOError:
+            return True
+        if not data:
+            self.pipe.close()
+            self.pipe = None
+            return False
+        self.written += len(data)
+        self.writes += 1
+        return True
+
+    @dbus.service.method(CHRC_IFACE, in_signature='', out_signature='')
+    def StartNotify(self):
+        self.update(CHRC_IFACE, {'Notifying': dbus.Boolean(True)})
+
+    @dbus.service.method(CHRC_IFACE, in_signature='', out_signature='')
+    def StopNotify(self):
+        self.update(CHRC_IFACE, {'Notifying': dbus.Boolean(False)})
+
+class Device(PropertiesObject):
+    def __init__(self, bluez, path, mac, alias, rssi, mfd):
+        props = {
+            'Address': mac,
+            'AddressType': 'random',
+            'Alias': alias or mac.replace(':', '-'),
+            'Adapter': dbus.ObjectPath(bluez.adapter.path),
+            'Connected': dbus.Boolean(False),
+            'ServicesResolved': dbus.Boolean(False),
+        }
+        if rssi is not None:
+            props['RSSI'] = dbus.Int16(rssi)
+        if mfd is not None:
+            props['ManufacturerData'] = manufacturer_data(mfd)
+        super().__init__(bluez, path, {DEVICE_IFACE: props})
+        self.gatt = []
+        self.pending = None
+
+    @dbus.service.method(DEVICE_IFACE, in_signature='', out_signature='',
+                         async_callbacks=('reply', 'error'))
+    def Connect(self, reply=None, error=None):
+        start = time.perf_counter()
+        if self.props[DEVICE_IFACE]['Connected']:
+            reply()
+            return
+        if self.pending is not None:
+            error(BluezError('InProgress', 'In Progress'))
+            return
+        def connected():
+            self.pending = None
+            self.update(DEVICE_IFACE, {'Connected': dbus.Boolean(True)})
+            self.resolve()
+            self.bluez.log.record('Device1.Connect', time.perf_counter() - start)
+            reply()
+            return False
+        self.pending = mainloop.timeout_add(self.bluez.connect_latency, connected)
+
+    @dbus.service.method(DEVICE_IFACE, in_signature='', out_signature='')
+    def Disconnect(self):
+        with self.bluez.log.timed('Device1.Disconnect'):
+            if self.pending is not None:
+                mainloop.source_remove(self.pending)
+                self.pending = None
+            self.unresolve()
+            self.update(DEVICE_IFACE, {'Connected': dbus.Boolean(False)})
+
+    def resolve(self):
+        if self.gatt:
+            return
+        service_path = self.path + '/service000a'
+        service = PropertiesObject(self.bluez, service_path, {
+            SERVICE_IFACE: {'UUID': fleet.DROID_SERVICE_UUID, 'Device': dbus.ObjectPath(self.path),
+                            'Primary': dbus.Boolean(True)},
+        })
+        self.gatt = [service,
+                     Characteristic(self.bluez, self, service_path + '/char000b', fleet.DROID_COMMAND_UUID, self.bluez.mtu),
+                     Characteristic(self.bluez, self, service_path + '/char000d', fleet.DROID_NOTIFY_UUID, self.bluez.mtu)]
+        for obj in self.gatt:
+            self.bluez.add_object(obj)
+        self.update(DEVICE_IFACE, {'ServicesResolved': dbus.Boolean(True)})
+
+    def unresolve(self):
+        if not self.gatt:
+            return
+        self.update(DEVICE_IFACE, {'ServicesResolved': dbus.Boolean(False)})
+        for obj in reversed(self.gatt):
+            self.bluez.remove_object(obj)
+        self.gatt = []
+
+def manufacturer_data(mfd):
+    return dbus.Dictionary({dbus.UInt16(company): dbus.Array(data, signature='y') for company, data in mfd.items()},
+                           signature='qv')
+
+class Feed(object):
+    '''
+    Replays capture records as discovery signals while discovery runs,
+    looping at the end of the capture
+    '''
+    def __init__(self, bluez, records, speed=1.0):
+        self.bluez = bluez
+        self.records = records
+        self.speed = speed
+        self.index = 0
+        self.source = None
+        self.started = None
+        self.sent = 0
+
+    def start(self):
+        if self.source is None and self.records:
+            self.started = time.monotonic() - (self.records[self.index][0] - self.records[0][0]) / self.speed
+            self.source = mainloop.timeout_add(10, self.tick)
+
+    def stop(self):
+        if self.source is not None:
+            mainloop.source_remove(self.source)
+            self.source = None
+
+    def tick(self):
+        elapsed = (time.monotonic() - self.started) * self.speed
+        first = self.records[0][0]
+        while self.records[self.index][0] - first <= elapsed:
+            timestamp, mac, alias, rssi, mfd = self.records[self.index]
+            self.bluez.advertise(mac, alias, rssi, mfd)
+            self.sent += 1
+            self.index += 1
+            if self.index == len(self.records):
+                self.index = 0
+                self.started = time.monotonic()
+                break
+        return True
+
+class FakeBluez(object):
+    def __init__(self, bus, records=(), speed=1.0, adapter='hci0', instances=4, connect_latency=300, mtu=185):
+        self.bus = bus
+        self.log = CallLog()
+        self.connect_latency = connect_latency
+        self.mtu = mtu
+        self.objects = collections.OrderedDict()
+        self.root = Root(self)
+        self.adapter = self.add_object(Adapter(self, adapter, instances), signal=False)
+        self.feed = Feed(self, list(records), speed)
+        self.signals = 0
+
+    def add_object(self, obj, signal=True):
+        self.objects[obj.path] = obj
+        if signal:
+            self.root.InterfacesAdded(obj.path, obj.props)
+            self.signals += 1
+        return obj
+
+    def remove_object(self, obj):
+        del self.objects[obj.path]
+        self.root.InterfacesRemoved(obj.path, list(obj.props))
+        self.signals += 1
+        obj.remove_from_connection()
+
+    def remove_device(self, path):
+        device = self.objects.get(path)
+        if not isinstance(device, Device):
+            raise BluezError('DoesNotExist', 'Does Not Exist')
+        device.unresolve()
+        self.remove_object(device)
+
+    def advertise(self, mac, alias, rssi, mfd):
+        '''
+        Report an advertisement: a new device or a PropertiesChanged with
+        its RSSI and manufacturer data, as bluetoothd does with
+        DuplicateData set
+        '''
+        discovery_filter = self.adapter.discovery_filter
+        if rssi is not None and 'RSSI' in discovery_filter and rssi < discovery_filter['RSSI']:
+            return
+        path = f'{self.adapter.path}/dev_{mac.upper().replace(":", "_")}'
+        device = self.objects.get(path)
+        if device is None:
+            self.add_object(Device(self, path, mac.upper(), alias, rssi, mfd))
+            return
+        changed = {}
+        if rssi is not None:
+            changed['RSSI'] = dbus.Int16(rssi)
+        if mfd is not None:
+            changed['ManufacturerData'] = manufacturer_data(mfd)
+        device.update(DEVICE_IFACE, changed)
+        self.signals += 1
+
+    def stats(self):
+        written = {path: obj.written for path, obj in self.objects.items() if isinstance(obj, Characteristic) and obj.written}
+        return {
+            'calls': self.log.stats(),
+            'signals': self.signals,
+            'advertisements_sent': self.feed.sent,
+            'registrations': self.adapter.registrations,
+            'active_advertisements': len(self.adapter.advertisements),
+            'gatt_bytes_written': written,
+        }
+
+def start_daemon():
+    '''
+    Start a private dbus-daemon
+
+    :return: (process, bus address)
+    '''
+    proc = subprocess.Popen(['dbus-daemon', '--session', '--nofork', '--print-address=1'],
+                            stdout=subprocess.PIPE, text=True)
+    address = proc.stdout.readline().strip()
+    if not address:
+        proc.kill()
+        raise Exception('dbus-daemon did not start')
+    return proc, address
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake BlueZ service for offline testing')
+    parser.add_argument('--address', help='Bus to serve on, default is a new private dbus-daemon')
+    parser.add_argument('--capture', metavar='FILE', help='Advertisements to replay, see capture.py')
+    parser.add_argument('--droids', type=int, default=10, help='Droids in the synthetic trace used without --capture')
+    parser.add_argument('--speed', type=float, default=1.0, help='Replay time scale')
+    parser.add_argument('--adapter', default='hci0')
+    parser.add_argument('--instances', type=int, default=4, help='Supported advertising instances')
+    parser.add_argument('--connect-latency', type=int, default=300, help='Device1.Connect latency in ms')
+    parser.add_argument('--mtu', type=int, default=185)
+    args = parser.parse_args()
+
+    if args.capture:
+        records = capture.load(args.capture)
+    else:
+        f = io.BytesIO()
+        capture.synthesize(f, droids=args.droids, others=args.droids * 4, seconds=10.0)
+        records = list(capture.read_capture(f.getvalue()))
+
+    mainloop.install('glib')
+    daemon = None
+    address = args.address
+    if address is None:
+        daemon, address = start_daemon()
+    bus = dbus.bus.BusConnection(address)
+    name = dbus.service.BusName('org.bluez', bus)
+    bluez = FakeBluez(bus, records, args.speed, args.adapter, args.instances, args.connect_latency, args.mtu)
+
+    print(f'export DBUS_SYSTEM_BUS_ADDRESS={address}', flush=True)
+
+    def stop(signum, frame):
+        mainloop.quit()
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        mainloop.run()
+    finally:
+        print(json.dumps(bluez.stats(), indent=1), file=sys.stderr)
+        if daemon is not None:
+            daemon.terminate()
+            daemon.wait()
+
+if __name__ == '__main__':
+    main()
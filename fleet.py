@@ -0,0 +1,361 @@
+#!/usr/bin/python3
+
+import collections
+import random
+import sys
+import time
+import dbus
+import gatt
+import mainloop
+
+import droid_cmd
+import gatt_writer
+
+DROID_SERVICE_UUID = '09b600a0-3e42-41fc-b474-e9c0c8f0c801'
+DROID_COMMAND_UUID = '09b600b1-3e42-41fc-b474-e9c0c8f0c801'
+DROID_NOTIFY_UUID = '09b600b0-3e42-41fc-b474-e9c0c8f0c801'
+
+class CharacteristicHandle(object):
+    '''
+    Minimal stand-in for gatt.Characteristic built from a cached object path
+    '''
+    def __init__(self, bus, path):
+        self.path = path
+        self._object = bus.get_object('org.bluez', path)
+        self._properties = dbus.Interface(self._object, dbus.PROPERTIES_IFACE)
+
+class DroidDevice(gatt.Device):
+    def __init__(self, mac_address, manager, backend):
+        super().__init__(mac_address=mac_address, manager=manager)
+        self.backend = backend
+
+    def connect_failed(self, error):
+        super().connect_failed(error)
+        self.backend.disconnected(self.mac_address, error)
+
+    def disconnect_succeeded(self):
+        super().disconnect_succeeded()
+        self.backend.disconnected(self.mac_address, 'disconnected')
+
+    def services_resolved(self):
+        path = self.backend.handles.get(self.mac_address)
+        if path is None:
+            # First connection, walk the GATT database once and remember
+            # where the command characteristic lives.
+            super().services_resolved()
+            for service in self.services:
+                for characteristic in service.characteristics:
+                    if characteristic.uuid == DROID_COMMAND_UUID:
+                        path = characteristic.path
+            if path is None:
+                self.backend.disconnected(self.mac_address, 'command characteristic not found')
+                self.disconnect()
+                return
+            self.backend.handles[self.mac_address] = path
+        self.backend.resolved(self.mac_address, CharacteristicHandle(self._bus, path))
+
+class GattBackend(object):
+    '''
+    Droid connections through BlueZ
+
+    Uses an existing gatt.DeviceManager (such as bay.AnyDeviceManager) for
+    the bus and adapter. The object path of each droid's command
+    characteristic is cached by MAC so reconnects go straight to the
+    characteristic without enumerating services again.
+    '''
+    def __init__(self, manager, writer_options=None):
+        self.manager = manager
+        self.writer_options = writer_options or {}
+        self.handles = {}
+        self.devices = {}
+        self.callbacks = {}
+
+    def connect(self, mac, ready, lost):
+        device = self.devices.get(mac)
+        if device is None:
+            device = DroidDevice(mac, self.manager, self)
+            self.devices[mac] = device
+        self.callbacks[mac] = (ready, lost)
+        device.connect()
+
+    def disconnect(self, mac):
+        self.callbacks.pop(mac, None)
+        device = self.devices.get(mac)
+        if device is not None:
+            device.disconnect()
+
+    def forget(self, mac):
+        self.handles.pop(mac, None)
+
+    def resolved(self, mac, handle):
+        if mac in self.callbacks:
+            self.callbacks[mac][0](mac, handle)
+
+    def disconnected(self, mac, error):
+        callbacks = self.callbacks.pop(mac, None)
+        if callbacks is not None:
+            callbacks[1](mac, error)
+
+    def writer(self, handle, drained):
+        return gatt_writer.CommandWriter(handle, drained=drained, **self.writer_options)
+
+class LoopbackWriter(gatt_writer.CommandWriter):
+    def __init__(self, backend, mac, drained):
+        super().__init__(None, mtu=backend.mtu, window=backend.window, drained=drained)
+        self.backend = backend
+        self.mac = mac
+
+    def pump(self):
+        while self.queue and self.in_flight < self.window:
+            packet, count = self.queue.popleft()
+            self.in_flight += 1
+            self.in_flight_commands += count
+            mainloop.timeout_add(self.backend.write_latency, self.complete, packet, count)
+
+    def complete(self, packet, count):
+        self.backend.received[self.mac] += packet
+        self.written(count, len(packet))
+        return False
+
+class LoopbackBackend(object):
+    '''
+    Simulated droids for exercising DroidController without hardware
+
+    Connections and writes complete after fixed latencies on the main
+    loop. Everything written to a droid is collected in received.
+    '''
+    def __init__(self, connect_latency=800, write_latency=8, mtu=185, window=8, failure_rate=0.0, seed=None):
+        '''
+        :param int connect_latency: ms from connect to resolved characteristic
+        :param int write_latency: ms per write
+        :param int mtu: Simulated ATT MTU
+        :param int window: Writes in flight per droid
+        :param float failure_rate: Fraction of connection attempts that fail
+        '''
+        self.connect_latency = connect_latency
+        self.write_latency = write_latency
+        self.mtu = mtu
+        self.window = window
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.received = collections.defaultdict(bytearray)
+        self.pending = {}
+        self.connects = 0
+        self.connected = set()
+        self.max_connected = 0
+
+    def connect(self, mac, ready, lost):
+        self.connects += 1
+        self.pending[mac] = mainloop.timeout_add(self.connect_latency, self.complete_connect, mac, ready, lost)
+
+    def complete_connect(self, mac, ready, lost):
+        del self.pending[mac]
+        if self.random.random() < self.failure_rate:
+            lost(mac, 'simulated connection failure')
+            return False
+        self.connected.add(mac)
+        self.max_connected = max(self.max_connected, len(self.connected))
+        ready(mac, mac)
+        return False
+
+    def disconnect(self, mac):
+        source = self.pending.pop(mac, None)
+        if source is not None:
+            mainloop.source_remove(source)
+        self.connected.discard(mac)
+
+    def writer(self, handle, drained):
+        return LoopbackWriter(self, handle, drained)
+
+class DroidSession(object):
+    __slots__ = ('mac', 'state', 'pending', 'writer', 'last_used', 'retries')
+
+    def __init__(self, mac):
+        self.mac = mac
+        self.state = 'idle'
+        self.pending = collections.deque()
+        self.writer = None
+        self.last_used = 0.0
+        self.retries = 0
+
+class DroidController(object):
+    '''
+    Dispatch command buffers to many droids in parallel
+
+    Each droid has its own queue. Buffers for a droid without a live
+    connection are held until it connects. At most max_connections droids
+    are connected or connecting at once; when the pool is full, the least
+    recently used droid with nothing left to write is disconnected to make
+    room, otherwise the droid waits for a free slot.
+    '''
+    def __init__(self, backend, max_connections=32, retries=3):
+        self.backend = backend
+        self.max_connections = max_connections
+        self.retries = retries
+        self.sessions = {}
+        self.pool = collections.OrderedDict()
+        self.waiting = collections.deque()
+        self.dropped = 0
+        self.evictions = 0
+        self.commands = 0
+        self.packets = 0
+
+    def session(self, mac):
+        session = self.sessions.get(mac)
+        if session is None:
+            session = DroidSession(mac)
+            self.sessions[mac] = session
+        return session
+
+    def send(self, mac, buf):
+        '''
+        Queue a command buffer for a droid
+
+        :param str mac: Droid address
+        :param bytes buf: Output of droid_cmd_buffer.pop()
+        '''
+        session = self.session(mac)
+        session.last_used = time.monotonic()
+        if session.writer is not None:
+            self.pool.move_to_end(mac)
+            session.writer.write(buf)
+        else:
+            session.pending.append(bytes(buf))
+            self.connect(session)
+
+    def broadcast(self, macs, buf):
+        buf = bytes(buf)
+        for mac in macs:
+            self.send(mac, buf)
+
+    def connect(self, session):
+        if session.state != 'idle':
+            return
+        if len(self.pool) >= self.max_connections and not self.evict():
+            if session.mac not in self.waiting:
+                self.waiting.append(session.mac)
+            return
+        session.state = 'connecting'
+        self.pool[session.mac] = session
+        self.backend.connect(session.mac, self.ready, self.lost)
+
+    def evict(self):
+        for mac, session in self.pool.items():
+            if session.state == 'ready' and session.writer.idle():
+                self.release(session)
+                self.backend.disconnect(mac)
+                self.evictions += 1
+                return True
+        return False
+
+    def release(self, session):
+        if session.writer is not None:
+            self.commands += session.writer.commands
+            self.packets += session.writer.packets
+            self.dropped += session.writer.failed_commands
+            session.writer.close()
+            session.writer = None
+        session.state = 'idle'
+        self.pool.pop(session.mac, None)
+
+    def admit(self):
+        while self.waiting and len(self.pool) < self.max_connections:
+            self.connect(self.sessions[self.waiting.popleft()])
+
+    def ready(self, mac, handle):
+        session = self.sessions[mac]
+        if session.state != 'connecting':
+            return
+        session.state = 'ready'
+        session.retries = 0
+        session.writer = self.backend.writer(handle, lambda: self.drained(session))
+        while session.pending:
+            session.writer.write(session.pending.popleft())
+
+    def lost(self, mac, error):
+        session = self.sessions.get(mac)
+        if session is None or session.state == 'idle':
+            return
+        if session.writer is not None:
+            # Packets not yet handed to BlueZ are sent again after
+            # reconnecting, those in flight may or may not have arrived
+            session.pending.extendleft(reversed(session.writer.unsent()))
+            self.dropped += session.writer.in_flight_commands
+        self.release(session)
+        if session.pending:
+            session.retries += 1
+            if session.retries > self.retries:
+                print(f'[{mac}] giving up: {error}')
+                self.dropped += sum(gatt_writer.count_commands(buf) for buf in session.pending)
+                session.pending.clear()
+            else:
+                self.connect(session)
+        self.admit()
+
+    def drained(self, session):
+        if self.waiting and session.state == 'ready':
+            self.release(session)
+            self.backend.disconnect(session.mac)
+            self.evictions += 1
+            self.admit()
+
+    def idle(self):
+        return all(not s.pending and (s.writer is None or s.writer.idle()) for s in self.sessions.values())
+
+    def stats(self):
+        commands = self.commands
+        packets = self.packets
+        dropped = self.dropped
+        for session in self.sessions.values():
+            if session.writer is not None:
+                commands += session.writer.commands
+                packets += session.writer.packets
+                dropped += session.writer.failed_commands
+        return {
+            'droids': len(self.sessions),
+            'connected': sum(1 for s in self.pool.values() if s.state == 'ready'),
+            'connecting': sum(1 for s in self.pool.values() if s.state == 'connecting'),
+            'waiting': len(self.waiting),
+            'queued': sum(len(s.pending) for s in self.sessions.values()),
+            'evictions': self.evictions,
+            'dropped': dropped,
+            'commands': commands,
+            'packets': packets,
+        }
+
+def load_test(droids=48, buffers=20, max_connections=16, **backend_options):
+    '''
+    Drive simulated droids through a DroidController and report throughput
+    '''
+    backend = LoopbackBackend(seed=0, **backend_options)
+    controller = DroidController(backend, max_connections=max_connections)
+    macs = [f'd0:00:00:00:{i >> 8:02x}:{i & 0xff:02x}' for i in range(droids)]
+
+    buf = droid_cmd.droid_cmd_buffer()
+    for i in range(16):
+        buf.led_rgb_ramp(0, (i * 16, 0x80, 0x40), 200)
+        buf.r2_center_head(0x80, 0)
+    script = buf.pop()
+    commands = 32 * buffers * droids
+
+    def poll():
+        if controller.idle():
+            mainloop.quit()
+            return False
+        return True
+
+    start = time.monotonic()
+    for _ in range(buffers):
+        controller.broadcast(macs, script)
+    mainloop.timeout_add(10, poll)
+    mainloop.run()
+    elapsed = time.monotonic() - start
+
+    for mac in macs:
+        if backend.received[mac] != script * buffers:
+            raise Exception(f'{mac} received wrong data')
+    print(f'{droids} droids, {commands} commands in {elapsed:.2f}s: {commands / elapsed:.0f} commands/s')
+    print(f'{backend.connects} connects, {backend.max_connected} max concurrent', controller.stats())
+
+if __name__ == '__main__':
+    load_test(*[int(arg) for arg in sys.argv[1:]])
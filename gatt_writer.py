@@ -0,0 +1,249 @@
+#!/usr/bin/python3
+
+import collections
+import os
+import time
+import dbus
+import dbus.exceptions
+import mainloop
+
+GATT_CHRC_IFACE = 'org.bluez.GattCharacteristic1'
+
+ATT_WRITE_HEADER = 3
+DEFAULT_MTU = 23
+
+def command_length(buf, offset):
+    '''
+    Length of the encoded cmd_buffer command at offset, header included
+    '''
+    return 4 + (buf[offset + 3] & 0x1f)
+
+def count_commands(buf):
+    '''
+    Number of cmd_buffer commands in buf
+    '''
+    offset = count = 0
+    while offset < len(buf):
+        offset += command_length(buf, offset)
+        count += 1
+    return count
+
+def packetize(buf, mtu=DEFAULT_MTU):
+    '''
+    Split a command buffer into GATT writes on command boundaries
+
+    As many whole commands as fit in the ATT payload (mtu - 3) are packed
+    into each write. The returned packets are views into buf.
+
+    :param bytes buf: Output of cmd_buffer.pop()
+    :param int mtu: Negotiated ATT MTU
+    :return: Iterator of (packet, number of commands in packet)
+    '''
+    limit = mtu - ATT_WRITE_HEADER
+    mv = memoryview(buf)
+    end = len(mv)
+    start = offset = 0
+    count = 0
+    while offset < end:
+        if end - offset < 4:
+            raise Exception('Truncated command')
+        length = command_length(mv, offset)
+        if offset + length > end:
+            raise Exception('Truncated command')
+        if length > limit:
+            raise Exception('Command larger than MTU')
+        if offset + length - start > limit:
+            yield mv[start:offset], count
+            start = offset
+            count = 0
+        offset += length
+        count += 1
+    if start < end:
+        yield mv[start:end], count
+
+def characteristic_mtu(characteristic):
+    '''
+    Read the negotiated MTU of a gatt.Characteristic
+
+    Requires BlueZ 5.62 or later, otherwise the ATT default is returned.
+    '''
+    try:
+        return int(characteristic._properties.Get(GATT_CHRC_IFACE, 'MTU'))
+    except dbus.exceptions.DBusException:
+        return DEFAULT_MTU
+
+class CommandWriter(object):
+    '''
+    Pipelined writer of command buffers to a GATT characteristic
+
+    Command buffers are packed into MTU sized writes by packetize. Up to
+    window writes are outstanding on D-Bus at once; further packets queue
+    until a write completes. Write without response ('command') is used
+    unless with_response is set.
+
+    With acquire set, the characteristic is opened with AcquireWrite and
+    packets are written straight to the returned socket, bypassing D-Bus
+    per packet. Flow control then comes from the socket send buffer.
+    '''
+    def __init__(self, characteristic, mtu=None, with_response=False, window=8, acquire=False, drained=None,
+                 dropped=None):
+        '''
+        :param gatt.Characteristic characteristic: Droid command characteristic
+        :param int mtu: ATT MTU, read from the characteristic by default
+        :param bool with_response: Use write requests instead of commands
+        :param int window: Maximum D-Bus writes in flight
+        :param bool acquire: Write through an AcquireWrite socket
+        :param callable drained: Called when all queued packets are written
+        :param callable dropped: Called with the number of commands and the
+        error when a write fails; the commands are not retried
+        '''
+        self.characteristic = characteristic
+        self.with_response = with_response
+        self.window = window
+        self.drained = drained
+        self.dropped = dropped
+        self.queue = collections.deque()
+        self.in_flight = 0
+        self.in_flight_commands = 0
+        self.fd = None
+        self.fd_watch = None
+        self.packets = 0
+        self.commands = 0
+        self.bytes = 0
+        self.errors = 0
+        self.failed_commands = 0
+        self.started = None
+
+        if acquire and not with_response:
+            fd, mtu = characteristic._object.AcquireWrite({}, dbus_interface=GATT_CHRC_IFACE)
+            self.fd = fd.take()
+            os.set_blocking(self.fd, False)
+        self.mtu = mtu or characteristic_mtu(characteristic)
+        self.options = {'type': 'request' if with_response else 'command'}
+
+    def write(self, buf):
+        '''
+        Queue a command buffer for writing
+
+        :param bytes buf: Output of cmd_buffer.pop()
+        '''
+        if self.started is None:
+            self.started = time.monotonic()
+        for packet, count in packetize(buf, self.mtu):
+            self.queue.append((bytes(packet), count))
+        self.pump()
+
+    def pump(self):
+        if self.fd is not None:
+            self.pump_socket()
+            return
+        while self.queue and self.in_flight < self.window:
+            packet, count = self.queue.popleft()
+            self.in_flight += 1
+            self.in_flight_commands += count
+            self.characteristic._object.WriteValue(
+                dbus.Array(packet, signature='y'), self.options,
+                reply_handler=lambda count=count, size=len(packet): self.written(count, size),
+                error_handler=lambda error, count=count: self.failed(count, error),
+                dbus_interface=GATT_CHRC_IFACE)
+
+    def pump_socket(self):
+        while self.queue:
+            packet, count = self.queue[0]
+            try:
+                os.write(self.fd, packet)
+            except BlockingIOError:
+                if self.fd_watch is None:
+                    self.fd_watch = mainloop.io_add_watch(self.fd, mainloop.IO_OUT, self.writable)
+                return
+            except OSError as e:
+                self.socket_failed(e)
+                return
+            self.queue.popleft()
+            self.written(count, len(packet))
+
+    def writable(self, fd, condition):
+        self.fd_watch = None
+        self.pump_socket()
+        return False
+
+    def written(self, count, size):
+        if self.fd is None:
+            self.in_flight -= 1
+            self.in_flight_commands -= count
+        self.packets += 1
+        self.commands += count
+        self.bytes += size
+        if self.fd is None:
+            self.pump()
+        self.check_drained()
+
+    def failed(self, count, error):
+        self.in_flight -= 1
+        self.in_flight_commands -= count
+        self.errors += 1
+        self.failed_commands += count
+        if self.dropped is not None:
+            self.dropped(count, error)
+        self.pump()
+        self.check_drained()
+
+    def socket_failed(self, error):
+        '''
+        Close the AcquireWrite socket after a write error, such as the droid
+        disconnecting, and drop the queued packets. Later writes go through
+        D-Bus.
+        '''
+        if self.fd_watch is not None:
+            mainloop.source_remove(self.fd_watch)
+            self.fd_watch = None
+        os.close(self.fd)
+        self.fd = None
+        count = sum(count for packet, count in self.queue)
+        self.queue.clear()
+        self.errors += 1
+        self.failed_commands += count
+        if self.dropped is not None:
+            self.dropped(count, error)
+        self.check_drained()
+
+    def check_drained(self):
+        if not self.queue and not self.in_flight and self.drained is not None:
+            self.drained()
+
+    def unsent(self):
+        '''
+        Take the packets not handed to BlueZ yet, each a whole number of
+        commands
+        '''
+        ret = [packet for packet, count in self.queue]
+        self.queue.clear()
+        return ret
+
+    def idle(self):
+        return not self.queue and not self.in_flight
+
+    def close(self):
+        # Replies to writes still in flight must not reach the owner
+        self.drained = None
+        self.dropped = None
+        if self.fd_watch is not None:
+            mainloop.source_remove(self.fd_watch)
+            self.fd_watch = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def stats(self):
+        elapsed = time.monotonic() - self.started if self.started is not None else 0.0
+        return {
+            'mtu': self.mtu,
+            'packets': self.packets,
+            'commands': self.commands,
+            'bytes': self.bytes,
+            'errors': self.errors,
+            'failed_commands': self.failed_commands,
+            'queued': len(self.queue),
+            'in_flight': self.in_flight,
+            'commands_per_second': self.commands / elapsed if elapsed else 0.0,
+        }
@@ -0,0 +1,223 @@
+#!/usr/bin/python3
+
+'''
+Pluggable main loop
+
+Modules schedule timers and fd watches through the functions here so the
+process can run on plain GLib, on asyncio or on Qt, chosen once at startup
+with install(). GLib semantics are used throughout: timer and watch
+callbacks return True to stay installed, timeouts are in ms, and watch
+callbacks are called as callback(fd, condition).
+
+dbus-python always needs its own main loop integration, installed here as
+the default for new bus connections, so install() must run before the
+first dbus.SystemBus() call.
+'''
+
+import os
+
+IO_IN = 1
+IO_OUT = 4
+IO_ERR = 8
+IO_HUP = 16
+
+class GLibLoop(object):
+    name = 'glib'
+
+    def __init__(self):
+        import dbus.mainloop.glib
+        from gi.repository import GLib
+        self.GLib = GLib
+        dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+        self.loop = GLib.MainLoop()
+
+    def timeout_add(self, interval, callback, *args):
+        return self.GLib.timeout_add(interval, callback, *args)
+
+    def io_add_watch(self, fd, condition, callback):
+        return self.GLib.io_add_watch(fd, condition, callback)
+
+    def source_remove(self, source):
+        self.GLib.source_remove(source)
+
+    def signal_add(self, signum, callback):
+        return self.GLib.unix_signal_add(self.GLib.PRIORITY_DEFAULT, signum, callback)
+
+    def run(self):
+        self.loop.run()
+
+    def quit(self):
+        self.loop.quit()
+
+class AsyncioSource(object):
+    __slots__ = ('handle', 'fd', 'condition')
+
+    def __init__(self, fd=None, condition=0):
+        self.handle = None
+        self.fd = fd
+        self.condition = condition
+
+class AsyncioLoop(object):
+    '''
+    asyncio running on the GLib main context, so dbus-python signals and
+    replies are dispatched alongside asyncio tasks. Needs PyGObject 3.50
+    or later for gi.events.
+    '''
+    name = 'asyncio'
+
+    def __init__(self):
+        import asyncio
+        import dbus.mainloop.glib
+        import gi.events
+        asyncio.set_event_loop_policy(gi.events.GLibEventLoopPolicy())
+        dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+        self.loop = asyncio.get_event_loop()
+
+    def timeout_add(self, interval, callback, *args):
+        source = AsyncioSource()
+        def fire():
+            if callback(*args):
+                source.handle = self.loop.call_later(interval / 1000, fire)
+            else:
+                source.handle = None
+        source.handle = self.loop.call_later(interval / 1000, fire)
+        return source
+
+    def io_add_watch(self, fd, condition, callback):
+        source = AsyncioSource(fd, condition)
+        def ready(condition):
+            if not callback(fd, condition):
+                self.source_remove(source)
+        if condition & (IO_IN | IO_HUP | IO_ERR):
+            self.loop.add_reader(fd, ready, IO_IN)
+        if condition & IO_OUT:
+            self.loop.add_writer(fd, ready, IO_OUT)
+        return source
+
+    def source_remove(self, source):
+        if source.fd is not None:
+            if source.condition & (IO_IN | IO_HUP | IO_ERR):
+                self.loop.remove_reader(source.fd)
+            if source.condition & IO_OUT:
+                self.loop.remove_writer(source.fd)
+            source.fd = None
+        elif source.handle is not None:
+            source.handle.cancel()
+            source.handle = None
+
+    def signal_add(self, signum, callback):
+        self.loop.add_signal_handler(signum, callback)
+
+    def run(self):
+        self.loop.run_forever()
+
+    def quit(self):
+        self.loop.stop()
+
+class QtLoop(object):
+    name = 'qt'
+
+    def __init__(self):
+        import sys
+        import dbus.mainloop.pyqt5
+        from PyQt5 import QtCore
+        self.QtCore = QtCore
+        dbus.mainloop.pyqt5.DBusQtMainLoop(set_as_default=True)
+        self.app = QtCore.QCoreApplication.instance() or QtCore.QCoreApplication(sys.argv)
+        self.wakeup = None
+
+    def timeout_add(self, interval, callback, *args):
+        timer = self.QtCore.QTimer()
+        def fire():
+            if not callback(*args):
+                timer.stop()
+        timer.timeout.connect(fire)
+        timer.start(interval)
+        return timer
+
+    def io_add_watch(self, fd, condition, callback):
+        notifiers = []
+        def ready(condition):
+            if not callback(fd, condition):
+                self.source_remove(notifiers)
+        if condition & (IO_IN | IO_HUP | IO_ERR):
+            notifiers.append(self.QtCore.QSocketNotifier(fd, self.QtCore.QSocketNotifier.Read))
+            notifiers[-1].activated.connect(lambda _: ready(IO_IN))
+        if condition & IO_OUT:
+            notifiers.append(self.QtCore.QSocketNotifier(fd, self.QtCore.QSocketNotifier.Write))
+            notifiers[-1].activated.connect(lambda _: ready(IO_OUT))
+        return notifiers
+
+    def source_remove(self, source):
+        if isinstance(source, list):
+            for notifier in source:
+                notifier.setEnabled(False)
+            source.clear()
+        else:
+            source.stop()
+
+    def signal_add(self, signum, callback):
+        import signal
+        signal.signal(signum, lambda signum, frame: callback())
+        # Python signal handlers only run once the interpreter gets control
+        # back from Qt
+        if self.wakeup is None:
+            self.wakeup = self.timeout_add(200, lambda: True)
+
+    def run(self):
+        self.app.exec_()
+
+    def quit(self):
+        self.app.quit()
+
+backends = {
+    'glib': GLibLoop,
+    'asyncio': AsyncioLoop,
+    'qt': QtLoop,
+}
+
+loop = None
+
+def install(name=None):
+    '''
+    Select the main loop backend
+
+    :param str name: 'glib', 'asyncio' or 'qt'. Defaults to the
+    DROID_MAINLOOP environment variable, then 'glib'.
+    '''
+    global loop
+    if loop is not None:
+        if name is not None and loop.name != name:
+            raise Exception(f'Main loop {loop.name} already installed')
+        return loop
+    name = name or os.environ.get('DROID_MAINLOOP', 'glib')
+    if name not in backends:
+        raise Exception(f'Unknown main loop {name}, expected one of {", ".join(backends)}')
+    loop = backends[name]()
+    return loop
+
+def get():
+    return loop if loop is not None else install()
+
+def timeout_add(interval, callback, *args):
+    return get().timeout_add(interval, callback, *args)
+
+def io_add_watch(fd, condition, callback):
+    if not isinstance(fd, int):
+        fd = fd.fileno()
+    return get().io_add_watch(fd, condition, callback)
+
+def source_remove(source):
+    get().source_remove(source)
+
+def signal_add(signum, callback):
+    '''
+    Call callback() from the main loop when the process receives signum
+    '''
+    get().signal_add(signum, callback)
+
+def run():
+    get().run()
+
+def quit():
+    get().quit()
@@ -0,0 +1,161 @@
+#!/usr/bin/python3
+
+'''
+Latency histograms for the discovery to activation path
+
+A droid's activation passes through these stages, each marked with the
+droid's address as key:
+
+    discovered  first 0x03 advertisement handled by DroidDiscovery
+    activate    dBeacon.add_droid_depot_activate called for it
+    published   the advertisement carrying the activation handed to
+                RegisterAdvertisement
+    registered  the RegisterAdvertisement reply arrived
+
+Intervals between stages are collected in the histograms below, and
+exported in the Prometheus text format by export() or as a dict for the
+control socket by snapshot().
+
+With bay.py --workers, advertisements are handled in the worker
+processes, so advertisement_handling stays empty in the coordinator, and
+discovered is marked when the coordinator polls the worker's table, up to
+the poll interval (100ms) after the advertisement arrived.
+'''
+
+import bisect
+import collections
+import os
+import time
+
+import droidstate
+
+clock = time.perf_counter
+
+# Bucket upper bounds in seconds, 1ms to 60s
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+MAX_KEYS = 4096
+
+class Histogram(object):
+    __slots__ = ('name', 'help', 'buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, name, help, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        '''
+        Estimate a quantile as the upper bound of the bucket holding it
+        '''
+        if not self.count:
+            return None
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return float('inf')
+
+    def export(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {total}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f'{self.name}_sum {self.sum}')
+        lines.append(f'{self.name}_count {self.count}')
+        return '\n'.join(lines)
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.sum / self.count if self.count else None,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+        }
+
+histograms = collections.OrderedDict()
+
+def histogram(name, help):
+    ret = histograms.get(name)
+    if ret is None:
+        ret = histograms[name] = Histogram(name, help)
+    return ret
+
+advertisement_handling = histogram('droid_advertisement_handling_seconds',
+                                   'Time to handle one advertisement in DroidDiscovery')
+advertisement_register = histogram('advertisement_register_seconds',
+                                   'RegisterAdvertisement call to reply')
+spans = {
+    ('discovered', 'activate'): histogram('droid_discovered_to_activate_seconds',
+                                          'First droid advertisement to add_droid_depot_activate'),
+    ('activate', 'published'): histogram('droid_activate_to_published_seconds',
+                                         'add_droid_depot_activate to RegisterAdvertisement call'),
+    ('published', 'registered'): histogram('droid_published_to_registered_seconds',
+                                           'RegisterAdvertisement call to reply for activations'),
+    ('activate', 'registered'): histogram('droid_activate_to_registered_seconds',
+                                          'add_droid_depot_activate to RegisterAdvertisement reply'),
+    ('discovered', 'registered'): histogram('droid_discovered_to_registered_seconds',
+                                            'First droid advertisement to RegisterAdvertisement reply'),
+}
+ends = collections.defaultdict(list)
+for start, end in spans:
+    ends[end].append(start)
+
+marks = collections.OrderedDict()
+
+def mark(key, stage, now=None):
+    '''
+    Record that key reached a stage and observe the spans ending there
+
+    :param str key: Droid address, upper case with colons
+    '''
+    now = clock() if now is None else now
+    stages = marks.get(key)
+    if stages is None:
+        stages = marks[key] = {}
+        if len(marks) > MAX_KEYS:
+            marks.popitem(last=False)
+    for start in ends.get(stage, ()):
+        then = stages.get(start)
+        if then is not None:
+            spans[start, stage].observe(now - then)
+    stages[stage] = now
+    if stage == 'registered':
+        # The activation is complete, start over on the next one but keep
+        # when the droid was discovered
+        for name in ('activate', 'published', 'registered'):
+            stages.pop(name, None)
+
+def forget(key):
+    marks.pop(key, None)
+
+mac_key = droidstate.mac_str
+
+def export():
+    '''
+    :return: All histograms in the Prometheus text exposition format
+    :rtype: str
+    '''
+    return '\n'.join(histogram.export() for histogram in histograms.values()) + '\n'
+
+def write(path):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(export())
+    os.replace(tmp, path)
+
+def snapshot():
+    return {name: histogram.as_dict() for name, histogram in histograms.items()}
@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+
+import time
+import dbus
+import mainloop
+
+import beacon
+import dbeacon
+
+def available_instances(manager):
+    '''
+    Number of advertising instances the adapter has free, including those
+    registered by other processes
+
+    :param gatt.DeviceManager manager: Manager for the adapter
+    '''
+    adapter_object = manager._bus.get_object('org.bluez', '/org/bluez/' + manager.adapter_name)
+    properties = dbus.Interface(adapter_object, beacon.DBUS_PROP_IFACE)
+    props = properties.GetAll('org.bluez.LEAdvertisingManager1')
+    return max(0, int(props['SupportedInstances']) - int(props.get('ActiveInstances', 0)))
+
+class Payload(object):
+    __slots__ = ('name', 'beacon', 'duty', 'dwell', 'airtime', 'on_air_since', 'slot', 'turns')
+
+    def __init__(self, name, beacon, duty, dwell):
+        self.name = name
+        self.beacon = beacon
+        self.duty = duty
+        self.dwell = dwell
+        self.airtime = 0.0
+        self.on_air_since = None
+        self.slot = None
+        self.turns = 0
+
+class Slot(object):
+    __slots__ = ('index', 'beacon', 'payload', 'timer')
+
+    def __init__(self, index, beacon):
+        self.index = index
+        self.beacon = beacon
+        self.payload = None
+        self.timer = None
+
+class AdvertisingMultiplexer(object):
+    '''
+    Rotate more dBeacon payloads than the adapter has advertising instances
+
+    Each instance is a slot. When a payload's dwell time in a slot expires
+    the slot is given to the payload furthest behind its duty cycle that is
+    not already on air in another slot. On-air time is counted from the
+    BlueZ RegisterAdvertisement reply until the payload is swapped out.
+    '''
+    def __init__(self, manager, instances=None, first_index=0):
+        '''
+        :param gatt.DeviceManager manager: Manager for the adapter
+        :param int instances: Number of advertising instances to use,
+        defaults to all available instances
+        :param int first_index: Advertisement index of the first slot
+        '''
+        if instances is None:
+            instances = available_instances(manager)
+        if instances < 1:
+            raise Exception('No advertising instances available')
+        self.slots = [Slot(i, dbeacon.dBeacon(manager, first_index + i)) for i in range(instances)]
+        self.payloads = {}
+        self.started = None
+        self.running = False
+
+    def add(self, name, payload, duty=1.0, dwell=500):
+        '''
+        Add a payload to the rotation
+
+        :param str name: Name used to report on-air time
+        :param dBeacon payload: Unregistered dBeacon holding the payload
+        :param float duty: Requested fraction of time on air, 0-1. If the
+        total of all duty cycles exceeds the slot count, each payload gets a
+        proportional share.
+        :param int dwell: Time in ms the payload stays on air per turn
+        '''
+        if not 0 < duty <= 1:
+            raise Exception('Duty cycle must be in (0, 1]')
+        self.payloads[name] = Payload(name, payload, duty, dwell)
+        if self.running:
+            for slot in self.slots:
+                if slot.payload is None:
+                    self.rotate(slot)
+
+    def remove(self, name):
+        payload = self.payloads.pop(name)
+        if payload.slot is not None:
+            self.rotate(payload.slot)
+
+    def start(self):
+        self.started = time.monotonic()
+        self.running = True
+        for slot in self.slots:
+            self.rotate(slot)
+
+    def stop(self):
+        self.running = False
+        for slot in self.slots:
+            if slot.timer is not None:
+                mainloop.source_remove(slot.timer)
+                slot.timer = None
+            self.vacate(slot)
+            slot.beacon.unregister()
+
+    def deficit(self, payload, now):
+        demand = sum(p.duty for p in self.payloads.values())
+        scale = min(1.0, len(self.slots) / demand)
+        airtime = payload.airtime
+        if payload.on_air_since is not None:
+            airtime += now - payload.on_air_since
+        return payload.duty * scale * (now - self.started) - airtime
+
+    def vacate(self, slot):
+        payload = slot.payload
+        if payload is None:
+            return
+        if payload.on_air_since is not None:
+            payload.airtime += time.monotonic() - payload.on_air_since
+            payload.on_air_since = None
+        payload.slot = None
+        slot.payload = None
+
+    def rotate(self, slot):
+        if slot.timer is not None:
+            mainloop.source_remove(slot.timer)
+            slot.timer = None
+        now = time.monotonic()
+        candidates = [p for p in self.payloads.values() if p.slot is None or p.slot is slot]
+        best = max(candidates, key=lambda p: self.deficit(p, now), default=None)
+        if best is not None and self.deficit(best, now) <= 0:
+            # Every payload that could use this slot is at or ahead of its duty cycle
+            best = None
+
+        if best is None:
+            self.vacate(slot)
+            slot.beacon.unregister()
+            slot.timer = mainloop.timeout_add(min((p.dwell for p in self.payloads.values()), default=500), self.expired, slot)
+            return
+
+        if best is not slot.payload:
+            self.vacate(slot)
+            best.slot = slot
+            best.turns += 1
+            slot.payload = best
+            try:
+                slot.beacon.load(best.beacon)
+            except dbus.exceptions.DBusException as e:
+                # BlueZ dropped the instance, register it again below
+                print(f'Failed to refresh multiplexed advertisement {slot.index}: {e}')
+                slot.beacon.running = False
+        if not slot.beacon.running:
+            slot.beacon.register(lambda: self.on_air(slot), lambda error: self.register_failed(slot, error))
+        slot.timer = mainloop.timeout_add(best.dwell, self.expired, slot)
+
+    def expired(self, slot):
+        slot.timer = None
+        if self.running:
+            self.rotate(slot)
+        return False
+
+    def on_air(self, slot):
+        payload = slot.payload
+        if payload is not None and payload.on_air_since is None:
+            payload.on_air_since = time.monotonic()
+
+    def register_failed(self, slot, error):
+        print(f'Failed to register multiplexed advertisement {slot.index}: {error}')
+        # Nothing is registered, so the next rotation registers again
+        slot.beacon.running = False
+        if slot.payload is not None:
+            self.vacate(slot)
+
+    def airtime(self):
+        '''
+        Report on-air time of each payload
+
+        :return: name -> dict with seconds on air, fraction of elapsed time
+        on air, requested duty cycle and number of turns
+        :rtype: dict
+        '''
+        now = time.monotonic()
+        elapsed = now - self.started if self.started is not None else 0.0
+        ret = {}
+        for name, payload in self.payloads.items():
+            airtime = payload.airtime
+            if payload.on_air_since is not None:
+                airtime += now - payload.on_air_since
+            ret[name] = {
+                'seconds': airtime,
+                'share': airtime / elapsed if elapsed else 0.0,
+                'duty': payload.duty,
+                'turns': payload.turns,
+            }
+        return ret
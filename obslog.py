@@ -0,0 +1,302 @@
+#!/usr/bin/python3
+
+'''
+Append-only log of droid observations
+
+The log is a header followed by fixed size records, so record n lives at
+HEADER_SIZE + n * RECORD_SIZE and never straddles a page:
+
+    header  <8sIII    magic, version, record size, index bucket seconds
+    record  <d6sbBBBBBH10x
+            timestamp (time.time()), MAC, advertisement RSSI, the droid
+            record as packed by droidstate
+
+A sidecar file, the log path plus '.idx', holds one <6sxxII entry (MAC,
+time bucket, page) the first time a droid is logged in each page of the
+log during each bucket. Queries by MAC and time read the index and then
+only the pages it names through a memory map of the log. Index entries
+are written after the records they name, so on reopening a log the
+records from the last indexed page on are indexed again.
+
+ObservationWriter packs records on the caller's thread and leaves the
+file writes and indexing to a background thread.
+'''
+
+import argparse
+import collections
+import datetime
+import mmap
+import os
+import struct
+import threading
+import time
+
+import droidstate
+
+MAGIC = b'DROIDOBS'
+VERSION = 2
+HEADER_SIZE = 32
+RECORD_SIZE = 32
+PAGE_SIZE = mmap.PAGESIZE
+
+_header = struct.Struct('<8sIII')
+_record = struct.Struct('<d6sb' + droidstate.RECORD_FORMAT + '10x')
+_index = struct.Struct('<6sxxII')
+
+Observation = collections.namedtuple('Observation', ('timestamp', 'mac', 'rssi', 'droid_id', 'bay', 'paired',
+                                                     'action78', 'battery_low', 'affiliation', 'personalityChip',
+                                                     'record_rssi'))
+
+def page_of(n):
+    return (HEADER_SIZE + n * RECORD_SIZE) // PAGE_SIZE
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        magic, version, record_size, bucket = _header.unpack(f.read(_header.size))
+    if magic != MAGIC or version != VERSION or record_size != RECORD_SIZE:
+        raise Exception(f'{path} is not a droid observation log')
+    return bucket
+
+class ObservationWriter(object):
+    '''
+    :param str path: Log file, appended to if it exists
+    :param int bucket: Seconds per index time bucket, for new logs
+    :param float interval: Seconds between background flushes
+    :param int buffer_size: Bytes of pending records that trigger an
+    early flush
+    '''
+    def __init__(self, path, bucket=3600, interval=1.0, buffer_size=65536):
+        self.path = path
+        self.interval = interval
+        self.buffer_size = buffer_size
+        if os.path.exists(path) and os.path.getsize(path) >= HEADER_SIZE:
+            self.bucket = read_header(path)
+            # Drop a record torn by a crash
+            size = os.path.getsize(path)
+            os.truncate(path, size - (size - HEADER_SIZE) % RECORD_SIZE)
+            self.f = open(path, 'ab')
+        else:
+            self.bucket = bucket
+            self.f = open(path, 'wb')
+            self.f.write(_header.pack(MAGIC, VERSION, RECORD_SIZE, bucket).ljust(HEADER_SIZE, b'\0'))
+            if os.path.exists(path + '.idx'):
+                os.truncate(path + '.idx', 0)
+        # Records up to self.records are indexed, self.indexed holds the
+        # (MAC, bucket) keys already indexed in self.page
+        self.records = 0
+        self.page = None
+        self.indexed = set()
+        self.index = open(path + '.idx', 'ab')
+        self.reindex()
+        self.pending = bytearray()
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.closed = False
+        self.written = 0
+        self.flushes = 0
+        self.thread = threading.Thread(target=self.run, name='obslog', daemon=True)
+        self.thread.start()
+
+    def write(self, mac, record, rssi, timestamp=None):
+        '''
+        Queue an observation
+
+        :param str mac: Droid address
+        :param record: Decoded 0x03 droid record
+        :param int rssi: RSSI of the advertisement
+        '''
+        packed = _record.pack(time.time() if timestamp is None else timestamp, droidstate.mac_bytes(mac),
+                              droidstate.rssi_byte(rssi), *droidstate.pack_record(record))
+        with self.lock:
+            self.pending += packed
+            full = len(self.pending) >= self.buffer_size
+        if full:
+            self.wake.set()
+
+    def observer(self, entry):
+        '''
+        DroidDiscovery listener logging every droid advertisement
+        '''
+        self.write(entry.mac, entry.record, entry.rssi[-1] if entry.rssi else None)
+
+    def run(self):
+        while not self.closed:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            buf, self.pending = self.pending, bytearray()
+        if not buf:
+            return
+        self.f.write(buf)
+        self.f.flush()
+        self.index_records(buf)
+        self.written += len(buf) // RECORD_SIZE
+        self.flushes += 1
+
+    def reindex(self):
+        '''
+        Index the records of a reopened log written after the last index
+        entry, starting over at the last indexed page
+        '''
+        size = self.index.tell()
+        size -= size % _index.size
+        os.truncate(self.path + '.idx', size)
+        if size:
+            with open(self.path + '.idx', 'rb') as f:
+                f.seek(size - _index.size)
+                self.page = _index.unpack(f.read(_index.size))[2]
+                # Keys of the last page sit at the end of the index
+                f.seek(max(0, size - PAGE_SIZE // RECORD_SIZE * _index.size))
+                for mac, bucket, page in _index.iter_unpack(f.read()):
+                    if page == self.page:
+                        self.indexed.add((mac, bucket))
+            self.records = max(0, (self.page * PAGE_SIZE - HEADER_SIZE + RECORD_SIZE - 1) // RECORD_SIZE)
+        with open(self.path, 'rb') as f:
+            f.seek(HEADER_SIZE + self.records * RECORD_SIZE)
+            self.index_records(f.read())
+
+    def index_records(self, buf):
+        '''
+        Add index entries for records appended to the log
+        '''
+        entries = bytearray()
+        for offset in range(0, len(buf), RECORD_SIZE):
+            page = page_of(self.records)
+            if page != self.page:
+                self.page = page
+                self.indexed.clear()
+            timestamp, mac = _record.unpack_from(buf, offset)[:2]
+            key = (mac, int(timestamp // self.bucket))
+            if key not in self.indexed:
+                self.indexed.add(key)
+                entries += _index.pack(mac, key[1], page)
+            self.records += 1
+        # The index only names records already written
+        self.index.write(entries)
+        self.index.flush()
+
+    def close(self):
+        self.closed = True
+        self.wake.set()
+        self.thread.join()
+        self.flush()
+        self.f.close()
+        self.index.close()
+
+    def stats(self):
+        return {'records': self.records, 'written': self.written, 'flushes': self.flushes,
+                'pending': len(self.pending) // RECORD_SIZE}
+
+class ObservationLog(object):
+    '''
+    Memory mapped reader of a log, reflecting it as of opening or the last
+    refresh()
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.bucket = read_header(path)
+        self.f = open(path, 'rb')
+        self.mm = None
+        self.index_offset = 0
+        self.by_mac = collections.defaultdict(lambda: collections.defaultdict(set))
+        self.by_bucket = collections.defaultdict(set)
+        self.refresh()
+
+    def refresh(self):
+        if self.mm is not None:
+            self.mm.close()
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.records = (len(self.mm) - HEADER_SIZE) // RECORD_SIZE
+        try:
+            with open(self.path + '.idx', 'rb') as f:
+                f.seek(self.index_offset)
+                buf = f.read()
+        except FileNotFoundError:
+            buf = b''
+        buf = buf[:len(buf) - len(buf) % _index.size]
+        self.index_offset += len(buf)
+        for mac, bucket, page in _index.iter_unpack(buf):
+            self.by_mac[mac][bucket].add(page)
+            self.by_bucket[bucket].add(page)
+
+    def close(self):
+        self.mm.close()
+        self.f.close()
+
+    def __len__(self):
+        return self.records
+
+    def pages(self, mac=None, start=None, end=None):
+        '''
+        :return: Sorted pages of the log that may hold matching records
+        '''
+        buckets = self.by_mac.get(droidstate.mac_bytes(mac), {}) if mac is not None else self.by_bucket
+        first = None if start is None else int(start // self.bucket)
+        last = None if end is None else int(end // self.bucket)
+        ret = set()
+        for bucket, pages in buckets.items():
+            if (first is None or bucket >= first) and (last is None or bucket <= last):
+                ret |= pages
+        return sorted(ret)
+
+    def page_records(self, page):
+        first = max(0, (page * PAGE_SIZE - HEADER_SIZE + RECORD_SIZE - 1) // RECORD_SIZE)
+        last = min(self.records, ((page + 1) * PAGE_SIZE - HEADER_SIZE) // RECORD_SIZE)
+        return range(first, last)
+
+    def query(self, mac=None, start=None, end=None):
+        '''
+        Observations of a droid and/or within a time range, in log order
+
+        :param str mac: Droid address
+        :param float start: Earliest timestamp, inclusive
+        :param float end: Latest timestamp, exclusive
+        :return: Generator of Observation
+        '''
+        raw = None if mac is None else droidstate.mac_bytes(mac)
+        for page in self.pages(mac, start, end):
+            for n in self.page_records(page):
+                fields = _record.unpack_from(self.mm, HEADER_SIZE + n * RECORD_SIZE)
+                timestamp, record_mac = fields[:2]
+                if raw is not None and record_mac != raw:
+                    continue
+                if (start is not None and timestamp < start) or (end is not None and timestamp >= end):
+                    continue
+                yield self.decode(fields)
+
+    @staticmethod
+    def decode(fields):
+        timestamp, mac, rssi = fields[:3]
+        record = droidstate.unpack_record(*fields[3:])
+        return Observation(timestamp, droidstate.mac_str(mac), droidstate.rssi_value(rssi), record.droid_id,
+                           record.bay, record.paired, record.action78, record.battery_low, record.affiliation,
+                           record.personalityChip, record.rssi)
+
+    def __iter__(self):
+        for n in range(self.records):
+            yield self.decode(_record.unpack_from(self.mm, HEADER_SIZE + n * RECORD_SIZE))
+
+def main():
+    parser = argparse.ArgumentParser(description='Query a droid observation log')
+    parser.add_argument('path')
+    parser.add_argument('--mac', help='Droid address')
+    parser.add_argument('--today', action='store_true', help='Only observations since midnight')
+    parser.add_argument('--start', type=float, help='Earliest timestamp, seconds since the epoch')
+    parser.add_argument('--end', type=float, help='Latest timestamp, seconds since the epoch')
+    args = parser.parse_args()
+
+    start = args.start
+    if args.today:
+        start = datetime.datetime.combine(datetime.date.today(), datetime.time()).timestamp()
+    log = ObservationLog(args.path)
+    for observation in log.query(args.mac, start, args.end):
+        print(f'{datetime.datetime.fromtimestamp(observation.timestamp):%Y-%m-%d %H:%M:%S.%f}',
+              observation.mac, observation.rssi, f'bay={observation.bay}', f'paired={observation.paired}',
+              f'personality={observation.personalityChip}', f'affiliation={observation.affiliation}')
+    log.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+
+import collections
+
+import dbeacon
+
+class ParseCache(object):
+    '''
+    Bounded LRU cache of decoded advertisements
+
+    Droids repeat the same manufacturer data many times a second. Entries
+    are keyed by (MAC, raw payload) so a repeated advertisement returns the
+    records decoded the first time, and the last payload seen from each MAC
+    is tracked so callers can skip work when nothing changed.
+    '''
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.latest = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, mac, payload):
+        '''
+        Decode a payload, reusing a previous decode if possible
+
+        The returned records are shared between callers and must not be
+        modified.
+
+        :param str mac: Address of the advertising device
+        :param bytes payload: MFG_ID_DISNEY manufacturer data
+        :return: (records from dbeacon.parse, changed) where changed is False
+        if payload is the same as the last one seen from mac
+        :rtype: tuple
+        '''
+        key = (mac, payload)
+        beacons = self.entries.get(key)
+        if beacons is None:
+            self.misses += 1
+            beacons = dbeacon.parse(payload)
+            self.entries[key] = beacons
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+
+        changed = self.latest.get(mac) != payload
+        self.latest[mac] = payload
+        self.latest.move_to_end(mac)
+        if len(self.latest) > self.maxsize:
+            self.latest.popitem(last=False)
+        return beacons, changed
+
+    def clear(self):
+        self.entries.clear()
+        self.latest.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
@@ -1,119 +1,85 @@
 #!/usr/bin/python3
 
 import struct
-import collections
 
-def parse_cmd(data, cmd, cmds):
-    if cmd in cmds:
-        a = cmds[cmd]
-        args = {'cmd': a[0]}
-        result = collections.namedtuple('nm', a[1])
-        if a[2]:
-            sz = struct.calcsize(a[2])
-            data, remainder = data[:sz], data[sz:]
-            new_args = result._asdict(result._make(struct.unpack(a[2], data)))
-            if a[3] is not None:
-                a[3](new_args, remainder)
-            args.update(new_args)
-        else:
-            remainder = data
-    else:
-        print(cmd, 'not in', cmds)
-        args = {'cmd': cmd, 'data': data}
-        remainder = bytearray()
-    data[:] = remainder
-    return args
-
-def motor_fixup(args, data):
-    args['reverse'] = (args['id'] & 0x80) != 0
-    args['id'] &= ~0x80
-
-cycle_led_cmds = {
-    0x01: ('LED Mono Ramp', 'id ramp_time end_value', '>BHB', None),
-    0x02: ('LED Mono Flash', 'id high_period low_period flashes high_value low_value', '>BHHBBB', None),
-    0x03: ('LED Mono Pulse', 'id ramp_time cycles high_value low_value', '>BHBBB', None),
-    0x04: ('LED RGB Ramp', 'id ramp_time r g b', '>BHBBB', None),
-    0x05: ('LED RGB Flash', 'id high_period low_period flashes sr sg sb er eg eb', '>BHHBBBBBBB', None),
-    0x06: ('LED RGB Pulse', 'id ramp_time cycles vr vg vb dr dg db', '>BHBBBBBBB', None),
-}
-
-def cycle_led_sub(args, data):
-    new_args = parse_cmd(data, args['cmd'], cycle_led_cmds)
-    args.clear()
-    args.update(new_args)
-
-def fixup_rotate_head1(args, data):
-    args['reverse'] = (args['flags'] & 0x80) != 0
-    del args['flags']
-
-def fixup_rotate_head2(args, data):
-    args['value'] = 255
-    args['ramp_time'] = 0
-    fixup_rotate_head1(args, data)
-
-def fixup_fwdrev(args, data):
-    args['reverse'] = (args['flags'] & 0x80) != 0
-    if (args['flags'] & 0x01) == 0:
-        args['value'] = 'default'
-    del args['flags']
-
-custom_cmds = {
-    0x44: {
-        0x00: ('Serial Write', 'reg value', '>BB', None),
-        0x01: ('Center R2 Head', 'value start_timer', '>BB', None),
-        0x02: ('Rotate R2 Head1', 'flags value ramp_time delay', '>BBHH', fixup_rotate_head1),
-        0x03: ('Rotate R2 Head2', 'flags delay', '>BB', fixup_rotate_head2),
-        0x04: ('BB8 Rotate', 'flags value ramp_time delay', '>BBHH', fixup_rotate_head1),
-        0x05: ('Drive Fwd/Rev', 'flags value ramp_time delay', '>BBHH', fixup_fwdrev),
-    }
-}
-
-def custom_cmd(args, data):
-    if args['custom_id'] in custom_cmds:
-        new_args = parse_cmd(data, args['cmd'], custom_cmds[args['custom_id']])
-    else:
-        new_args = {'custom_id': args['custom_id'], 'data': data.copy()}
-        data[:] = bytearray()
-    args.clear()
-    args.update(new_args)
-
-droid_cmds = {
-    0x01: ('ID', '', None, None),
-    0x02: ('Mono LED', 'id brightness', '>BB', None),
-    0x03: ('RGB LED', 'id r g b', '>BBBB', None),
-    0x04: ('Cycle LED', 'cmd', '>B', cycle_led_cmds),
-    0x05: ('Motor', 'id value ramp_time', '>BBH', motor_fixup),
-    0x06: ('No action', '', None, None),
-    0x0c: ('Script', 'entry action', '>BB', None),
-    0x0d: ('Delay', 'delay', '>H', None),
-    0x0f: ('Custom', 'custom_id cmd', '>BB', custom_cmd),
-}
-
-def parse(b):
-    c, b = b[:3], b[3:]
-    entry_type, entry_len, sum = struct.unpack('<BBB', c)
+import commands
+
+_entry_hdr = struct.Struct('<BBBB')
+_cmd_hdr = struct.Struct('<BB')
+
+ENTRY_HEADER_LEN = 3
+
+def iter_cmds(buf, offset=0, end=None):
+    '''
+    Decode the commands of a script entry as they are read
+
+    :param bytes buf: Buffer holding the entry's commands
+    :param int offset: Start of the first command header
+    :param int end: End of the entry, defaults to the end of buf
+    :return: Iterator of decoded command dicts
+    '''
+    mv = memoryview(buf)
+    if end is None:
+        end = len(mv)
+    while end - offset >= 2:
+        cmd, l = _cmd_hdr.unpack_from(mv, offset)
+        offset += 2
+        if (l & 0x40) == 0:
+            break
+        cmd_end = min(offset + (l & 0x1f), end)
+        yield commands.decode(cmd, mv, offset, cmd_end)
+        offset = cmd_end
+
+def parse_header(buf, offset=0):
+    '''
+    :return: (entry_id, entry_len) of the entry at offset
+    '''
+    entry_type, entry_len, sum, entry_id = _entry_hdr.unpack_from(buf, offset)
     if entry_type != 1:
         raise Exception('Unexpected entry type:', entry_type)
+    return entry_id, entry_len
 
-    c, b = b[:1], b[1:]
-    entry_id, = struct.unpack('<B', c)
-
-    cmds = []
+def check_length(entry_len):
+    # The length counts the entry id
+    if entry_len < _entry_hdr.size - ENTRY_HEADER_LEN:
+        raise ValueError(f'Script entry length {entry_len} too short')
 
-    while len(b) >= 2:
-        c, b = b[:2], b[2:]
-        cmd, l = struct.unpack('<BB', c)
-        present = (l & 0x40) != 0
-        l &= 0x1f
-
-        if not present:
-            break
-
-        cmd_data, b = b[:l], b[l:]
-        args = parse_cmd(cmd_data, cmd, droid_cmds)
-        cmds.append(args)
-
-    return cmds
+def parse(b):
+    entry_id, entry_len = parse_header(b)
+    return list(iter_cmds(b, _entry_hdr.size))
+
+def iter_entries(b):
+    '''
+    Decode a dump of back to back script entries
+
+    :param bytes b: Entry dump
+    :return: Iterator of (entry_id, iterator of command dicts)
+    '''
+    offset = 0
+    while len(b) - offset >= _entry_hdr.size:
+        entry_id, entry_len = parse_header(b, offset)
+        check_length(entry_len)
+        end = min(offset + ENTRY_HEADER_LEN + entry_len, len(b))
+        yield entry_id, iter_cmds(b, offset + _entry_hdr.size, end)
+        offset = end
+
+def read_entries(f):
+    '''
+    Decode script entries from a binary file one entry at a time
+
+    :param file f: File positioned at the start of an entry dump
+    :return: Iterator of (entry_id, iterator of command dicts)
+    '''
+    while True:
+        hdr = f.read(ENTRY_HEADER_LEN)
+        if len(hdr) < ENTRY_HEADER_LEN:
+            return
+        check_length(hdr[1])
+        entry = hdr + f.read(hdr[1])
+        if len(entry) < ENTRY_HEADER_LEN + hdr[1]:
+            raise ValueError('Truncated script entry')
+        entry_id, entry_len = parse_header(entry)
+        yield entry_id, iter_cmds(entry, _entry_hdr.size)
 
 entries = {
     1: '015700010f444401a0010f44440010040f44440300140f48440200820028014a0f4844020000002800280f44440380140f48440280820028015e0f48440280ff0028012c0f48440200ff0050026c0f444401ff01054402000028',
@@ -137,8 +103,8 @@ entries = {
     19: '012b00130544002000000544012000000f48440501dc019000fa0f484405000002ee00fa0f48440501dc01900000',
 }
 
-for id, entry in entries.items():
-    print('Entry', id)
-    cmds = parse(bytearray.fromhex(entry))
-    for cmd in cmds:
-        print(cmd)
+if __name__ == '__main__':
+    for id, entry in entries.items():
+        print('Entry', id)
+        for cmd in iter_cmds(bytes.fromhex(entry), _entry_hdr.size):
+            print(cmd)
@@ -0,0 +1,208 @@
+#!/usr/bin/python3
+
+import collections
+import time
+
+import droidstate
+
+IDLE = 'idle'
+PAIRING = 'pairing'
+ACTIVATING = 'activating'
+
+class DroidEntry(object):
+    '''
+    Last known state of one droid
+
+    :param str mac: Droid address, upper case
+
+    adapters maps the name of each adapter the droid was seen on to the
+    RSSI and time of its last advertisement there.
+    '''
+    __slots__ = ('mac', 'record', 'bay', 'paired', 'rssi', 'first_seen', 'last_seen', 'state', 'adapters')
+
+    def __init__(self, mac, history, now):
+        self.mac = mac
+        self.record = None
+        self.bay = None
+        self.paired = None
+        self.rssi = collections.deque(maxlen=history)
+        self.first_seen = now
+        self.last_seen = now
+        self.state = IDLE
+        self.adapters = {}
+
+    @property
+    def addr(self):
+        return bytearray(droidstate.mac_bytes(self.mac))
+
+    def as_dict(self, now):
+        ret = {'mac': self.mac, 'age': round(now - self.last_seen, 1), 'state': self.state,
+               'rssi_history': list(self.rssi)}
+        if self.adapters:
+            ret['adapters'] = {name: rssi for name, (rssi, seen) in self.adapters.items()}
+        if self.record is not None:
+            ret.update((field, self.record[field]) for field in self.record.fields)
+        return ret
+
+class DroidRegistry(object):
+    '''
+    Droids seen by discovery, keyed by MAC address
+
+    Entries are also indexed by the bay and paired fields of their last
+    0x03 droid record. Entries are kept in last seen order so those not
+    seen for max_age seconds are evicted from the front on each update.
+
+    :param float max_age: Seconds after which an unseen droid is dropped
+    :param int history: Number of RSSI readings kept per droid
+
+    Callables in evicted are called with each entry dropped for age.
+    '''
+    def __init__(self, max_age=300, history=16, clock=time.monotonic):
+        self.max_age = max_age
+        self.history = history
+        self.clock = clock
+        self.entries = collections.OrderedDict()
+        self.by_bay = collections.defaultdict(collections.OrderedDict)
+        self.by_paired = {True: collections.OrderedDict(), False: collections.OrderedDict()}
+        self.evictions = 0
+        self.evicted = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries.values())
+
+    def __contains__(self, mac):
+        return mac.upper() in self.entries
+
+    def get(self, mac):
+        return self.entries.get(mac.upper())
+
+    def unindex(self, entry):
+        if entry.bay is not None:
+            bay = self.by_bay[entry.bay]
+            bay.pop(entry.mac, None)
+            if not bay:
+                del self.by_bay[entry.bay]
+        if entry.paired is not None:
+            self.by_paired[entry.paired].pop(entry.mac, None)
+
+    def update(self, mac, record, rssi=None, now=None, adapter=None):
+        '''
+        Record a sighting of a droid
+
+        :param str mac: Droid address
+        :param DroidRecord record: Decoded 0x03 droid record
+        :param int rssi: Received signal strength of the advertisement, the
+        rssi field of the record is used if not given
+        :param str adapter: Name of the adapter that received it
+        :rtype: DroidEntry
+        '''
+        now = self.clock() if now is None else now
+        mac = mac.upper()
+        entry = self.entries.get(mac)
+        if entry is None:
+            entry = self.entries[mac] = DroidEntry(mac, self.history, now)
+        else:
+            self.entries.move_to_end(mac)
+        entry.last_seen = now
+        rssi = record['rssi'] if rssi is None else rssi
+        entry.rssi.append(rssi)
+        if adapter is not None:
+            entry.adapters[adapter] = (rssi, now)
+        if entry.record is None or entry.bay != record['bay'] or entry.paired != record['paired']:
+            self.unindex(entry)
+            entry.bay = record['bay']
+            entry.paired = record['paired']
+        entry.record = record
+        # Short records carry no bay, and no paired flag if shorter still
+        if entry.bay is not None:
+            bay = self.by_bay[entry.bay]
+            bay[mac] = entry
+            bay.move_to_end(mac)
+        if entry.paired is not None:
+            paired = self.by_paired[entry.paired]
+            paired[mac] = entry
+            paired.move_to_end(mac)
+        self.evict(now)
+        return entry
+
+    def remove(self, mac):
+        entry = self.entries.pop(mac.upper(), None)
+        if entry is not None:
+            self.unindex(entry)
+        return entry
+
+    def evict(self, now=None):
+        now = self.clock() if now is None else now
+        while self.entries:
+            entry = next(iter(self.entries.values()))
+            if now - entry.last_seen < self.max_age:
+                break
+            self.remove(entry.mac)
+            self.evictions += 1
+            for callback in self.evicted:
+                callback(entry)
+
+    def latest(self):
+        '''
+        :return: The most recently seen droid, or None
+        '''
+        return next(reversed(self.entries.values()), None)
+
+    def in_bay(self, bay):
+        return list(self.by_bay.get(bay, {}).values())
+
+    def latest_in_bay(self, bay):
+        droids = self.by_bay.get(bay)
+        return next(reversed(droids.values()), None) if droids else None
+
+    def paired(self):
+        return list(self.by_paired[True].values())
+
+    def unpaired(self):
+        return list(self.by_paired[False].values())
+
+    def set_state(self, mac, state):
+        entry = self.get(mac)
+        if entry is None:
+            raise Exception(f'Droid {mac} not seen')
+        entry.state = state
+        return entry
+
+    def find(self, mac=None, bay=None):
+        '''
+        Resolve a target given by address or bay
+
+        :param str mac: Droid address
+        :param int bay: Bay number, the most recently seen droid reporting
+        it is used
+        :rtype: DroidEntry
+        '''
+        if mac is not None:
+            entry = self.get(mac)
+            if entry is None:
+                raise Exception(f'Droid {mac.upper()} not seen')
+        elif bay is not None:
+            entry = self.latest_in_bay(bay)
+            if entry is None:
+                raise Exception(f'No droid seen in bay {bay}')
+        else:
+            entry = self.latest()
+            if entry is None:
+                raise Exception('No droid seen')
+        return entry
+
+    def as_list(self):
+        now = self.clock()
+        return [entry.as_dict(now) for entry in self.entries.values()]
+
+    def stats(self):
+        return {
+            'droids': len(self.entries),
+            'paired': len(self.by_paired[True]),
+            'unpaired': len(self.by_paired[False]),
+            'bays': {bay: len(droids) for bay, droids in self.by_bay.items()},
+            'evictions': self.evictions,
+        }
@@ -1,21 +1,34 @@
 import struct 
 
+import commands
+
+_header = struct.Struct('>BBBB')
+_custom = struct.Struct('>BB')
+
+SCRIPT_SUB_CMD = 0x42
+
 class cmd_buffer:
-    def __init__(self):
-        self.buf = b''
+    def __init__(self, sub_cmd=0x00):
+        '''
+        :param int sub_cmd: Default sub-command for encoded commands. Use
+        SCRIPT_SUB_CMD to encode commands for the currently open command
+        script.
+        '''
+        self.buf = bytearray()
+        self.sub_cmd = sub_cmd
 
     def pop(self):
         '''
         Return the current command buffer and clear it.
 
         :return: The current command buffer
-        :rtype: bytearray
+        :rtype: bytes
         '''
-        ret = self.buf
-        self.buf = b''
+        ret = bytes(self.buf)
+        self.buf.clear()
         return ret
 
-    def cmd(self, id, data=b'', sub_cmd=0x00):
+    def cmd(self, id, data=b'', sub_cmd=None):
         '''
         Encode a single command.
 
@@ -23,11 +36,15 @@ class cmd_buffer:
 
         :param int id: The command id, 0-255
         :param bytearray data: The command data
-        :param int sub_cmd: The sub-command (0 or 0x42)
+        :param int sub_cmd: The sub-command (0 or 0x42), defaults to the
+        buffer's sub_cmd
         '''
+        if sub_cmd is None:
+            sub_cmd = self.sub_cmd
         if len(data) > 0x1f:
             raise Exception('Command data too large')
-        self.buf += struct.pack('>BBBB', (len(data)+3) | 0x20, sub_cmd, id, len(data) | 0x40) + data
+        self.buf += _header.pack((len(data)+3) | 0x20, sub_cmd, id, len(data) | 0x40)
+        self.buf += data
 
     def cmd_script(self, id, data=b''):
         '''
@@ -38,11 +55,25 @@ class cmd_buffer:
         :param int id: The command id, 0-255
         :param bytearray data: The command data
         '''
-        self.cmd(id, data, sub_cmd=0x42)
+        self.cmd(id, data, sub_cmd=SCRIPT_SUB_CMD)
 
     def empty(self):
         return len(self.buf) == 0
 
+_id = commands.encoders['id']
+_led_mono = commands.encoders['led_mono']
+_led_rgb = commands.encoders['led_rgb']
+_led_mono_ramp = commands.encoders['led_mono_ramp']
+_led_mono_flash = commands.encoders['led_mono_flash']
+_led_mono_pulse = commands.encoders['led_mono_pulse']
+_led_rgb_ramp = commands.encoders['led_rgb_ramp']
+_led_rgb_flash = commands.encoders['led_rgb_flash']
+_led_rgb_pulse = commands.encoders['led_rgb_pulse']
+_motor = commands.encoders['motor']
+_nop = commands.encoders['nop']
+_script = commands.encoders['script']
+_delay = commands.encoders['delay']
+
 class robot_cmd_buffer(cmd_buffer):
     def id(self):
         '''
@@ -51,7 +82,7 @@ class robot_cmd_buffer(cmd_buffer):
         Returns the ID of the robot/firmware in a GATT notify event. Return
         data format is unknown but is fixed in the firmware.
         '''
-        self.cmd(0x01)
+        _id(self.buf, self.sub_cmd)
 
     def led_mono(self, idx, value):
         '''
@@ -60,7 +91,7 @@ class robot_cmd_buffer(cmd_buffer):
         :param int idx: The ID of the mono LED, 1-127. A value of 0 sets all mono LEDs
         :param int value: The brightness value of the LED, 0-255
         '''
-        self.cmd(0x02, struct.pack('>BB', idx, value))
+        _led_mono(self.buf, self.sub_cmd, idx, value)
 
     def led_rgb(self, idx, rgb_value):
         '''
@@ -69,7 +100,7 @@ class robot_cmd_buffer(cmd_buffer):
         :param int idx: The ID of the RGB LED, 1-127. A value of 0 sets all RGB LEDs
         :param tuple value: An RGB (r, g, b) brightness tuple of the LED, 0-255
         '''
-        self.cmd(0x03, struct.pack('>BBBB', idx, rgb_value[0], rgb_value[1], rgb_value[2]))
+        _led_rgb(self.buf, self.sub_cmd, idx, rgb_value[0], rgb_value[1], rgb_value[2])
 
     def led_mono_ramp(self, idx, end_value, ramp_time):
         '''
@@ -79,7 +110,7 @@ class robot_cmd_buffer(cmd_buffer):
         :param int end_value: The desired brightness of the LED, 0-255
         :param int ramp_time: The time over which to ramp the value, 0-65535
         '''
-        self.cmd(0x04, struct.pack('>BBHB', 0x01, idx, ramp_time, end_value))
+        _led_mono_ramp(self.buf, self.sub_cmd, idx, ramp_time, end_value)
 
     def led_mono_flash(self, idx, high_value, low_value, flashes, high_period, low_period):
         '''
@@ -92,7 +123,7 @@ class robot_cmd_buffer(cmd_buffer):
         :param int high_period: The per flash on period, 0-65535
         :param int low_period: The per flash off period, 0-65535
         '''
-        self.cmd(0x04, struct.pack('>BBHHBBB', 0x02, idx, high_period, low_period, flashes, high_value, low_value))
+        _led_mono_flash(self.buf, self.sub_cmd, idx, high_period, low_period, flashes, high_value, low_value)
 
     def led_mono_pulse(self, idx, high_value, low_value, cycles, ramp_time):
         '''
@@ -104,7 +135,7 @@ class robot_cmd_buffer(cmd_buffer):
         :param int cycles: The number of times to pulse the LED either up or down. An odd number will leave the LED high. 0-255
         :param int ramp_time: The amount of delay to ramp from low to high or high to low. 0-65535
         '''
-        self.cmd(0x04, struct.pack('>BBHBBB', 0x03, idx, ramp_time, cycles, high_value, low_value))
+        _led_mono_pulse(self.buf, self.sub_cmd, idx, ramp_time, cycles, high_value, low_value)
 
     def led_rgb_ramp(self, idx, rgb_end_value, ramp_time):
         '''
@@ -114,7 +145,7 @@ class robot_cmd_buffer(cmd_buffer):
         :param tuple end_value: An RGB (r, g, b) brightness tuple of the LED, 0-255
         :param int ramp_time: The time over which to ramp the value, 0-65535
         '''
-        self.cmd(0x04, struct.pack('>BBHBBB', 0x04, idx, ramp_time, rgb_end_value[0], rgb_end_value[1], rgb_end_value[2]))
+        _led_rgb_ramp(self.buf, self.sub_cmd, idx, ramp_time, rgb_end_value[0], rgb_end_value[1], rgb_end_value[2])
 
     def led_rgb_flash(self, idx, rgb_high_value, rgb_low_value, flashes, high_period, low_period):
         '''
@@ -126,9 +157,9 @@ class robot_cmd_buffer(cmd_buffer):
         :param int cycles: The number of times to pulse the LED either up or down. An odd number will leave the LED high. 0-255
         :param int ramp_time: The amount of delay to ramp from low to high or high to low. 0-65535
         '''
-        self.cmd(0x04, struct.pack('>BBHHBBBBBBB', 0x05, idx, high_period, low_period, flashes,
+        _led_rgb_flash(self.buf, self.sub_cmd, idx, high_period, low_period, flashes,
                 rgb_high_value[0], rgb_high_value[1], rgb_high_value[2],
-                rgb_low_value[1], rgb_low_value[1], rgb_low_value[2]))
+                rgb_low_value[0], rgb_low_value[1], rgb_low_value[2])
 
     def led_rgb_pulse(self, idx, rgb_high_value, rgb_low_value, cycles, ramp_time):
         '''
@@ -140,9 +171,9 @@ class robot_cmd_buffer(cmd_buffer):
         :param int cycles: The number of times to pulse the LED either up or down. An odd number will leave the LED high. 0-255
         :param int ramp_time: The amount of delay to ramp from low to high or high to low. 0-65535
         '''
-        self.cmd(0x04, struct.pack('>BBHBBBBBBB', 0x06, idx, ramp_time, cycles,
+        _led_rgb_pulse(self.buf, self.sub_cmd, idx, ramp_time, cycles,
                 rgb_high_value[0], rgb_high_value[1], rgb_high_value[2],
-                rgb_low_value[0], rgb_low_value[1], rgb_low_value[2]))
+                rgb_low_value[0], rgb_low_value[1], rgb_low_value[2])
 
     def motor(self, idx, value, ramp_time):
         '''
@@ -154,7 +185,7 @@ class robot_cmd_buffer(cmd_buffer):
         if value < 0:
             value = -value
             idx |= 0x80
-        self.cmd(0x05, struct.pack('>BBH', idx, value, ramp_time))
+        _motor(self.buf, self.sub_cmd, idx, value, ramp_time)
 
     def nop(self, idx):
         '''
@@ -162,7 +193,7 @@ class robot_cmd_buffer(cmd_buffer):
 
         Possibly unimplemented command on BB8/R2
         '''
-        self.cmd(0x06)
+        _nop(self.buf, self.sub_cmd)
 
     def script_open(self, idx):
         '''
@@ -179,7 +210,7 @@ class robot_cmd_buffer(cmd_buffer):
 
         :param int idx: Identifier of the command script, 20-127
         '''
-        self.cmd(0x0c, struct.pack('>BB', idx, 0x00))
+        _script(self.buf, self.sub_cmd, idx, 0x00)
 
     def script_finish(self):
         '''
@@ -187,7 +218,7 @@ class robot_cmd_buffer(cmd_buffer):
 
         Stores the currently in memory command script to flash memory.
         '''
-        self.cmd(0x0c, struct.pack('>BB', 0x00, 0x01))
+        _script(self.buf, self.sub_cmd, 0x00, 0x01)
 
     def script_run(self, idx):
         '''
@@ -195,7 +226,7 @@ class robot_cmd_buffer(cmd_buffer):
 
         :param int idx: Identified or the command script, 1-127
         '''
-        self.cmd(0x0c, struct.pack('>BB', idx, 0x02))
+        _script(self.buf, self.sub_cmd, idx, 0x02)
 
     def delay(self, delay):
         '''
@@ -207,7 +238,7 @@ class robot_cmd_buffer(cmd_buffer):
         script instruction. 1-65535. A value of 0 will use a special in memory
         delay which defaults to zero unless set by a 0xbc beacon.
         '''
-        self.cmd(0x0d, struct.pack('>H', delay))
+        _delay(self.buf, self.sub_cmd, delay)
 
     def custom(self, id, cmd, bytes):
         '''
@@ -217,5 +248,5 @@ class robot_cmd_buffer(cmd_buffer):
         :param int cmd: The sub-command id. 0-255
         :param bytearray bytes: The sub-command data
         '''
-        self.cmd(0x0f, struct.pack('>BB', id, cmd) + bytes)
+        self.cmd(0x0f, _custom.pack(id, cmd) + bytes)
 
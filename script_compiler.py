@@ -0,0 +1,136 @@
+#!/usr/bin/python3
+
+import hashlib
+import json
+import os
+
+import droid_cmd
+import robot_cmd
+
+FIRST_CUSTOM_SCRIPT = 20
+LAST_CUSTOM_SCRIPT = 127
+
+def compile_steps(steps, buffer_class=droid_cmd.droid_cmd_buffer):
+    '''
+    Encode the commands of a script body
+
+    Each step names a command buffer method, either as a tuple of the
+    method name followed by positional arguments, or as a dict with the
+    method name under 'cmd' and keyword arguments for the rest:
+
+        ('led_rgb_ramp', 0, (255, 0, 0), 500)
+        {'cmd': 'delay', 'delay': 1000}
+
+    :param list steps: Script steps
+    :param type buffer_class: robot_cmd_buffer or droid_cmd_buffer
+    :return: Encoded commands for storing in the open command script
+    :rtype: bytes
+    '''
+    buf = buffer_class(sub_cmd=robot_cmd.SCRIPT_SUB_CMD)
+    for step in steps:
+        if isinstance(step, dict):
+            kwargs = dict(step)
+            name = kwargs.pop('cmd')
+            args = ()
+        else:
+            name, args, kwargs = step[0], step[1:], {}
+        if name.startswith('script_') or name in ('cmd', 'cmd_script', 'pop', 'empty'):
+            raise Exception(f'{name} is not a script step')
+        getattr(buf, name)(*args, **kwargs)
+    return buf.pop()
+
+def frame_script(slot, body):
+    '''
+    Wrap an encoded script body in script_open/script_finish for a slot
+
+    :param int slot: Script slot, 20-127
+    :param bytes body: Output of compile_steps
+    :rtype: bytes
+    '''
+    if not FIRST_CUSTOM_SCRIPT <= slot <= LAST_CUSTOM_SCRIPT:
+        raise Exception(f'Script slot {slot} is not writable')
+    buf = robot_cmd.robot_cmd_buffer()
+    buf.script_open(slot)
+    buf.buf += body
+    buf.script_finish()
+    return buf.pop()
+
+def digest(slot, body):
+    return hashlib.sha256(bytes([slot]) + body).hexdigest()
+
+class CompiledScript(object):
+    __slots__ = ('slot', 'body', 'digest', 'data')
+
+    def __init__(self, slot, body):
+        self.slot = slot
+        self.body = body
+        self.digest = digest(slot, body)
+        self.data = frame_script(slot, body)
+
+def compile_scripts(scripts, buffer_class=droid_cmd.droid_cmd_buffer):
+    '''
+    Compile a set of script definitions once for deploying to a fleet
+
+    :param dict scripts: slot -> list of steps (see compile_steps)
+    :return: slot -> CompiledScript
+    :rtype: dict
+    '''
+    return {slot: CompiledScript(slot, compile_steps(steps, buffer_class)) for slot, steps in scripts.items()}
+
+class ScriptStore(object):
+    '''
+    Content hashes of the scripts last written to each droid's slots
+
+    Stored as JSON at path, if given, so deploys stay incremental across
+    runs. Use forget after a droid is reset or its flash is rewritten by
+    other means.
+    '''
+    def __init__(self, path=None):
+        self.path = path
+        self.digests = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                self.digests = json.load(f)
+
+    def get(self, mac, slot):
+        return self.digests.get(mac.lower(), {}).get(str(slot))
+
+    def record(self, mac, compiled):
+        '''
+        Mark scripts as written to a droid
+
+        :param str mac: Droid address
+        :param list compiled: CompiledScript objects that were written
+        '''
+        slots = self.digests.setdefault(mac.lower(), {})
+        for script in compiled:
+            slots[str(script.slot)] = script.digest
+        self.save()
+
+    def forget(self, mac=None):
+        if mac is None:
+            self.digests.clear()
+        else:
+            self.digests.pop(mac.lower(), None)
+        self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.digests, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def plan(self, mac, compiled):
+        '''
+        Select the scripts a droid needs
+
+        :param str mac: Droid address
+        :param dict compiled: Output of compile_scripts
+        :return: (command buffer writing the changed scripts, list of the
+        changed CompiledScript objects to pass to record once written)
+        :rtype: tuple
+        '''
+        changed = [script for slot, script in sorted(compiled.items()) if self.get(mac, slot) != script.digest]
+        return b''.join(script.data for script in changed), changed
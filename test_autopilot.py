@@ -0,0 +1,132 @@
+#!/usr/bin/python3
+
+import contextlib
+
+import pytest
+
+pytest.importorskip('dbus')
+
+import autopilot
+import dbeacon
+import droidstate
+import mainloop
+import registry
+
+class fake_loop(object):
+    def __init__(self):
+        self.timers = {}
+        self.next_source = 1
+
+    def timeout_add(self, interval, callback, *args):
+        source = self.next_source
+        self.next_source += 1
+        self.timers[source] = (interval, callback, args)
+        return source
+
+    def source_remove(self, source):
+        del self.timers[source]
+
+    def fire(self):
+        (source, (interval, callback, args)), = self.timers.items()
+        del self.timers[source]
+        return interval, callback(*args)
+
+class fake_beacon(object):
+    def __init__(self):
+        self.activate = None
+        self.changes = []
+
+    def add_droid_depot_activate(self, gapAddr, action, delay):
+        self.activate = (droidstate.mac_str(gapAddr), action, delay)
+        self.changes.append(self.activate)
+
+    def remove_droid_depot_activate(self):
+        self.activate = None
+        self.changes.append(None)
+
+    @contextlib.contextmanager
+    def batch(self):
+        yield self
+
+class clock(object):
+    now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def record(paired=False, bay=3, action78=False):
+    ret = droidstate.DecodedRecord()
+    for field, value in zip(ret.fields, (0x44, -60, bay, action78, False, 5, 1, paired)):
+        setattr(ret, field, value)
+    return ret
+
+@pytest.fixture
+def bay(monkeypatch):
+    loop = fake_loop()
+    monkeypatch.setattr(mainloop, 'loop', loop)
+    droids = registry.DroidRegistry(clock=clock())
+    automation = autopilot.BayAutomation(fake_beacon(), 3, droids, timeout=10000, activate_time=3000, cooldown=120,
+                                         clock=droids.clock)
+
+    def advertise(mac, rssi=-60, **fields):
+        entry = droids.update(mac, record(**fields), rssi)
+        automation.advertisement(entry)
+        return entry
+
+    return automation, loop, advertise
+
+A = 'D0:00:00:00:00:0A'
+B = 'D0:00:00:00:00:0B'
+
+def test_pair_and_activate(bay):
+    automation, loop, advertise = bay
+    advertise(B, -90)
+    assert automation.state == registry.IDLE
+    entry = advertise(A)
+    assert (automation.state, entry.state) == (registry.PAIRING, registry.PAIRING)
+    assert automation.adv.activate == (A, dbeacon.DROID_DEPOT_ACTIVATE_PAIR, 0)
+    # Other droids and unpaired advertisements do not move the bay on
+    advertise(B, -50)
+    advertise(A)
+    assert automation.target is entry and automation.state == registry.PAIRING
+
+    advertise(A, paired=True)
+    assert automation.state == registry.ACTIVATING
+    assert automation.adv.activate == (A, dbeacon.DROID_DEPOT_ACTIVATE_GO, 2)
+    advertise(A, -55, paired=True)
+    assert automation.state == registry.ACTIVATING
+    advertise(A, paired=True, action78=True)
+    # B is still waiting in the bay and is picked as A is done
+    assert automation.adv.changes[-2:] == [None, (B, dbeacon.DROID_DEPOT_ACTIVATE_PAIR, 0)]
+    assert entry.state == registry.IDLE and automation.target.mac == B
+    assert [interval for interval, callback, args in loop.timers.values()] == [10000]
+    stats = automation.stats()
+    assert (stats['paired'], stats['activated'], stats['go_timeouts']) == (1, 1, 0)
+
+def test_timeouts_and_cooldown(bay):
+    automation, loop, advertise = bay
+    advertise(A)
+    assert loop.fire() == (10000, False)
+    assert automation.state == registry.IDLE and automation.adv.activate is None
+    assert automation.stats()['timeouts'] == 1
+
+    # A timed out droid waits for the cooldown before it is picked again
+    advertise(A)
+    assert automation.state == registry.IDLE
+    automation.droids.clock.now = 120
+    advertise(A)
+    assert automation.state == registry.PAIRING
+
+    advertise(A, paired=True)
+    assert loop.fire() == (3000, False)
+    assert automation.state == registry.IDLE and automation.adv.activate is None
+    assert automation.stats()['go_timeouts'] == 1 and not loop.timers
+
+def test_cancel(bay):
+    automation, loop, advertise = bay
+    assert automation.cancel() is None
+    entry = advertise(A)
+    assert automation.cancel(advertise(B, -90)) is None
+    assert automation.cancel(entry) == A
+    assert automation.state == registry.IDLE and automation.adv.activate is None and not loop.timers
+    assert automation.stats()['cancelled'] == 1
@@ -0,0 +1,38 @@
+#!/usr/bin/python3
+
+import io
+
+import pytest
+
+pytest.importorskip('dbus')
+
+import capture
+import dbeacon
+
+def test_roundtrip():
+    f = io.BytesIO()
+    writer = capture.CaptureWriter(f)
+    droid = {dbeacon.MFG_ID_DISNEY: capture.droid_payload(1, 5, True, 3, -60), 0x004c: b'\x01\x02'}
+    writer.write('d0:00:00:00:00:01', 'DROID', -60, droid, 1700000000.0)
+    writer.write('0E:00:00:00:00:02', None, None, None, 1700000000.5)
+    writer.write('0E:00:00:00:00:03', 'Phone', -300, {0x004c: bytes(300)}, 1700000001.0)
+    # 200 two byte characters, cut to 127 of them
+    writer.write('0E:00:00:00:00:04', 'é' * 200, -70, {}, 1700000001.5)
+    assert writer.records == 4
+    assert list(capture.read_capture(f.getvalue())) == [
+        (1700000000.0, 'D0:00:00:00:00:01', 'DROID', -60, {dbeacon.MFG_ID_DISNEY: droid[dbeacon.MFG_ID_DISNEY]}),
+        (1700000000.5, '0E:00:00:00:00:02', '', None, None),
+        (1700000001.0, '0E:00:00:00:00:03', 'Phone', -127, {0x004c: bytes(255)}),
+        (1700000001.5, '0E:00:00:00:00:04', 'é' * 127, -70, None),
+    ]
+
+def test_torn_tail():
+    f = io.BytesIO()
+    writer = capture.CaptureWriter(f)
+    for i in range(3):
+        writer.write(f'D0:00:00:00:00:0{i}', 'DROID', -60, {dbeacon.MFG_ID_DISNEY: b'\x03\x00'}, 1700000000.0 + i)
+    buf = f.getvalue()
+    for end in range(len(buf) - 1, len(buf) - 20, -1):
+        assert len(list(capture.read_capture(buf[:end]))) == 2
+    with pytest.raises(Exception, match='Not a droid capture'):
+        list(capture.read_capture(b'DROIDCAP0\n'))
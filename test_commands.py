@@ -0,0 +1,98 @@
+#!/usr/bin/python3
+
+import io
+import random
+
+import pytest
+
+import commands
+import droid_cmd
+import parse_entry1
+import robot_cmd
+
+_field_ranges = {'B': 0x100, 'H': 0x10000}
+
+def script_entry(buf):
+    '''
+    Convert cmd_buffer output to script entry commands by dropping the
+    size and sub-command bytes of each command header
+    '''
+    ret = bytearray()
+    offset = 0
+    while offset < len(buf):
+        length = 4 + (buf[offset + 3] & 0x1f)
+        ret += buf[offset + 2:offset + length]
+        offset += length
+    return bytes(ret)
+
+def expected_args(spec, fields):
+    args = {'cmd': spec.name}
+    args.update(fields)
+    if spec.fixup is not None:
+        spec.fixup(args)
+    return args
+
+@pytest.mark.parametrize('spec', commands.commands, ids=lambda spec: spec.key)
+def test_roundtrip(spec):
+    rnd = random.Random(spec.key)
+    for _ in range(500):
+        fields = {field: rnd.randrange(_field_ranges[fmt]) for field, fmt in zip(spec.fields, spec.fmt)}
+        buf = bytearray()
+        spec.encode(buf, robot_cmd.SCRIPT_SUB_CMD, *fields.values())
+        assert list(parse_entry1.iter_cmds(script_entry(buf))) == [expected_args(spec, fields)]
+
+def test_roundtrip_sequences():
+    rnd = random.Random(0)
+    for _ in range(2000):
+        buf = bytearray()
+        expected = []
+        for spec in (rnd.choice(commands.commands) for _ in range(rnd.randrange(1, 8))):
+            fields = {field: rnd.randrange(_field_ranges[fmt]) for field, fmt in zip(spec.fields, spec.fmt)}
+            spec.encode(buf, robot_cmd.SCRIPT_SUB_CMD, *fields.values())
+            expected.append(expected_args(spec, fields))
+        assert list(parse_entry1.iter_cmds(script_entry(buf))) == expected
+
+@pytest.mark.parametrize('method, args, expected', [
+    ('bb8_fwd_rev', (180, 100, 500), {'value': 180, 'reverse': False}),
+    ('bb8_fwd_rev', (-180, 100, 500), {'value': 180, 'reverse': True}),
+    ('bb8_fwd_rev_default', (True, 100, 500), {'value': 'default', 'reverse': False}),
+    ('bb8_fwd_rev_default', (False, 100, 500), {'value': 'default', 'reverse': True}),
+])
+def test_fwd_rev(method, args, expected):
+    buf = droid_cmd.droid_cmd_buffer()
+    getattr(buf, method)(*args)
+    expected = dict(expected, cmd='Drive Fwd/Rev', ramp_time=100, delay=500)
+    assert list(parse_entry1.iter_cmds(script_entry(buf.buf))) == [expected]
+
+def test_fwd_rev_entry():
+    # Script entry 19 drives with the default value, then with value 0
+    cmds = [args for args in parse_entry1.parse(bytes.fromhex(parse_entry1.entries[19]))
+            if args['cmd'] == 'Drive Fwd/Rev']
+    assert [args['value'] for args in cmds] == ['default', 0, 'default']
+    assert not any(args['reverse'] for args in cmds)
+
+def test_pop():
+    buf = droid_cmd.droid_cmd_buffer()
+    buf.delay(100)
+    first = buf.pop()
+    buf.delay(200)
+    assert first == bytes.fromhex('25000d420064') and type(first) is bytes
+    assert buf.pop() == bytes.fromhex('25000d4200c8')
+    assert buf.empty()
+
+def entry_dump():
+    return b''.join(bytes.fromhex(entry) for entry in parse_entry1.entries.values())
+
+def test_iter_entries():
+    expected = [(entry_id, parse_entry1.parse(bytes.fromhex(entry))) for entry_id, entry in parse_entry1.entries.items()]
+    assert [(entry_id, list(cmds)) for entry_id, cmds in parse_entry1.iter_entries(entry_dump())] == expected
+    assert [(entry_id, list(cmds)) for entry_id, cmds in parse_entry1.read_entries(io.BytesIO(entry_dump()))] == expected
+
+def test_read_entries_bad_length():
+    dump = entry_dump()
+    with pytest.raises(ValueError, match='too short'):
+        list(parse_entry1.read_entries(io.BytesIO(dump + bytes.fromhex('010000'))))
+    with pytest.raises(ValueError, match='too short'):
+        list(parse_entry1.iter_entries(dump + bytes.fromhex('01000001')))
+    with pytest.raises(ValueError, match='Truncated'):
+        list(parse_entry1.read_entries(io.BytesIO(dump[:-1])))
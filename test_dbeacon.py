@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+
+import pytest
+
+pytest.importorskip('dbus')
+
+import dbeacon
+
+def test_parse_droid():
+    record = dbeacon.parse(bytes.fromhex('03064481820105c4'))[0x03]
+    assert record.as_dict() == {
+        'sub_id': 0x03, 'sub_len': 6, 'sub_data': None,
+        'droid_id': 0x44, 'rssi': -60, 'bay': 5, 'action78': False, 'battery_low': False,
+        'personalityChip': 1, 'affiliation': 0, 'paired': True,
+    }
+    assert record['bay'] == record.bay
+
+def test_parse_droid_short():
+    record = dbeacon.parse(bytes.fromhex('030444018205'))[0x03]
+    assert (record.droid_id, record.paired, record.personalityChip) == (0x44, False, 5)
+    assert record.bay is None and record.rssi is None
+    record = dbeacon.parse(bytes.fromhex('03024401'))[0x03]
+    assert record.droid_id is None and record.bay is None
+
+def test_parse_depot():
+    beacons = dbeacon.parse(bytes.fromhex('bd0205a6bc08d5a8b5ba307a0100'))
+    assert (beacons[0xbd].bay, beacons[0xbd].expectedRssi) == (5, -90)
+    activate = beacons[0xbc]
+    assert (activate.gapAddr, activate.action, activate.delay) == (bytes.fromhex('d5a8b5ba307a'), 1, 0)
+    assert activate.sub_data == bytes.fromhex('d5a8b5ba307a0100')
+
+def test_parse_truncated():
+    # A sub-record running past the end of the data ends the parse
+    assert list(dbeacon.parse(bytes.fromhex('bd0205a6030644818201'))) == [0xbd]
+    assert dbeacon.parse(b'') == {}
+    assert dbeacon.parse(b'\x03') == {}
+
+def scalar_droids(payloads, fields):
+    ret = []
+    for payload in payloads:
+        record = dbeacon.parse(payload).get(0x03)
+        ret.append(None if record is None else {key: record[key] for key in fields})
+    return ret
+
+def test_batch_matches_parse():
+    pytest.importorskip('numpy')
+    import dbeacon_batch
+
+    payloads = dbeacon_batch.random_payloads(5000)
+    matrix, lengths = dbeacon_batch.pack(payloads)
+    assert (dbeacon_batch.to_records(dbeacon_batch.parse_droid(matrix, lengths)) ==
+            scalar_droids(payloads, dbeacon_batch.droid_fields))
+    # Rows cut by a narrower matrix decode like truncated payloads
+    matrix, lengths = dbeacon_batch.pack(payloads, 6)
+    assert (dbeacon_batch.to_records(dbeacon_batch.parse_droid(matrix, lengths)) ==
+            scalar_droids([payload[:6] for payload in payloads], dbeacon_batch.droid_fields))
+
+def test_parse_cache():
+    import parse_cache
+
+    cache = parse_cache.ParseCache(maxsize=2)
+    a, b, c = (bytes.fromhex(f'0306448182{personality:02x}05c4') for personality in (1, 2, 3))
+    beacons, changed = cache.lookup('D0:00:00:00:00:01', a)
+    assert changed and beacons[0x03].personalityChip == 1
+    assert cache.lookup('D0:00:00:00:00:01', a) == (beacons, False)
+    cache.lookup('D0:00:00:00:00:02', b)
+    # a was used more recently than b, so b is evicted by c
+    cache.lookup('D0:00:00:00:00:01', a)
+    cache.lookup('D0:00:00:00:00:03', c)
+    assert list(cache.entries) == [('D0:00:00:00:00:01', a), ('D0:00:00:00:00:03', c)]
+    assert cache.lookup('D0:00:00:00:00:01', a)[0] is beacons
+    stats = cache.stats()
+    assert (stats['size'], stats['hits'], stats['misses'], stats['evictions']) == (2, 3, 3, 1)
+    # The last payload of a MAC is kept for change detection
+    assert cache.lookup('D0:00:00:00:00:01', b)[1]
+    assert not cache.lookup('D0:00:00:00:00:01', b)[1]
+
+class offline_bus(object):
+    def get_object(self, *args, **kwargs):
+        return None
+
+    def _register_object_path(self, *args, **kwargs):
+        pass
+
+class offline_manager(object):
+    adapter_name = 'hci0'
+    _bus = offline_bus()
+
+def test_activation_latency_across_refresh():
+    import metrics
+
+    adv = dbeacon.dBeacon(offline_manager(), 0)
+    adv.rh = lambda: None
+    registered = metrics.spans['published', 'registered'].count
+    adv.add_droid_depot_activate(bytes.fromhex('d5a8b5ba307a'), 1, 0)
+    adv.register_sent()
+    # Another refresh goes out before BlueZ replies to the first
+    adv.register_sent()
+    assert adv.activation_published == 'D5:A8:B5:BA:30:7A'
+    adv.registered()
+    assert adv.activation_published is None
+    assert metrics.spans['published', 'registered'].count == registered + 1
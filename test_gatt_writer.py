@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+
+import os
+import socket
+
+import pytest
+
+pytest.importorskip('dbus')
+
+import droid_cmd
+import gatt_writer
+
+def commands(count):
+    buf = droid_cmd.droid_cmd_buffer()
+    for i in range(count):
+        buf.led_rgb(0, (i, i, i))
+        buf.delay(100)
+    return buf.pop()
+
+def test_packetize():
+    buf = commands(5)
+    packets = list(gatt_writer.packetize(buf))
+    # 8 byte RGB LED and 6 byte delay commands, 20 bytes per packet
+    assert [(len(packet), count) for packet, count in packets] == [(14, 2)] * 5
+    assert b''.join(packet for packet, count in packets) == bytes(buf)
+    packets = list(gatt_writer.packetize(buf, mtu=247))
+    assert [(len(packet), count) for packet, count in packets] == [(70, 10)]
+    assert gatt_writer.count_commands(buf) == 10
+    assert list(gatt_writer.packetize(b'')) == []
+
+def test_packetize_errors():
+    buf = bytes(commands(1))
+    with pytest.raises(Exception, match='Truncated'):
+        list(gatt_writer.packetize(buf[:-1]))
+    with pytest.raises(Exception, match='Truncated'):
+        list(gatt_writer.packetize(buf + buf[:3]))
+    with pytest.raises(Exception, match='MTU'):
+        list(gatt_writer.packetize(buf, mtu=10))
+
+class fake_fd(object):
+    def __init__(self, fd):
+        self.fd = fd
+
+    def take(self):
+        return self.fd
+
+class fake_characteristic(object):
+    def __init__(self, fd):
+        self._object = self
+        self.fd = fd
+
+    def AcquireWrite(self, options, dbus_interface=None):
+        return fake_fd(self.fd), 23
+
+def test_socket_write_error():
+    local, remote = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    fd = os.dup(local.fileno())
+    local.close()
+    remote.close()
+    dropped = []
+    drained = []
+    writer = gatt_writer.CommandWriter(fake_characteristic(fd), acquire=True, drained=lambda: drained.append(True),
+                                       dropped=lambda count, error: dropped.append((count, type(error))))
+    writer.write(commands(5))
+    assert dropped == [(10, BrokenPipeError)]
+    assert drained == [True]
+    assert writer.fd is None and writer.idle()
+    assert writer.stats()['failed_commands'] == 10
+    with pytest.raises(OSError):
+        os.fstat(fd)
@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+
+import pytest
+
+import droidstate
+import droidtable
+import obslog
+
+LOW_RSSI_MAC = 'D0:00:00:00:00:10'
+
+def low_rssi_record():
+    # RSSI byte 0x10, decoded by dbeacon.DroidRecord as 0x10 - 256
+    record = droidstate.DecodedRecord()
+    for field, value in zip(record.fields, (0x44, 0x10 - 256, 3, False, True, 5, 1, True)):
+        setattr(record, field, value)
+    return record
+
+def test_pack_record_low_rssi_byte():
+    record = low_rssi_record()
+    decoded = droidstate.unpack_record(*droidstate.pack_record(record))
+    assert [decoded[field] for field in decoded.fields] == [record[field] for field in record.fields]
+
+def test_table_low_rssi_byte():
+    table = droidtable.DroidTable.create(4)
+    try:
+        table.write(LOW_RSSI_MAC, low_rssi_record(), -300)
+        (mac, record, rssi, last_seen, advertisements), = table.changed()
+        assert mac == LOW_RSSI_MAC
+        assert record['rssi'] == -240
+        assert record['bay'] == 3
+        assert rssi == -127
+    finally:
+        table.close()
+
+def test_obslog_low_rssi_byte(tmp_path):
+    path = str(tmp_path / 'droids.log')
+    writer = obslog.ObservationWriter(path)
+    writer.write(LOW_RSSI_MAC, low_rssi_record(), -60, 1700000000.0)
+    writer.close()
+    log = obslog.ObservationLog(path)
+    try:
+        observation, = log.query(LOW_RSSI_MAC)
+        assert observation.record_rssi == -240
+        assert observation.rssi == -60
+        assert observation.battery_low
+    finally:
+        log.close()
+
+def test_obslog_reindex_after_crash(tmp_path):
+    path = str(tmp_path / 'droids.log')
+    writer = obslog.ObservationWriter(path, bucket=60)
+    for i in range(300):
+        writer.write(f'D0:00:00:00:00:{i % 7:02X}', low_rssi_record(), -60, 1700000000.0 + i)
+    writer.close()
+    # Records that reached the log before a crash, without index entries
+    writer = obslog.ObservationWriter(path, bucket=60)
+    writer.index_records = lambda buf: None
+    for i in range(300, 400):
+        writer.write(LOW_RSSI_MAC, low_rssi_record(), -60, 1700000000.0 + i)
+    writer.close()
+    obslog.ObservationWriter(path).close()
+    log = obslog.ObservationLog(path)
+    try:
+        assert len(list(log.query(LOW_RSSI_MAC))) == 100
+        assert len(list(log.query(start=1700000000.0, end=1700000400.0))) == 400
+        assert len(list(log.query('D0:00:00:00:00:03'))) == len(range(3, 300, 7))
+    finally:
+        log.close()
+
+def test_discovery_low_rssi_byte(tmp_path):
+    pytest.importorskip('dbus')
+    import capture
+    import dbeacon
+    import discovery
+
+    table = droidtable.DroidTable.create(4)
+    try:
+        droids = discovery.DroidDiscovery(verbose=False)
+        seen = []
+        writer = obslog.ObservationWriter(str(tmp_path / 'droids.log'))
+        droids.listeners.append(lambda entry: table.write(entry.mac, entry.record, entry.rssi[-1]))
+        droids.listeners.append(writer.observer)
+        droids.listeners.append(seen.append)
+        mfd = {dbeacon.MFG_ID_DISNEY: capture.droid_payload(1, 5, True, 3, 0x10)}
+        entry = droids.advertisement(LOW_RSSI_MAC, 'DROID', -60, mfd)
+        assert entry.record['rssi'] == -240
+        assert seen == [entry]
+        (mac, record, rssi, last_seen, advertisements), = table.changed()
+        assert record['rssi'] == -240
+        assert rssi == -60
+        writer.close()
+        log = obslog.ObservationLog(writer.path)
+        assert [observation.record_rssi for observation in log] == [-240]
+        log.close()
+    finally:
+        table.close()
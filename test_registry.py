@@ -0,0 +1,52 @@
+#!/usr/bin/python3
+
+import pytest
+
+import droidstate
+import registry
+
+def record(bay=None, paired=False, rssi=-60):
+    ret = droidstate.DecodedRecord()
+    for field, value in zip(ret.fields, (0x44, rssi, bay, False, False, 5, 1, paired)):
+        setattr(ret, field, value)
+    return ret
+
+def test_index():
+    droids = registry.DroidRegistry()
+    droids.update('d0:00:00:00:00:01', record(3), now=0)
+    droids.update('D0:00:00:00:00:02', record(3, True), -50, now=1, adapter='hci1')
+    droids.update('D0:00:00:00:00:03', record(), now=2)
+    assert [entry.mac for entry in droids.in_bay(3)] == ['D0:00:00:00:00:01', 'D0:00:00:00:00:02']
+    assert droids.latest_in_bay(3).mac == 'D0:00:00:00:00:02'
+    assert droids.get('D0:00:00:00:00:02').adapters == {'hci1': (-50, 1)}
+    assert [entry.mac for entry in droids.paired()] == ['D0:00:00:00:00:02']
+    # A droid without a bay is not in any bay index
+    assert droids.stats()['bays'] == {3: 2}
+
+    # Moving bays and pairing update the indexes
+    droids.update('D0:00:00:00:00:01', record(4, True), now=3)
+    assert [entry.mac for entry in droids.in_bay(3)] == ['D0:00:00:00:00:02']
+    assert droids.find(bay=4).mac == 'D0:00:00:00:00:01'
+    assert len(droids.paired()) == 2 and [entry.mac for entry in droids.unpaired()] == ['D0:00:00:00:00:03']
+    assert droids.find().mac == 'D0:00:00:00:00:01'
+    assert list(droids.get('D0:00:00:00:00:01').rssi) == [-60, -60]
+
+    droids.remove('D0:00:00:00:00:02')
+    assert droids.in_bay(3) == [] and 3 not in droids.by_bay
+    with pytest.raises(Exception, match='No droid seen in bay 3'):
+        droids.find(bay=3)
+
+def test_eviction():
+    droids = registry.DroidRegistry(max_age=10)
+    evicted = []
+    droids.evicted.append(evicted.append)
+    droids.update('D0:00:00:00:00:01', record(1), now=0)
+    droids.update('D0:00:00:00:00:02', record(2), now=5)
+    droids.update('D0:00:00:00:00:01', record(1), now=8)
+    droids.update('D0:00:00:00:00:03', record(3), now=15)
+    assert [entry.mac for entry in evicted] == ['D0:00:00:00:00:02']
+    assert 'D0:00:00:00:00:02' not in droids and droids.in_bay(2) == []
+    droids.evict(now=18)
+    assert [entry.mac for entry in evicted] == ['D0:00:00:00:00:02', 'D0:00:00:00:00:01']
+    assert [entry.mac for entry in droids] == ['D0:00:00:00:00:03']
+    assert droids.stats()['evictions'] == 2
@@ -0,0 +1,44 @@
+#!/usr/bin/python3
+
+import pytest
+
+import droid_cmd
+import robot_cmd
+import script_compiler
+
+SCRIPTS = {
+    20: [('led_rgb_ramp', 0, (255, 0, 0), 500), {'cmd': 'delay', 'delay': 1000}],
+    21: [('bb8_fwd_rev', -100, 200, 0)],
+}
+
+def test_compile_steps():
+    buf = droid_cmd.droid_cmd_buffer(sub_cmd=robot_cmd.SCRIPT_SUB_CMD)
+    buf.led_rgb_ramp(0, (255, 0, 0), 500)
+    buf.delay(1000)
+    assert script_compiler.compile_steps(SCRIPTS[20]) == buf.pop()
+    with pytest.raises(Exception, match='not a script step'):
+        script_compiler.compile_steps([('script_run', 20)])
+    with pytest.raises(Exception, match='not writable'):
+        script_compiler.compile_scripts({10: []})
+
+def test_plan_dedup(tmp_path):
+    path = str(tmp_path / 'scripts.json')
+    compiled = script_compiler.compile_scripts(SCRIPTS)
+    store = script_compiler.ScriptStore(path)
+    data, changed = store.plan('d0:00:00:00:00:01', compiled)
+    assert [script.slot for script in changed] == [20, 21]
+    assert data == compiled[20].data + compiled[21].data
+    store.record('d0:00:00:00:00:01', changed)
+
+    # Written scripts are skipped for that droid only, also after a reload
+    store = script_compiler.ScriptStore(path)
+    assert store.plan('D0:00:00:00:00:01', compiled) == (b'', [])
+    assert len(store.plan('D0:00:00:00:00:02', compiled)[1]) == 2
+
+    # Only the changed slot is written again
+    compiled = script_compiler.compile_scripts({**SCRIPTS, 21: [('bb8_fwd_rev', 100, 200, 0)]})
+    data, changed = store.plan('D0:00:00:00:00:01', compiled)
+    assert [script.slot for script in changed] == [21] and data == compiled[21].data
+
+    store.forget('D0:00:00:00:00:01')
+    assert len(script_compiler.ScriptStore(path).plan('D0:00:00:00:00:01', compiled)[1]) == 2
@@ -0,0 +1,145 @@
+#!/usr/bin/python3
+
+import collections
+import hashlib
+
+import parse_entry1
+
+START_TIMER_DELAY = 3000
+
+Event = collections.namedtuple('Event', 'start end channel cmd')
+
+class Timeline(object):
+    '''
+    Simulated execution of a command script
+
+    All times are in ms from the start of the script. Script commands run
+    back to back; only Delay, the delay argument of the custom motion
+    commands and the start_timer flag of Center R2 Head hold up the next
+    command. LED and motor effects run on in the background on their own
+    channel.
+    '''
+    def __init__(self, events, cursor):
+        self.events = tuple(events)
+        self.cursor = cursor
+        self.duration = max([cursor] + [event.end for event in events])
+
+    def channels(self):
+        '''
+        :return: channel -> list of events on that channel
+        :rtype: dict
+        '''
+        ret = collections.defaultdict(list)
+        for event in self.events:
+            ret[event.channel].append(event)
+        return dict(ret)
+
+    def busy_until(self, channel):
+        return max((event.end for event in self.events if event.channel == channel), default=0)
+
+def effect(cmd):
+    '''
+    Channel and length of the background effect of a command
+
+    Serial writes (sounds) and Script commands are recorded as instant
+    events, their run time is not known here.
+
+    :return: (channel, duration in ms), channel is None for commands that
+    only affect script timing
+    '''
+    name = cmd.get('cmd')
+    if name == 'Mono LED':
+        return f'mono_led:{cmd["id"]}', 0
+    if name == 'RGB LED':
+        return f'rgb_led:{cmd["id"]}', 0
+    if name in ('LED Mono Ramp', 'LED Mono Flash', 'LED Mono Pulse'):
+        channel = f'mono_led:{cmd["id"]}'
+    elif name in ('LED RGB Ramp', 'LED RGB Flash', 'LED RGB Pulse'):
+        channel = f'rgb_led:{cmd["id"]}'
+    elif name == 'Motor':
+        return f'motor:{cmd["id"]}', cmd['ramp_time']
+    elif name in ('Rotate R2 Head1', 'Rotate R2 Head2', 'Center R2 Head'):
+        return 'head', cmd.get('ramp_time', 0)
+    elif name in ('BB8 Rotate', 'Drive Fwd/Rev'):
+        return 'drive', cmd['ramp_time']
+    elif name == 'Serial Write':
+        return 'serial', 0
+    elif name == 'Script':
+        return 'script', 0
+    else:
+        return None, 0
+
+    if name.endswith('Ramp'):
+        return channel, cmd['ramp_time']
+    if name.endswith('Flash'):
+        return channel, cmd['flashes'] * (cmd['high_period'] + cmd['low_period'])
+    return channel, cmd['cycles'] * cmd['ramp_time']
+
+def hold(cmd, default_delay):
+    '''
+    Time in ms before the next script command runs
+    '''
+    name = cmd.get('cmd')
+    if name == 'Delay':
+        return cmd['delay'] or default_delay
+    if name == 'Center R2 Head':
+        return START_TIMER_DELAY if cmd['start_timer'] else 0
+    if name in ('Rotate R2 Head1', 'Rotate R2 Head2', 'BB8 Rotate', 'Drive Fwd/Rev'):
+        return cmd['delay']
+    return 0
+
+def simulate(cmds, default_delay=0):
+    '''
+    Simulate a decoded command stream
+
+    :param iterable cmds: Decoded commands, as from parse_entry1.iter_cmds
+    :param int default_delay: Delay in ms used by 'Delay' commands with a
+    delay of 0, set on the droid by the 0xbc activate beacon (delay * 100)
+    :rtype: Timeline
+    '''
+    events = []
+    cursor = 0
+    for cmd in cmds:
+        channel, duration = effect(cmd)
+        if channel is not None:
+            events.append(Event(cursor, cursor + duration, channel, cmd))
+        cursor += hold(cmd, default_delay)
+    return Timeline(events, cursor)
+
+CACHE_SIZE = 256
+
+_cache = collections.OrderedDict()
+
+def entry_timeline(entry, default_delay=0):
+    '''
+    Simulate a script entry, memoized by its content hash in an LRU of
+    CACHE_SIZE timelines
+
+    The returned Timeline is shared between callers.
+
+    :param bytes entry: Script entry including its header
+    :rtype: Timeline
+    '''
+    key = (hashlib.sha256(entry).digest(), default_delay)
+    timeline = _cache.get(key)
+    if timeline is None:
+        parse_entry1.parse_header(entry)
+        timeline = simulate(parse_entry1.iter_cmds(entry, 4), default_delay)
+        _cache[key] = timeline
+        if len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    else:
+        _cache.move_to_end(key)
+    return timeline
+
+def duration(entry, default_delay=0):
+    '''
+    Total run time in ms of a script entry
+    '''
+    return entry_timeline(entry, default_delay).duration
+
+if __name__ == '__main__':
+    for id, entry in parse_entry1.entries.items():
+        timeline = entry_timeline(bytes.fromhex(entry))
+        channels = ', '.join(f'{channel} {max(e.end for e in events)}' for channel, events in sorted(timeline.channels().items()))
+        print(f'Entry {id:2d}: {timeline.duration:6d}ms ({channels})')